@@ -0,0 +1,7 @@
+function(doc, req) {
+    // passes items and refresh requests to the backend's dispatcher, leaving
+    // out metric snapshots, deletions (claims and pruned snapshots) and other
+    // docs that can't be on a queue.
+    return !doc._deleted && (typeof doc.aliases != "undefined" ||
+        doc.type == "refresh_request");
+}
@@ -1,14 +1,19 @@
 function(doc) {
-    // lists items, ordered by the last-modified time of their aliases.
+    // lists items, ordered by priority lane (interactive items before bulk
+    // ones; see LANES in queue.py), then the last-modified time of their
+    // aliases.
+    // the values are null, to keep the index small; query with include_docs
+    // to get the items.
+    var lane = (doc.priority == "interactive") ? 0 : 1;
     if (typeof doc.aliases != "undefined") {
         if (typeof doc.last_requested != "undefined") {
             if (typeof doc.aliases.last_completed == "undefined") {
                 // Aliases has never been defined
-                emit([doc.last_requested], doc);
+                emit([lane, doc.last_requested], null);
             } else { 
                 // Aliases has been defined, but it is behind the doc definition
                 if (doc.aliases.last_completed < doc.last_requested) {
-                    emit([doc.last_requested], doc);
+                    emit([lane, doc.last_requested], null);
                 }
             }
         }
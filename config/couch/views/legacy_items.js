@@ -0,0 +1,19 @@
+function(doc) {
+    // lists items saved before metric snapshots were stored separately that
+    //    still have more than one value of a metric in the item, for the
+    //    metrics compactor to move out to snapshots
+    // the values are null, to keep the index small; query with include_docs
+    //    to get the items
+    if (typeof doc.metrics == "object" && typeof doc.aliases == "object") {
+        for (var metricName in doc.metrics) {
+            var count = 0
+            for (var ts in doc.metrics[metricName].values) {
+                count++
+            }
+            if (count > 1) {
+                emit(null, null);
+                return;
+            }
+        }
+    }
+}
@@ -1,6 +1,8 @@
 function(doc) {
-    // for items that have aliases, lists items sorted by provider, last request
-    //    time, and last update time
+    // for items that have aliases, lists items sorted by provider, priority
+    //    lane, last request time, and last update time; and refresh requests
+    // the values are null, to keep the index small; query with include_docs
+    //    to get the items
 
 
     getMetricLastUpdated = function(metricValues){
@@ -35,10 +37,23 @@ function(doc) {
             // Check to see if this metric has been updated since
             // the latest compilation of the aliases
             if ( doc.aliases.last_completed ) {
+              // interactive items go before bulk ones (see LANES in queue.py)
+              var lane = (doc.priority == "interactive") ? 0 : 1
               if ( lastModified < doc.aliases.last_completed ) {
-                emit([name, doc.last_requested, lastModified], doc);
+                emit([name, lane, doc.last_requested, lastModified], null);
               }
             }
         }
     }
+
+    // refreshes the refresh scheduler asked for (see refreshes.py) are listed
+    // under the refresh request doc, in the bulk lane, until they're done
+    if (doc.type == "refresh_request") {
+        var completed = doc.completed || {}
+        for (var name in doc.requested) {
+            if ( doc.requested[name] > (completed[name] || 0) ) {
+                emit([name, 1, doc.requested[name], null], null);
+            }
+        }
+    }
 }
@@ -0,0 +1,27 @@
+function(doc) {
+    // for items whose aliases have been compiled, lists the item under each
+    //    provider it has metrics from, sorted by when the provider's metrics
+    //    were last updated, for the refresh scheduler to find the stale ones
+    // the values are null, to keep the index small; query with include_docs
+    //    to get the items
+    if (typeof doc.metrics == "object" && doc.aliases && doc.aliases.last_completed) {
+        var lastModified = {}
+        for (var metricName in doc.metrics) {
+            var thisMetric = doc.metrics[metricName]
+            if ( !thisMetric.ignore ) {
+                var providerName = metricName.split(':')[0]
+                for (var ts in thisMetric.values) {
+                    if (!(lastModified[providerName] >= Number(ts))) {
+                        lastModified[providerName] = Number(ts)
+                    }
+                }
+            }
+        }
+        // metrics that have never been fetched are left to the metrics queue
+        for (var name in lastModified) {
+            if (lastModified[name]) {
+                emit([name, lastModified[name]], null);
+            }
+        }
+    }
+}
@@ -0,0 +1,8 @@
+function(doc) {
+    // lists the metric snapshots of items, by tiid, metric name and time
+    if (doc.type == "metric_snapshot") {
+        for (var metricName in doc.values) {
+            emit([doc.tiid, metricName, doc.ts], doc.values[metricName]);
+        }
+    }
+}
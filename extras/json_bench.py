@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+#
+# Compares the size and serialisation cost of the API's JSON styles, with
+# and without gzip, on item docs with long metric histories.
+#
+# usage: python extras/json_bench.py [--days 365] [--items 20] [--runs 20]
+#
+
+import os, sys, json, time, zlib, copy
+from optparse import OptionParser
+
+import yaml
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from totalimpact import api
+
+ARTICLE_LOC = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    "../test/data/couch_docs/article.yml")
+
+
+def make_item_dicts(num_items, num_days):
+    ''' Makes item dicts like the API sends, from the sample article doc,
+        with num_days of daily snapshots for each metric.
+    '''
+    article = yaml.load(open(ARTICLE_LOC, "r").read())
+    start = 1328000000
+    item_dicts = []
+    for item_num in range(num_items):
+        item_dict = copy.deepcopy(article)
+        item_dict["tiid"] = "%032x" % item_num
+        for (metric_name, metric) in item_dict["metrics"].iteritems():
+            metric["values"] = dict([
+                (str(start + day * 86400), day * 7 + item_num)
+                for day in range(num_days)])
+        item_dicts.append(item_dict)
+    return item_dicts
+
+def gzip_size(data):
+    return len("".join(api.gzip_chunks([data], api.app.config["GZIP"]["level"])))
+
+def time_it(func, runs):
+    start = time.clock()
+    for run in range(runs):
+        func()
+    return (time.clock() - start) / runs
+
+def main():
+    parser = OptionParser()
+    parser.add_option("--days", dest="days", type="int", default=365,
+        help="number of snapshots per metric")
+    parser.add_option("--items", dest="items", type="int", default=20,
+        help="number of items, as in a GET /items request")
+    parser.add_option("--runs", dest="runs", type="int", default=20,
+        help="number of times to time each serialisation")
+    (options, args) = parser.parse_args()
+
+    item_dicts = make_item_dicts(options.items, options.days)
+    level = api.app.config["GZIP"]["level"]
+
+    print "%i items, %i snapshots per metric, %i runs\n" % (
+        options.items, options.days, options.runs)
+    print "%-8s %12s %12s %12s %12s" % (
+        "style", "bytes", "gzip bytes", "dumps ms", "+gzip ms")
+
+    for style in api.JSON_STYLES:
+        data = api.to_json(item_dicts, style)
+        dumps_time = time_it(lambda: api.to_json(item_dicts, style), options.runs)
+        gzip_time = time_it(lambda: "".join(api.gzip_chunks([data], level)), options.runs)
+        print "%-8s %12i %12i %12.2f %12.2f" % (
+            style, len(data), gzip_size(data), dumps_time * 1000, gzip_time * 1000)
+
+if __name__ == '__main__':
+    main()
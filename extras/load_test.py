@@ -94,11 +94,21 @@ def checkItem(item, data, item_type, debug=False):
 
 
 from twisted.internet import reactor
-from twisted.web.client import getPage 
+from twisted.web.client import getPage, HTTPClientFactory
+from twisted.web import error
 
 total_responses = 0
 
-REQUEST_DETAILS_RETRY_DELAY=5
+# How long each request for an item's details is held open by the server,
+# waiting for the item to change, before it gives up with a 304
+REQUEST_DETAILS_WAIT=30
+
+def getPageWithHeaders(url, *args, **kwargs):
+    """ Like getPage, but the deferred fires with (page, response headers) """
+    factory = HTTPClientFactory(url, *args, **kwargs)
+    reactor.connectTCP(factory.host, factory.port, factory)
+    factory.deferred.addCallback(lambda page: (page, factory.response_headers))
+    return factory.deferred
 
 class TotalImpactAPIAsync:
     base_url = 'http://localhost:5001/'
@@ -107,6 +117,7 @@ class TotalImpactAPIAsync:
     def __init__(self):
         self.item_ids = {}
         self.item_details = {}
+        self.item_etags = {}
         self.total_responses = 0
         self.details_responses = 0
         self.item_idx = 0
@@ -121,17 +132,25 @@ class TotalImpactAPIAsync:
         self.total_responses += 1
         reactor.stop()
 
-    def handleItemDetailsResponse(self, response, idx, item_type, count):
+    def handleItemDetailsResponse(self, result, idx, item_type, count):
+        (response, headers) = result
         if self.debug: print 'Details received for %i' % idx
         self.item_details[idx] = json.loads(urllib.unquote(response))
+        self.item_etags[idx] = headers.get('etag', [None])[0]
         if not checkItem(self.item_ids[idx], self.item_details[idx], item_type):
-            # This item isn't read yet, lets keep re-requesting
-            if self.debug: print "not ready yet, calling later"
-            reactor.callLater(REQUEST_DETAILS_RETRY_DELAY, self._request_details, idx, item_type, count+1)
+            # This item isn't ready yet. Ask again straight away: the
+            # server holds the request until the item changes.
+            if self.debug: print "not ready yet, waiting for changes"
+            self._request_details(idx, item_type, count+1)
         else:
             self.details_responses += 1
 
-    def handleItemDetailsFailure(self, failure, idx):
+    def handleItemDetailsFailure(self, failure, idx, item_type, count):
+        if failure.check(error.Error) and failure.value.status == '304':
+            # nothing changed while we waited, so wait again
+            if self.debug: print "no changes for %i, waiting again" % idx
+            self._request_details(idx, item_type, count+1)
+            return
         print 'Item details failed for %i' % idx, failure
         self.details_responses += 1
         reactor.stop()
@@ -158,10 +177,15 @@ class TotalImpactAPIAsync:
     def _request_details(self, idx, item_type, count=1):
         item_id = self.item_ids[idx]
         url = self.base_url + urllib.quote('item/%s' % (item_id))
+        headers = {}
+        if self.item_etags.get(idx):
+            # long-poll for changes to the version we already have
+            url += '?wait=%i' % REQUEST_DETAILS_WAIT
+            headers['If-None-Match'] = self.item_etags[idx]
         if self.debug: print "Getting %i / %s" % (idx, url)
-        d = getPage(url, method='GET')
+        d = getPageWithHeaders(url, method='GET', headers=headers)
         d.addCallback(self.handleItemDetailsResponse, idx, item_type, count)
-        d.addErrback(self.handleItemDetailsFailure, idx)
+        d.addErrback(self.handleItemDetailsFailure, idx, item_type, count)
 
 
 class TotalImpactTest:
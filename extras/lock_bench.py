@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+#
+# Compares the old per-item lock map with the striped item locks used by
+# Saveable.save(): memory (lock objects kept) and time for many threads
+# taking item locks at once.
+#
+# usage: python extras/lock_bench.py [--threads 20] [--items 50000]
+#
+
+import os, sys, time, threading
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from totalimpact import models
+
+
+class LegacyItemLock:
+    ''' GlobalItemLock as it was: a lock per item id, behind a master lock '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.itemLock = {}
+
+    def getItemLock(self, item_id):
+        self.lock.acquire()
+        if not self.itemLock.has_key(item_id):
+            self.itemLock[item_id] = threading.Lock()
+        self.lock.release()
+        return self.itemLock[item_id]
+
+    def count(self):
+        return len(self.itemLock)
+
+
+def take_locks(locks, item_ids):
+    for item_id in item_ids:
+        lock = locks.getItemLock(item_id)
+        lock.acquire()
+        lock.release()
+
+def run(locks, num_threads, num_items):
+    ''' each thread takes the lock of num_items different items '''
+    threads = [threading.Thread(target=take_locks,
+            args=(locks, ["%i-%i" % (thread_num, i) for i in range(num_items)]))
+        for thread_num in range(num_threads)]
+
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.time() - start
+
+def main():
+    parser = OptionParser()
+    parser.add_option("--threads", dest="threads", type="int", default=20,
+        help="number of threads taking locks")
+    parser.add_option("--items", dest="items", type="int", default=50000,
+        help="number of items each thread locks")
+    (options, args) = parser.parse_args()
+
+    print "%i threads, %i items each\n" % (options.threads, options.items)
+    print "%-10s %12s %10s" % ("locks", "lock objs", "secs")
+
+    legacy = LegacyItemLock()
+    secs = run(legacy, options.threads, options.items)
+    print "%-10s %12i %10.2f" % ("legacy", legacy.count(), secs)
+
+    striped = models.GlobalItemLock()
+    secs = run(striped, options.threads, options.items)
+    print "%-10s %12i %10.2f" % ("striped", len(striped.stripes), secs)
+
+if __name__ == '__main__':
+    main()
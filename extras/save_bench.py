@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+#
+# Counts the db round trips made by Saveable.save() in the API's item create
+# path and in the backend's alias and metrics updates, and compares them with
+# the old read-merge-write save.
+#
+# By default the docs are kept in memory, so only the counts mean anything.
+# Pass --couch to run against the couchdb in the config (it makes and then
+# deletes a save_bench db) and get timings too.
+#
+# usage: python extras/save_bench.py [--items 100] [--couch]
+#
+
+import os, sys, time, copy
+from optparse import OptionParser
+
+import couchdb
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from totalimpact import models, dao, default_settings
+from totalimpact.models import ItemFactory
+
+BENCH_DB_NAME = "save_bench"
+
+
+class MemoryDao(object):
+    ''' Keeps docs in a dict, checking _revs on save like couch does '''
+
+    def __init__(self):
+        self.docs = {}
+
+    def get(self, id):
+        return copy.deepcopy(self.docs.get(id))
+
+    def save_and_commit(self, doc):
+        current = self.docs.get(doc["id"])
+        if doc.get("_rev") != (current and current["_rev"]):
+            raise couchdb.ResourceConflict("conflict")
+        doc = copy.deepcopy(doc)
+        doc["_id"] = doc["id"]
+        doc["_rev"] = str(int(current["_rev"]) + 1) if current else "1"
+        self.docs[doc["id"]] = doc
+        return (doc["id"], doc["_rev"])
+
+
+class CountingDao(object):
+    ''' Wraps a dao, counting the calls made to it '''
+
+    def __init__(self, wrapped):
+        self.wrapped = wrapped
+        self.counts = {"get": 0, "save_and_commit": 0}
+
+    def get(self, id):
+        self.counts["get"] += 1
+        return self.wrapped.get(id)
+
+    def save_and_commit(self, doc):
+        self.counts["save_and_commit"] += 1
+        return self.wrapped.save_and_commit(doc)
+
+    def total(self):
+        return sum(self.counts.values())
+
+
+def legacy_save(self):
+    ''' Saveable.save as it was: read the doc, merge, then write '''
+    while True:
+        try:
+            new_dict = self.dao.get(self.id)
+            dict_to_save = self._update_dict(new_dict)
+            if new_dict:
+                dict_to_save['_rev'] = new_dict['_rev']
+            return self.dao.save_and_commit(dict_to_save)
+        except couchdb.ResourceConflict, e:
+            pass
+
+
+def create_items(mydao, num_items):
+    ''' Like the API's POST /item/:namespace/:id '''
+    items = []
+    for num in range(num_items):
+        item = ItemFactory.make(mydao, default_settings.PROVIDERS)
+        item.aliases.add_alias("doi", "10.1/%i" % num)
+        item.save()
+        items.append(item)
+    return items
+
+def update_aliases(mydao, items, num_providers):
+    ''' Like the backend's alias thread: a save per provider '''
+    for item in items:
+        for provider_num in range(num_providers):
+            item.aliases.add_alias("url", "http://example.org/%i/%i" % (
+                provider_num, len(item.aliases.get_aliases_list())))
+            item.save()
+
+def update_metrics(mydao, items):
+    ''' Like the backend's metrics threads: load the item, add a snap, save '''
+    for item in items:
+        item = ItemFactory.get(mydao, item.id, default_settings.PROVIDERS)
+        item.metrics["wikipedia:mentions"]["values"][str(time.time())] = 1
+        item.save()
+
+def run(mydao, num_items, num_providers):
+    counting_dao = CountingDao(mydao)
+    results = []
+
+    start = time.time()
+    items = create_items(counting_dao, num_items)
+    results.append(("API create", counting_dao.total(), time.time() - start))
+
+    for (name, func, args) in [
+            ("backend aliases", update_aliases, (counting_dao, items, num_providers)),
+            ("backend metrics", update_metrics, (counting_dao, items))]:
+        before = counting_dao.total()
+        start = time.time()
+        func(*args)
+        results.append((name, counting_dao.total() - before, time.time() - start))
+
+    return results
+
+def make_dao(options):
+    if not options.couch:
+        return MemoryDao()
+    mydao = dao.Dao(BENCH_DB_NAME)
+    mydao.create_new_db_and_connect(BENCH_DB_NAME)
+    return mydao
+
+def main():
+    parser = OptionParser()
+    parser.add_option("--items", dest="items", type="int", default=100,
+        help="number of items to create and update")
+    parser.add_option("--providers", dest="providers", type="int", default=4,
+        help="number of alias providers (saves per item in the alias thread)")
+    parser.add_option("--couch", dest="couch", default=False, action="store_true",
+        help="use the couchdb from the config, and time the requests")
+    (options, args) = parser.parse_args()
+
+    new_save = models.Saveable.save
+    models.Saveable.save = legacy_save
+    legacy_results = run(make_dao(options), options.items, options.providers)
+    models.Saveable.save = new_save
+    results = run(make_dao(options), options.items, options.providers)
+
+    if options.couch:
+        dao.Dao(BENCH_DB_NAME).delete_db(BENCH_DB_NAME)
+
+    print "%i items, %i alias providers\n" % (options.items, options.providers)
+    print "%-16s %14s %14s %12s %12s" % (
+        "path", "old requests", "new requests", "old secs", "new secs")
+    for ((name, old_count, old_secs), (name, new_count, new_secs)) in zip(legacy_results, results):
+        print "%-16s %14i %14i %12.3f %12.3f" % (
+            name, old_count, new_count, old_secs, new_secs)
+
+if __name__ == '__main__':
+    main()
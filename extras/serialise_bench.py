@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+#
+# Microbenchmarks Saveable.as_dict() against the recursive todict() it used
+# to be, for items with long metric histories, their aliases, collections
+# and errors. Also checks the two give the same docs.
+#
+# usage: python extras/serialise_bench.py [--days 365] [--runs 200]
+#
+
+import os, sys, time, timeit
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from totalimpact import default_settings
+from totalimpact.models import ItemFactory, CollectionFactory, Error, todict
+
+
+def make_item(num_days):
+    item = ItemFactory.make(None, default_settings.PROVIDERS)
+    item.aliases.add_alias("doi", "10.1371/journal.pbio.0050082")
+    item.aliases.add_alias("url", "http://dx.doi.org/10.1371/journal.pbio.0050082")
+    item.biblio = {"data": {"title": "Environmental Shotgun Sequencing",
+        "journal": "PLoS Biology", "author": ["Eisen, M."], "year": 2007}}
+    start = 1328000000
+    for (num, metric) in enumerate(item.metrics.values()):
+        metric["provenance_url"] = "http://example.org/%i" % num
+        metric["values"] = dict([(str(start + day * 86400), day * 7 + num)
+            for day in range(num_days)])
+    return item
+
+def make_collection(num_items):
+    collection = CollectionFactory.make(None)
+    collection.title = "My Collection"
+    collection.add_items(["%032x" % num for num in range(num_items)])
+    return collection
+
+def make_error():
+    e = Error(None)
+    e.message = "Error opening file"
+    e.error_type = "http_timeout"
+    e.provider = "github_provider"
+    e.stack_trace = "Python Stacktrace"
+    return e
+
+def legacy_as_dict(obj):
+    return todict(obj, ignore=['dao'])
+
+def main():
+    parser = OptionParser()
+    parser.add_option("--days", dest="days", type="int", default=365,
+        help="number of snapshots per metric")
+    parser.add_option("--runs", dest="runs", type="int", default=200,
+        help="number of times to serialise each object")
+    (options, args) = parser.parse_args()
+
+    objs = [
+        ("item", make_item(options.days)),
+        ("aliases", make_item(0).aliases),
+        ("collection", make_collection(100)),
+        ("error", make_error())
+    ]
+
+    print "%i snapshots per metric, %i runs\n" % (options.days, options.runs)
+    print "%-12s %14s %14s %8s" % ("object", "todict() us", "as_dict() us", "speedup")
+
+    for (name, obj) in objs:
+        new_func = obj.as_dict
+        assert new_func() == legacy_as_dict(obj)
+
+        legacy_secs = timeit.timeit(lambda: legacy_as_dict(obj), number=options.runs) / options.runs
+        new_secs = timeit.timeit(new_func, number=options.runs) / options.runs
+        print "%-12s %14.1f %14.1f %7.0fx" % (
+            name, legacy_secs * 1e6, new_secs * 1e6, legacy_secs / new_secs)
+
+if __name__ == '__main__':
+    main()
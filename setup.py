@@ -19,6 +19,10 @@ setup(
         "negotiate",
         "importlib"
     ],
+    extras_require = {
+        # for running the backend with --gevent
+        "gevent": ["gevent"]
+    },
     url = '',
     author = 'total-impact',
     author_email = 'totalimpactdev@gmail.com',
@@ -2,6 +2,8 @@ import os, unittest, time
 import sys
 import logging
 import traceback
+from copy import deepcopy
+import couchdb
 
 from totalimpact import default_settings
 from totalimpact.backend import StoppableThread
@@ -17,19 +19,154 @@ from totalimpact.models import Aliases
 def dao_init_mock(self, config):
     pass
 
+def collation_key(value):
+    ''' Sorts view keys the way couch does: null, booleans, numbers,
+        strings, arrays, then objects '''
+    if value is None:
+        return (0,)
+    if isinstance(value, bool):
+        return (1, value)
+    if isinstance(value, (int, long, float)):
+        return (2, value)
+    if isinstance(value, basestring):
+        return (3, value)
+    if isinstance(value, (list, tuple)):
+        return (4, [collation_key(v) for v in value])
+    return (5, sorted([(k, collation_key(v)) for (k, v) in value.iteritems()]))
+
 class MockDao(object):
+    """ Fakes the bits of the Dao the code under test uses.
+
+        Docs are kept in a dict, and saves and deletes check the _rev like
+        couch does. _all_docs lists them; other views serve the rows given
+        for them (or a function that makes the rows from the docs). Views
+        take the key, keys, startkey, startkey_docid, endkey, limit and
+        include_docs params, and group_level, which counts the rows like a
+        _count reduce. changes() hands out the changes given.
+
+        The methods called are recorded in calls, and the view queries
+        made (with their params) in queries.
+
+        setResponses() makes get() hand back the given docs in turn instead.
+    """
+
+    def __init__(self, docs=None, view_rows=None, changes=None, update_seq=5):
+        self.docs = {}
+        for doc in docs or []:
+            doc = deepcopy(doc)
+            doc["_id"] = doc.get("_id", doc.get("id"))
+            doc["_rev"] = doc.get("_rev", "1")
+            self.docs[doc["_id"]] = doc
+        self.view_rows = view_rows or {}
+        self.changes_docs = changes or []
+        self.update_seq = update_seq
+        self.responses = None
+        self.calls = []
+        self.queries = []
 
-    def get(self, id):
-        ret = self.responses[self.index]
-        self.index = self.index + 1
-        return ret
-    
     def setResponses(self, responses):
         self.responses = responses
         self.index = 0
 
+    def get(self, id):
+        self.calls.append("get")
+        return self._get(id)
+
+    def _get(self, id):
+        if self.responses is not None:
+            ret = self.responses[self.index]
+            self.index = self.index + 1
+            return ret
+        return deepcopy(self.docs.get(id))
+    
+    def get_bulk(self, ids):
+        self.calls.append("get_bulk")
+        return [self._get(id) for id in ids]
+
     def save(self, doc):
-        self.save.append(doc)
+        self.calls.append("save")
+        return self._save(doc)
+
+    def save_and_commit(self, doc):
+        return self.save(doc)
+
+    def _save(self, doc):
+        doc["_id"] = doc["id"]
+        current = self.docs.get(doc["_id"])
+        if doc.get("_rev") != (current and current["_rev"]):
+            raise couchdb.ResourceConflict("conflict")
+        doc = deepcopy(doc)
+        doc["_rev"] = str(int(current["_rev"]) + 1) if current else "1"
+        self.docs[doc["_id"]] = doc
+        return (doc["_id"], doc["_rev"])
+
+    def bulk_save(self, docs):
+        self.calls.append("bulk_save")
+        ret = []
+        for doc in docs:
+            try:
+                (id, rev) = self._save(doc)
+                ret.append((True, id, rev))
+            except couchdb.ResourceConflict, e:
+                ret.append((False, doc["id"], e))
+        return ret
+
+    def bulk_delete(self, docs):
+        self.calls.append("bulk_delete")
+        ret = []
+        for doc in docs:
+            current = self.docs.get(doc["_id"])
+            if current is not None and current["_rev"] == doc["_rev"]:
+                del self.docs[doc["_id"]]
+                ret.append((True, doc["_id"], str(int(doc["_rev"]) + 1)))
+            else:
+                ret.append((False, doc["_id"], couchdb.ResourceConflict("conflict")))
+        return ret
+
+    def view(self, viewname, **params):
+        self.calls.append("view")
+        self.queries.append((viewname, dict(params)))
+        if viewname == '_all_docs':
+            rows = [{"id": id, "key": id, "value": {"rev": doc["_rev"]}}
+                for (id, doc) in self.docs.iteritems()]
+        else:
+            rows = self.view_rows.get(viewname, [])
+            if callable(rows):
+                rows = rows(self.docs)
+        rows = sorted(rows, key=lambda row: (collation_key(row["key"]), row["id"]))
+
+        if "key" in params:
+            rows = [row for row in rows if row["key"] == params["key"]]
+        if "keys" in params:
+            rows = [row for key in params["keys"] for row in rows if row["key"] == key]
+        if "startkey" in params:
+            start = (collation_key(params["startkey"]), params.get("startkey_docid", ""))
+            rows = [row for row in rows if (collation_key(row["key"]), row["id"]) >= start]
+        if "endkey" in params:
+            end = collation_key(params["endkey"])
+            rows = [row for row in rows if collation_key(row["key"]) <= end]
+        if "group_level" in params:
+            counts = []
+            for row in rows:
+                key = row["key"][:params["group_level"]]
+                if counts and counts[-1]["key"] == key:
+                    counts[-1]["value"] += 1
+                else:
+                    counts.append({"key": key, "value": 1})
+            rows = counts
+        if "limit" in params:
+            rows = rows[:params["limit"]]
+        if params.get("include_docs"):
+            rows = [dict(row, doc=deepcopy(self.docs.get(row["id"]))) for row in rows]
+        return {"rows": rows}
+
+    def get_update_seq(self):
+        return self.update_seq
+
+    def changes(self, since, timeout, filter=None):
+        self.calls.append("changes")
+        (changes, self.changes_docs) = (self.changes_docs, [])
+        return (changes, since + len(changes))
 
 
 
@@ -76,9 +213,21 @@ class QueueMock(object):
             self.current_item += 1
         return item
 
+    def dequeue_batch(self, n):
+        item = self.dequeue()
+        if item:
+            return ("bulk", [item])
+        return (None, [])
+
+    def more_urgent_waiting(self, lane):
+        return False
+
     def save_and_unqueue(self, item):
         logging.debug("Unqueue item %s" % item.id)
 
+    def unqueue(self, item_id):
+        logging.debug("Unqueue item %s" % item_id)
+
 
 class ItemMock(object):
     def __init__(self,id=None,dao=None):
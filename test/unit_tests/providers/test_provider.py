@@ -90,6 +90,16 @@ class Test_Provider(unittest.TestCase):
         provider = ProviderFactory.get_provider("wikipedia")
         assert_equals(provider.__class__.__name__, "Wikipedia")
         
+    def test_08_get_provider_is_shared(self):
+        provider = ProviderFactory.get_provider("wikipedia")
+        assert provider is ProviderFactory.get_provider("wikipedia")
+        assert_equals(provider.provider_name, "wikipedia")
+
+    def test_08_load_provider_makes_new_instance(self):
+        provider = ProviderFactory.load_provider("wikipedia")
+        assert provider is not ProviderFactory.get_provider("wikipedia")
+        assert_equals(provider.provider_name, "wikipedia")
+
     def test_09_get_providers(self):
         providers = ProviderFactory.get_providers(self.provider_configs)
         assert len(providers) == len(self.provider_configs)
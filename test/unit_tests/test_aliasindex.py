@@ -0,0 +1,127 @@
+import unittest, threading
+from nose.tools import assert_equals
+
+from totalimpact.aliasindex import AliasIndex, lookup_tiids, lookup_tiids_bulk
+from test.mocks import MockDao
+
+VIEW_ROWS = [
+    {"id": "tiid1", "key": ["doi", "10.1/a"], "value": "tiid1"},
+    {"id": "tiid1", "key": ["url", "http://a.org"], "value": "tiid1"},
+    {"id": "tiid2", "key": ["doi", "10.1/b"], "value": "tiid2"},
+    {"id": "tiid3", "key": ["doi", "10.1/b"], "value": "tiid3"}
+]
+
+class BlockingDao(MockDao):
+    ''' Holds up reads of the whole view until unblocked is set '''
+
+    def __init__(self, **kwargs):
+        MockDao.__init__(self, **kwargs)
+        self.unblocked = threading.Event()
+
+    def view(self, viewname, **params):
+        if "key" not in params and "keys" not in params:
+            self.unblocked.wait(5)
+        return MockDao.view(self, viewname, **params)
+
+
+class TestAliasIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.d = MockDao(view_rows={"queues/by_alias": list(VIEW_ROWS)})
+
+    def test_lookup_tiids_uses_key(self):
+        tiids = lookup_tiids(self.d, "doi", "10.1/b")
+        assert_equals(tiids, ["tiid2", "tiid3"])
+        assert_equals(self.d.queries, [("queues/by_alias", {"key": ["doi", "10.1/b"]})])
+
+    def test_lookup_tiids_bulk(self):
+        tiids = lookup_tiids_bulk(self.d, [("doi", "10.1/a"), ("doi", "10.1/b"), ("doi", "unknown")])
+        assert_equals(tiids, {
+            ("doi", "10.1/a"): ["tiid1"],
+            ("doi", "10.1/b"): ["tiid2", "tiid3"],
+            ("doi", "unknown"): []
+            })
+        assert_equals(len(self.d.queries), 1)
+
+    def test_get_tiids(self):
+        index = AliasIndex(self.d)
+        index.load()
+        assert_equals(index.get_tiids("doi", "10.1/a"), ["tiid1"])
+        assert_equals(index.get_tiids("doi", "10.1/b"), ["tiid2", "tiid3"])
+        assert_equals(index.get_tiids("url", "http://a.org"), ["tiid1"])
+
+        # the view was read once, without a key, to load the index
+        assert_equals(self.d.queries, [("queues/by_alias", {"limit": 10001})])
+
+    def test_get_tiids_falls_back_to_view_on_miss(self):
+        index = AliasIndex(self.d)
+        index.load()
+        self.d.view_rows["queues/by_alias"].append({"id": "tiid4", "key": ["doi", "10.1/new"], "value": "tiid4"})
+
+        assert_equals(index.get_tiids("doi", "10.1/new"), ["tiid4"])
+        assert_equals(self.d.queries[-1], ("queues/by_alias", {"key": ["doi", "10.1/new"]}))
+
+        # the answer is remembered
+        index.get_tiids("doi", "10.1/new")
+        assert_equals(len(self.d.queries), 2)
+
+    def test_get_tiids_unknown_alias(self):
+        index = AliasIndex(self.d)
+        index.load()
+        assert_equals(index.get_tiids("doi", "unknown"), [])
+
+    def test_add(self):
+        index = AliasIndex(self.d)
+        index.load()
+        index.add("doi", "10.1/a", "tiid5")
+        index.add("doi", "10.1/a", "tiid5")
+        assert_equals(index.get_tiids("doi", "10.1/a"), ["tiid1", "tiid5"])
+
+    def test_reloads_in_background_when_stale(self):
+        d = BlockingDao(view_rows={"queues/by_alias": list(VIEW_ROWS)})
+        index = AliasIndex(d, max_age=-1)
+        d.unblocked.set()
+        index.load()
+        d.unblocked.clear()
+
+        d.view_rows["queues/by_alias"].append({"id": "tiid4", "key": ["doi", "10.1/a"], "value": "tiid4"})
+        # the stale index answers while it's reloaded, and only one reload runs
+        assert_equals(index.get_tiids("doi", "10.1/a"), ["tiid1"])
+        loader = index.loader
+        assert_equals(index.get_tiids("doi", "10.1/a"), ["tiid1"])
+        assert index.loader is loader
+
+        # an alias added while the view is being read isn't lost
+        index.add("doi", "10.1/c", "tiid5")
+        d.unblocked.set()
+        loader.join(5)
+        assert_equals(index.loader, None)
+        index.max_age = 600
+        assert_equals(index.get_tiids("doi", "10.1/a"), ["tiid1", "tiid4"])
+        assert_equals(index.get_tiids("doi", "10.1/c"), ["tiid5"])
+        assert_equals(d.calls.count("view"), 2)
+
+    def test_first_lookups_dont_wait_for_load(self):
+        d = BlockingDao(view_rows={"queues/by_alias": list(VIEW_ROWS)})
+        index = AliasIndex(d)
+        # answered with a keyed query while the index loads
+        assert_equals(index.get_tiids("doi", "10.1/b"), ["tiid2", "tiid3"])
+        d.unblocked.set()
+        index.loader.join(5)
+        assert index.loaded_at is not None
+
+    def test_get_tiids_bulk(self):
+        index = AliasIndex(self.d)
+        index.load()
+        self.d.view_rows["queues/by_alias"].append({"id": "tiid4", "key": ["doi", "10.1/new"], "value": "tiid4"})
+
+        tiids = index.get_tiids_bulk([("doi", "10.1/a"), ("doi", "10.1/new"), ("doi", "unknown")])
+        assert_equals(tiids, {
+            ("doi", "10.1/a"): ["tiid1"],
+            ("doi", "10.1/new"): ["tiid4"],
+            ("doi", "unknown"): []
+            })
+
+        # only the aliases missing from the index were queried for
+        assert_equals(self.d.queries[-1],
+            ("queues/by_alias", {"keys": [["doi", "10.1/new"], ["doi", "unknown"]]}))
@@ -1,10 +1,13 @@
-import unittest, json, uuid
+import unittest, json, uuid, gzip
+from StringIO import StringIO
 from copy import deepcopy
 from urllib import quote_plus
 from nose.tools import nottest, assert_equals
 from BeautifulSoup import BeautifulSoup
 
 from totalimpact import api, dao
+from totalimpact.models import ItemFactory
+from test.mocks import MockDao
 from totalimpact.providers.dryad import Dryad
 import os, yaml
 
@@ -60,6 +63,121 @@ class ApiTester(unittest.TestCase):
 
         self.d.create_new_db_and_connect(self.testing_db_name)
 
+class TestConnectToDb(ApiTester):
+
+    def test_dao_is_reused_between_requests(self):
+        self.client.get('/')
+        first_dao = api.mydao
+        self.client.get('/')
+        assert api.mydao is first_dao
+
+    def test_dao_follows_config(self):
+        self.client.get('/')
+        first_dao = api.mydao
+
+        self.app.config["DB_NAME"] = "api_test_other"
+        try:
+            self.client.get('/')
+            assert api.mydao is not first_dao
+            assert_equals(api.mydao.db_name, "api_test_other")
+        finally:
+            self.app.config["DB_NAME"] = self.testing_db_name
+            api.mydao.delete_db("api_test_other")
+
+class TestRequestOptions(unittest.TestCase):
+
+    def setUp(self):
+        self.app = api.app
+
+    def tearDown(self):
+        self.app.config["JSON_STYLE"] = "pretty"
+
+    def test_default_is_from_config(self):
+        with self.app.test_request_context('/'):
+            assert_equals(api.json_style(), "pretty")
+            assert_equals(api.to_json({"b": 1, "a": [1, 2]}),
+                '{\n    "a": [\n        1, \n        2\n    ], \n    "b": 1\n}')
+
+        self.app.config["JSON_STYLE"] = "compact"
+        with self.app.test_request_context('/'):
+            assert_equals(api.json_style(), "compact")
+            assert_equals(api.to_json({"a": [1, 2]}), '{"a":[1,2]}')
+
+    def test_query_param(self):
+        with self.app.test_request_context('/?json=compact'):
+            assert_equals(api.json_style(), "compact")
+        with self.app.test_request_context('/?json=nonsense'):
+            assert_equals(api.json_style(), "pretty")
+
+    def test_accept_header(self):
+        with self.app.test_request_context('/',
+                headers={"Accept": "text/html, application/json; q=0.9; style=compact"}):
+            assert_equals(api.json_style(), "compact")
+        with self.app.test_request_context('/',
+                headers={"Accept": "text/html; style=compact"}):
+            assert_equals(api.json_style(), "pretty")
+
+    def test_get_wait(self):
+        with self.app.test_request_context('/?wait=5'):
+            assert_equals(api.get_wait(), 5)
+        with self.app.test_request_context('/?wait=100000'):
+            assert_equals(api.get_wait(), self.app.config["LONG_POLL"]["max_wait"])
+        with self.app.test_request_context('/'):
+            assert_equals(api.get_wait(), 0)
+
+    def test_gzip_chunks(self):
+        data = "".join(api.gzip_chunks(["[", '{"a":1}', "]"], 6))
+        assert_equals(gzip.GzipFile(fileobj=StringIO(data)).read(), '[{"a":1}]')
+
+
+class TestCreateItems(unittest.TestCase):
+
+    def setUp(self):
+        self.old_dao = api.mydao
+        self.old_index_config = api.app.config["ALIAS_INDEX"]
+        api.app.config["ALIAS_INDEX"] = dict(self.old_index_config, enabled=False)
+        # the view is empty, as if the items below were made by another
+        # request after we looked
+        api.mydao = MockDao(view_rows={"queues/by_alias": []})
+
+    def tearDown(self):
+        api.mydao = self.old_dao
+        api.app.config["ALIAS_INDEX"] = self.old_index_config
+
+    def test_create_item(self):
+        (tiid, created) = api.create_item("doi", "10.1/a")
+        assert_equals(created, True)
+        assert_equals(tiid, ItemFactory.alias_tiid("doi", "10.1/a"))
+        assert_equals(api.mydao.docs[tiid]["aliases"]["doi"], ["10.1/a"])
+
+        # couch's conflict stops a second item being made
+        assert_equals(api.create_item("doi", "10.1/a"), (tiid, False))
+        assert_equals(len(api.mydao.docs), 1)
+
+    def test_create_items(self):
+        (tiid, created) = api.create_item("doi", "10.1/a")
+        ret = api.create_items([("doi", "10.1/a"), ("doi", "10.1/b")])
+        assert_equals(ret[("doi", "10.1/a")], (tiid, "exists"))
+        assert_equals(ret[("doi", "10.1/b")], (ItemFactory.alias_tiid("doi", "10.1/b"), "created"))
+        assert_equals(len(api.mydao.docs), 2)
+
+    def test_interactive_request_promotes_bulk_items(self):
+        ret = api.create_items([("doi", "10.1/a"), ("doi", "10.1/b")], "bulk")
+        (tiid_a, tiid_b) = [ret[("doi", nid)][0] for nid in ["10.1/a", "10.1/b"]]
+
+        # asking for them in bulk again leaves them be
+        api.create_items([("doi", "10.1/a")], "bulk")
+        assert_equals(api.mydao.docs[tiid_a]["priority"], "bulk")
+        assert_equals(api.mydao.docs[tiid_a]["_rev"], "1")
+
+        assert_equals(api.create_item("doi", "10.1/a"), (tiid_a, False))
+        assert_equals(api.mydao.docs[tiid_a]["priority"], "interactive")
+        api.create_items([("doi", "10.1/a"), ("doi", "10.1/b")], "interactive")
+        assert_equals(api.mydao.docs[tiid_b]["priority"], "interactive")
+        # a was interactive already, so wasn't written again
+        assert_equals(api.mydao.docs[tiid_a]["_rev"], "2")
+
+
 class TestMemberItems(ApiTester):
 
     def setUp(self): 
@@ -100,11 +218,13 @@ class TestTiid(ApiTester):
         response = self.client.post('/item/doi/IdThatAlreadyExists/')
         print response
         print response.data
-
-        # FIXME should check and if already exists return 200
-        # right now this makes a new item every time, creating many dups
         assert_equals(response.status_code, 201)
-        assert_equals(len(json.loads(response.data)), 32)
+        tiid = json.loads(response.data)
+
+        # posting the same alias again gives back the extant tiid
+        response = self.client.post('/item/doi/IdThatAlreadyExists/')
+        assert_equals(response.status_code, 200)
+        assert_equals(json.loads(response.data), tiid)
         assert_equals(response.mimetype, "application/json")
 
     def test_item_get_unknown_tiid(self):
@@ -139,7 +259,7 @@ class TestItem(ApiTester):
         assert_equals(
             set(json.loads(response.data).keys()),
             set([u'tiid', u'aliases', u'biblio', u'created', u'id', u'last_modified',
-                u'last_requested', u'metrics'])
+                u'last_requested', u'metrics', u'priority'])
             )
         assert_equals(response.mimetype, "application/json")
 
@@ -159,6 +279,99 @@ class TestItem(ApiTester):
         print response
         print tiid
 
+    def test_item_provenance_urls_post(self):
+        resp = self.client.post('/item/doi/' + quote_plus(TEST_DRYAD_DOI))
+        tiid = json.loads(resp.data)
+
+        # not worked out until the backend has done the aliases
+        resp = self.client.get('/item/' + tiid)
+        item_dict = json.loads(resp.data)
+        assert_equals(item_dict["metrics"]["dryad:package_views"]["provenance_url"], None)
+
+        resp = self.client.post('/item/' + tiid + '/provenance_urls')
+        assert_equals(resp.status_code, 200)
+        assert json.loads(resp.data)["metrics"]["dryad:package_views"]["provenance_url"]
+
+        # and they're saved
+        resp = self.client.get('/item/' + tiid)
+        item_dict = json.loads(resp.data)
+        assert item_dict["metrics"]["dryad:package_views"]["provenance_url"]
+
+    def test_item_provenance_urls_post_unknown_tiid(self):
+        resp = self.client.post('/item/' + str(uuid.uuid4()) + '/provenance_urls')
+        assert_equals(resp.status_code, 404)
+
+    def test_item_get_etag(self):
+        resp = self.client.post('/item/doi/' + quote_plus(TEST_DRYAD_DOI))
+        tiid = json.loads(resp.data)
+
+        resp = self.client.get('/item/' + tiid)
+        etag = resp.headers["ETag"]
+        assert etag
+
+        resp = self.client.get('/item/' + tiid, headers={"If-None-Match": etag})
+        assert_equals(resp.status_code, 304)
+        assert_equals(resp.data, "")
+        assert_equals(resp.headers["ETag"], etag)
+
+        # a different format is a different representation
+        resp = self.client.get('/item/' + tiid + '.html', headers={"If-None-Match": etag})
+        assert_equals(resp.status_code, 200)
+
+    def test_item_get_etag_changes_on_save(self):
+        resp = self.client.post('/item/doi/' + quote_plus(TEST_DRYAD_DOI))
+        tiid = json.loads(resp.data)
+        etag = self.client.get('/item/' + tiid).headers["ETag"]
+
+        self.client.post('/item/' + tiid + '/provenance_urls')
+
+        resp = self.client.get('/item/' + tiid, headers={"If-None-Match": etag})
+        assert_equals(resp.status_code, 200)
+        assert resp.headers["ETag"] != etag
+
+    def test_item_get_long_poll_times_out(self):
+        resp = self.client.post('/item/doi/' + quote_plus(TEST_DRYAD_DOI))
+        tiid = json.loads(resp.data)
+        etag = self.client.get('/item/' + tiid).headers["ETag"]
+
+        resp = self.client.get('/item/' + tiid + '?wait=0.1',
+            headers={"If-None-Match": etag})
+        assert_equals(resp.status_code, 304)
+
+    def test_item_get_long_poll_stale_etag(self):
+        resp = self.client.post('/item/doi/' + quote_plus(TEST_DRYAD_DOI))
+        tiid = json.loads(resp.data)
+
+        # we don't wait if the client's version is already out of date
+        resp = self.client.get('/item/' + tiid + '?wait=60',
+            headers={"If-None-Match": 'w/"1-old"'})
+        assert_equals(resp.status_code, 200)
+
+    def test_item_get_history(self):
+        resp = self.client.post('/item/doi/' + quote_plus(TEST_DRYAD_DOI))
+        tiid = json.loads(resp.data)
+        item = api.ItemFactory.get(self.d, tiid, self.app.config["PROVIDERS"])
+        for (ts, value) in [("100.0", 1), ("200.0", 2)]:
+            api.ItemFactory.add_metrics_snapshot(self.d, item, "dryad",
+                {"dryad:package_views": value}, ts)
+        item.save()
+
+        item_dict = json.loads(self.client.get('/item/' + tiid).data)
+        assert_equals(item_dict["metrics"]["dryad:package_views"]["values"], {"200.0": 2})
+
+        item_dict = json.loads(self.client.get('/item/' + tiid + '?history=true').data)
+        assert_equals(item_dict["metrics"]["dryad:package_views"]["values"],
+            {"100.0": 1, "200.0": 2})
+
+    def test_item_post_priority(self):
+        resp = self.client.post('/item/doi/AnIdOfSomeKind/?priority=bulk')
+        tiid = json.loads(resp.data)
+        saved_item = json.loads(self.client.get('/item/' + tiid).data)
+        assert_equals(saved_item["priority"], "bulk")
+
+        resp = self.client.post('/item/doi/AnotherId/?priority=urgent')
+        assert_equals(resp.status_code, 400)
+
     def test_item_post_unknown_namespace(self):
         response = self.client.post('/item/AnUnknownNamespace/AnIdOfSomeKind/')
         # cheerfully creates items whether we know their namespaces or not.
@@ -170,6 +383,32 @@ class TestItem(ApiTester):
         response = self.client.get('/item/' + ARTICLE_ITEM['id'])
         assert_equals(response.headers[0][1], 'application/json')
 
+    def test_item_get_compact(self):
+        print self.d.save(ARTICLE_ITEM)
+        pretty = self.client.get('/item/' + ARTICLE_ITEM['id'])
+        compact = self.client.get('/item/' + ARTICLE_ITEM['id'] + '?json=compact')
+        assert_equals(json.loads(compact.data), json.loads(pretty.data))
+        assert len(compact.data) < len(pretty.data)
+        assert "\n" not in compact.data
+
+        # the two styles are different representations, so get different etags
+        assert compact.headers["ETag"] != pretty.headers["ETag"]
+
+        by_accept = self.client.get('/item/' + ARTICLE_ITEM['id'],
+            headers={"Accept": "application/json; style=compact"})
+        assert_equals(by_accept.data, compact.data)
+
+    def test_item_get_gzip(self):
+        print self.d.save(ARTICLE_ITEM)
+        plain = self.client.get('/item/' + ARTICLE_ITEM['id'])
+        assert "Content-Encoding" not in plain.headers
+        assert_equals(plain.headers["Vary"], "Accept-Encoding")
+
+        gzipped = self.client.get('/item/' + ARTICLE_ITEM['id'],
+            headers={"Accept-Encoding": "gzip, deflate"})
+        assert_equals(gzipped.headers["Content-Encoding"], "gzip")
+        assert_equals(gzip.GzipFile(fileobj=StringIO(gzipped.data)).read(), plain.data)
+
     def test_returns_html_mimetype(self):
         print self.d.save(ARTICLE_ITEM) 
         response = self.client.get('item/{0}.html'.format(ARTICLE_ITEM['id']))
@@ -216,19 +455,102 @@ class TestItems(ApiTester):
             data=json.dumps(items),
             content_type="application/json"
         )
+        assert_equals(resp.status_code, 201)
         dois = []
-        for tiid in json.loads(resp.data):
-            doc = self.d.get(tiid)
+        for entry in json.loads(resp.data):
+            assert_equals(entry["status"], "created")
+            doc = self.d.get(entry["tiid"])
             dois.append(doc['aliases']['doi'][0])
 
+        # one entry per posted alias, in the order posted
         expected_dois = [i[1] for i in items]
-        assert_equals(set(expected_dois), set(dois))
+        assert_equals(expected_dois, dois)
+
+    def test_post_with_repeated_items(self):
+        items = [
+            ["doi", "10.123"],
+            ["doi", "10.124"],
+            ["doi", "10.123"]
+        ]
+        resp = self.client.post(
+            '/items',
+            data=json.dumps(items),
+            content_type="application/json"
+        )
+        entries = json.loads(resp.data)
+        assert_equals([entry["alias"] for entry in entries], items)
+        assert_equals(entries[0]["tiid"], entries[2]["tiid"])
+        assert entries[0]["tiid"] != entries[1]["tiid"]
+
+    def test_post_with_known_items(self):
+        items = [
+            ["doi", "10.123"],
+            ["doi", "10.124"]
+        ]
+        resp = self.client.post(
+            '/items',
+            data=json.dumps(items),
+            content_type="application/json"
+        )
+        assert_equals(resp.status_code, 201)
+        first_tiids = [entry["tiid"] for entry in json.loads(resp.data)]
+
+        # no new items made the second time around
+        items.append(["doi", "10.125"])
+        resp = self.client.post(
+            '/items',
+            data=json.dumps(items),
+            content_type="application/json"
+        )
+        assert_equals(resp.status_code, 201)
+        entries = json.loads(resp.data)
+        assert_equals([entry["tiid"] for entry in entries[:2]], first_tiids)
+        assert_equals([entry["status"] for entry in entries],
+            ["exists", "exists", "created"])
 
 
 
 
 
 
+    def test_get_items(self):
+        items = [
+            ["doi", "10.123"],
+            ["doi", "10.124"]
+        ]
+        resp = self.client.post(
+            '/items',
+            data=json.dumps(items),
+            content_type="application/json"
+        )
+        tiids = [entry["tiid"] for entry in json.loads(resp.data)]
+
+        resp = self.client.get('/items/' + ",".join(tiids))
+        assert_equals(resp.status_code, 200)
+        assert_equals(resp.mimetype, "application/json")
+        item_dicts = json.loads(resp.data)
+        assert_equals([item_dict["tiid"] for item_dict in item_dicts], tiids)
+        assert_equals([item_dict["aliases"]["doi"][0] for item_dict in item_dicts],
+            ["10.123", "10.124"])
+
+    def test_get_items_gzip(self):
+        resp = self.client.post('/item/doi/10.123')
+        tiid = json.loads(resp.data)
+
+        resp = self.client.get('/items/' + tiid + '?json=compact',
+            headers={"Accept-Encoding": "gzip"})
+        assert_equals(resp.headers["Content-Encoding"], "gzip")
+        item_dicts = json.loads(gzip.GzipFile(fileobj=StringIO(resp.data)).read())
+        assert_equals(item_dicts[0]["tiid"], tiid)
+
+    def test_get_items_with_unknown_tiid(self):
+        resp = self.client.post('/item/doi/10.123')
+        tiid = json.loads(resp.data)
+
+        resp = self.client.get('/items/' + tiid + "," + str(uuid.uuid4()))
+        assert_equals(resp.status_code, 404)
+
+
 class TestCollection(ApiTester):
 
     def test_collection_post_already_exists(self):
@@ -277,6 +599,23 @@ class TestCollection(ApiTester):
         assert_equals(response_loaded["item_tiids"],
             COLLECTION_SEED_MODIFIED["item_tiids"])
 
+    def test_collection_get_etag(self):
+        response = self.client.post('/collection',
+                data=json.dumps({"items": TEST_COLLECTION_TIID_LIST, "title":"My Title"}),
+                content_type="application/json")
+        cid = json.loads(response.data)["id"]
+
+        response = self.client.get('/collection/' + cid)
+        etag = response.headers["ETag"]
+        response = self.client.get('/collection/' + cid, headers={"If-None-Match": etag})
+        assert_equals(response.status_code, 304)
+
+        self.client.put('/collection/' + cid,
+                data=json.dumps(COLLECTION_SEED_MODIFIED),
+                content_type="application/json")
+        response = self.client.get('/collection/' + cid, headers={"If-None-Match": etag})
+        assert_equals(response.status_code, 200)
+
     def test_collection_put_empty_payload(self):
         response = self.client.put('/collection/' + TEST_COLLECTION_ID)
         assert_equals(response.status_code, 404)  #Not found
@@ -319,6 +658,16 @@ class TestApi(ApiTester):
         response2 = self.client.get('/collection/' + new_collection_id)
         assert_equals(response2.status_code, 404)  #Not found
         
+    def test_queues(self):
+        self.client.post('/item/doi/' + quote_plus(PLOS_TEST_DOI))
+
+        response = self.client.get('/queues')
+        assert_equals(response.status_code, 200)
+        report = json.loads(response.data)
+        assert_equals(report["queues"]["aliases"]["depth"], 1)
+        assert_equals(report["queues"]["aliases"]["lanes"]["interactive"]["depth"], 1)
+        assert_equals(report["backends"], [])
+
     def test_tiid_get_with_unknown_alias(self):
         # try to retrieve tiid id for something that doesn't exist yet
         plos_no_tiid_resp = self.client.get('/tiid/doi/' + 
@@ -342,7 +691,7 @@ class TestApi(ApiTester):
         assert_equals(plos_create_tiid, plos_lookup_tiids[0])
 
     def test_tiid_get_tiids_for_multiple_known_aliases(self):
-        # create two new items with the same plos alias
+        # try to create two new items with the same plos alias
         first_plos_create_tiid_resp = self.client.post('/item/doi/' + 
                 quote_plus(PLOS_TEST_DOI))
         first_plos_create_tiid = json.loads(first_plos_create_tiid_resp.data)
@@ -351,12 +700,28 @@ class TestApi(ApiTester):
                 quote_plus(PLOS_TEST_DOI))
         second_plos_create_tiid = json.loads(second_plos_create_tiid_resp.data)
 
+        # the second post reused the first item
+        assert_equals(first_plos_create_tiid, second_plos_create_tiid)
+
         # retrieve the plos tiid using tiid api
         plos_lookup_tiid_resp = self.client.get('/tiid/doi/' + 
                 quote_plus(PLOS_TEST_DOI))
         assert_equals(plos_lookup_tiid_resp.status_code, 303)  
         plos_lookup_tiids = json.loads(plos_lookup_tiid_resp.data)
 
-        # check that the tiid lists are the same
-        assert_equals(sorted(plos_lookup_tiids), 
-            sorted([first_plos_create_tiid, second_plos_create_tiid]))
+        # check that there's just the one tiid
+        assert_equals(plos_lookup_tiids, [first_plos_create_tiid])
+
+    def test_tiid_get_with_alias_index(self):
+        self.app.config["ALIAS_INDEX"]["enabled"] = True
+        try:
+            plos_create_tiid_resp = self.client.post('/item/doi/' + 
+                    quote_plus(PLOS_TEST_DOI))
+            plos_create_tiid = json.loads(plos_create_tiid_resp.data)
+
+            plos_lookup_tiid_resp = self.client.get('/tiid/doi/' + 
+                    quote_plus(PLOS_TEST_DOI))
+            assert_equals(plos_lookup_tiid_resp.status_code, 303)  
+            assert_equals(json.loads(plos_lookup_tiid_resp.data), [plos_create_tiid])
+        finally:
+            self.app.config["ALIAS_INDEX"]["enabled"] = False
@@ -1,10 +1,14 @@
-import os, unittest, time
-from nose.tools import nottest, assert_equals
+import os, sys, unittest, time, subprocess
+from nose.tools import nottest, assert_equals, assert_raises
+from nose.plugins.skip import SkipTest
 from test.utils import slow
 
 from totalimpact.backend import TotalImpactBackend, ProviderMetricsThread, ProvidersAliasThread, StoppableThread, QueueConsumer
+from totalimpact.backend import ChangesDispatcher, ProviderThread
+from totalimpact.backend import make_option_parser, check_gevent_patched
+from totalimpact.stats import BackendStats
 from totalimpact.providers.provider import Provider, ProviderFactory
-from totalimpact.queue import Queue, AliasQueue, MetricsQueue
+from totalimpact.queue import Queue, AliasQueue, MetricsQueue, ReadyItems
 from totalimpact import dao, api
 from totalimpact.tilogging import logging
 
@@ -17,7 +21,7 @@ from totalimpact.providers.provider import ProviderConfigurationError, ProviderT
 from totalimpact.providers.provider import ProviderClientError, ProviderServerError, ProviderContentMalformedError
 from totalimpact.providers.provider import ProviderValidationFailedError, ProviderRateLimitError
 
-from test.mocks import ProviderMock, QueueMock, ItemMock
+from test.mocks import ProviderMock, QueueMock, ItemMock, MockDao
 
 def slow(f):
     f.slow = True
@@ -416,3 +420,222 @@ class TestBackend(unittest.TestCase):
         ## self.assertEqual(set(ns_list),set(['mock','doi']))
 
 
+
+
+class BatchQueue(object):
+    ''' Hands out one batch of items, and records what happens to them '''
+
+    def __init__(self, items, on_dequeue=None):
+        self.items = dict([(item.id, item) for item in items])
+        self.ids = [item.id for item in items]
+        self.on_dequeue = on_dequeue
+        # more_urgent_waiting says yes once this many items have been saved
+        self.urgent_after = None
+        self.loads = []
+        self.saved = []
+        self.unqueued = []
+        self.released = []
+        self.renewed = []
+        # the ids renew says we've lost the claims on
+        self.lost = []
+
+    def dequeue_batch(self, n):
+        if self.on_dequeue:
+            self.on_dequeue()
+        (batch, self.ids) = (self.ids[:n], self.ids[n:])
+        self.loads.append(batch)
+        return ("bulk", [self.items[id] for id in batch if id in self.items])
+
+    def more_urgent_waiting(self, lane):
+        return self.urgent_after is not None and len(self.saved) >= self.urgent_after
+
+    def release(self, item_ids, lane):
+        self.released += item_ids
+
+    def renew(self, item_ids):
+        self.renewed.append(item_ids)
+        return [item_id for item_id in item_ids if item_id in self.lost]
+
+    def save_and_unqueue(self, item):
+        self.saved.append(item.id)
+
+    def unqueue(self, item_id):
+        self.unqueued.append(item_id)
+
+
+class RecordingThread(ProviderThread):
+
+    def __init__(self, queue):
+        ProviderThread.__init__(self, None, queue)
+        self.processed = []
+
+    def process_item(self, item):
+        self.processed.append(item.id)
+
+
+class TestProviderThreadBatches(unittest.TestCase):
+
+    def test_processes_batch(self):
+        queue = BatchQueue([ItemMock(str(i)) for i in range(5)])
+        thread = RecordingThread(queue)
+        thread.batch_size = 3
+
+        thread.run(run_only_once=True)
+        assert_equals(thread.processed, ["0", "1", "2"])
+        assert_equals(queue.saved, ["0", "1", "2"])
+        # the batch was loaded all at once
+        assert_equals(queue.loads, [["0", "1", "2"]])
+
+    def test_skips_deleted_items(self):
+        queue = BatchQueue([ItemMock(str(i)) for i in range(3)])
+        del queue.items["1"]
+        thread = RecordingThread(queue)
+        thread.batch_size = 3
+
+        thread.run(run_only_once=True)
+        assert_equals(thread.processed, ["0", "2"])
+
+    def test_gives_back_batch_for_urgent_items(self):
+        queue = BatchQueue([ItemMock(str(i)) for i in range(3)])
+        queue.urgent_after = 1
+        thread = RecordingThread(queue)
+        thread.batch_size = 3
+
+        thread.run(run_only_once=True)
+        assert_equals(thread.processed, ["0"])
+        assert_equals(queue.released, ["1", "2"])
+
+    def test_counts_dequeued(self):
+        queue = BatchQueue([ItemMock(str(i)) for i in range(5)])
+        queue.queue_name = "aliases"
+        thread = RecordingThread(queue)
+        thread.batch_size = 3
+        thread.stats = BackendStats("host:1")
+
+        thread.run(run_only_once=True)
+        assert_equals(thread.stats.dequeued, {"aliases": 3})
+
+    def test_counts_provider_calls(self):
+        provider = ProviderMock(metrics_exceptions={1: [ProviderHttpError]})
+        provider.get_sleep_time = lambda error_type, count: 0
+        item = ItemMock(1)
+        item.aliases.add_alias("mock", "1")
+        thread = RecordingThread(BatchQueue([]))
+        thread.stats = BackendStats("host:1")
+
+        (success, response) = thread.process_item_for_provider(item, provider, 'metrics')
+        assert_equals(success, True)
+        counts = thread.stats.providers[provider.provider_name]["metrics"]
+        assert_equals(counts["success"], 1)
+        assert_equals(counts["errors"], {"http_error": 1})
+        assert_equals(counts["latency"]["count"], 2)
+
+    def test_renews_claims_between_items(self):
+        queue = BatchQueue([ItemMock(str(i)) for i in range(4)])
+        queue.lost = ["2"]
+        thread = RecordingThread(queue)
+        thread.batch_size = 4
+
+        thread.run(run_only_once=True)
+        assert_equals(queue.renewed, [["1", "2", "3"], ["3"]])
+        # someone else has 2 now
+        assert_equals(thread.processed, ["0", "1", "3"])
+
+    def test_stopping_releases_batch(self):
+        queue = BatchQueue([ItemMock(str(i)) for i in range(3)])
+        thread = RecordingThread(queue)
+        thread.batch_size = 3
+        # stop after the batch is claimed, before any are worked on
+        queue.on_dequeue = thread.stop
+
+        thread.run(run_only_once=True)
+        assert_equals(thread.processed, [])
+        assert_equals(queue.released, ["0", "1", "2"])
+
+
+class TestChangesDispatcher(unittest.TestCase):
+
+    def test_offer_deferred(self):
+        d = MockDao([
+            {"id": "123", "last_requested": 200.0, "aliases": {"last_completed": 100.0}},
+            {"id": "456", "last_requested": 200.0, "aliases": {"last_completed": 300.0}}
+            ])
+        ready = ReadyItems([])
+        dispatcher = ChangesDispatcher(d, ready, 10)
+
+        for item_id in ["123", "456", "789"]:
+            ready.defer("aliases", item_id, 0)
+        # 456 has been done since, and 789 deleted
+        assert_equals(dispatcher.offer_deferred(), 1)
+        assert_equals(ready.get("aliases", 0), "123")
+        assert_equals(ready.deferred, {})
+
+    def test_load_backlog(self):
+        d = MockDao(view_rows={
+            "queues/aliases": [{"id": "123", "key": [0, 100.0]}],
+            "queues/metrics": [{"id": "456", "key": ["dryad", 1, 100.0, None]}]
+            })
+        ready = ReadyItems(["dryad"])
+        dispatcher = ChangesDispatcher(d, ready, 10)
+
+        assert_equals(dispatcher.load_backlog(), 5)
+        assert_equals(ready.qsize("aliases", "interactive"), 1)
+        assert_equals(ready.qsize("dryad", "bulk"), 1)
+        assert_equals(ready.get("aliases", 0), "123")
+        assert_equals(ready.get("dryad", 0), "456")
+
+    def test_dispatch_changes(self):
+        changed = [
+            {"_id": "123", "last_requested": 200.0, "aliases": {}},
+            {"_id": "456", "last_requested": 200.0, "aliases": {"last_completed": 300.0}},
+            {"_id": "789", "_deleted": True, "last_requested": 200.0, "aliases": {}}
+            ]
+        ready = ReadyItems(["dryad"])
+        dispatcher = ChangesDispatcher(MockDao(changes=changed), ready, 10)
+        dispatcher.since = 5
+
+        assert_equals(dispatcher.dispatch_changes(), 1)
+        assert_equals(dispatcher.since, 8)
+        assert_equals(ready.get("aliases", 0), "123")
+
+    def test_reloads_backlog(self):
+        d = MockDao()
+        dispatcher = ChangesDispatcher(d, ReadyItems([]), 10, reload_interval=60)
+        assert_equals(dispatcher.backlog_due(), True)
+
+        dispatcher.since = dispatcher.load_backlog()
+        assert_equals(dispatcher.backlog_due(), False)
+        dispatcher.loaded -= 61
+        assert_equals(dispatcher.backlog_due(), True)
+
+
+class TestGevent(unittest.TestCase):
+
+    def test_gevent_options(self):
+        for argv in [["-g"], ["--gevent"], ["-dg"], ["-l", "x.log", "-g"]]:
+            (options, args) = make_option_parser().parse_args(argv)
+            assert_equals(options.gevent, True)
+        assert_equals(make_option_parser().parse_args(["-d"])[0].gevent, False)
+
+    def test_gevent_patching(self):
+        try:
+            import gevent.monkey
+        except ImportError:
+            raise SkipTest("gevent isn't installed")
+
+        # nothing has patched this process, so main would refuse to run
+        assert_raises(RuntimeError, check_gevent_patched)
+
+        # patch a new process the way backend.py does
+        code = "; ".join([
+            "import sys",
+            "from totalimpact import backend",
+            "(options, args) = backend.make_option_parser().parse_args(sys.argv[1:])",
+            "backend.patch_for_gevent(options)",
+            "backend.check_gevent_patched()"
+            ])
+        rootdir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        assert_equals(subprocess.call([sys.executable, "-c", code, "-dg"], cwd=rootdir), 0)
+        # without -g, nothing's patched and main would refuse to run
+        assert subprocess.call([sys.executable, "-c", code, "-d"], cwd=rootdir,
+            stderr=open(os.devnull, "w")) != 0
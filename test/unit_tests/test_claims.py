@@ -0,0 +1,102 @@
+import unittest, time
+from copy import deepcopy
+from nose.tools import assert_equals
+
+from totalimpact import default_settings
+from totalimpact.claims import LocalClaims, CouchClaims, make_claims
+from test.mocks import MockDao
+
+
+class TestLocalClaims(unittest.TestCase):
+
+    def test_claim_and_release(self):
+        claims = LocalClaims(60)
+        assert_equals(claims.claim("aliases", "123"), True)
+        assert_equals(claims.claim("aliases", "123"), False)
+        assert_equals(claims.claim("dryad", "123"), True)
+
+        claims.release("aliases", "123")
+        assert_equals(claims.claim("aliases", "123"), True)
+
+    def test_renew(self):
+        claims = LocalClaims(60)
+        claims.claim("aliases", "123")
+        claims.expires[("aliases", "123")] = time.time() + 1
+        assert_equals(claims.renew("aliases", "123"), True)
+        assert claims.expires[("aliases", "123")] > time.time() + 30
+
+    def test_claim_expires(self):
+        claims = LocalClaims(-1)
+        assert_equals(claims.claim("aliases", "123"), True)
+        assert_equals(claims.claim("aliases", "123"), True)
+
+
+class TestCouchClaims(unittest.TestCase):
+
+    def setUp(self):
+        self.d = MockDao()
+
+    def test_claim_and_release(self):
+        mine = CouchClaims(self.d, "host1:1", 60)
+        theirs = CouchClaims(self.d, "host2:1", 60)
+
+        assert_equals(mine.claim("aliases", "123"), True)
+        assert_equals(theirs.claim("aliases", "123"), False)
+        assert_equals(self.d.docs["claim:aliases:123"]["owner"], "host1:1")
+
+        mine.release("aliases", "123")
+        assert_equals(self.d.docs, {})
+        assert_equals(theirs.claim("aliases", "123"), True)
+
+    def test_takes_over_expired_claim(self):
+        crashed = CouchClaims(self.d, "host1:1", -1)
+        theirs = CouchClaims(self.d, "host2:1", 60)
+
+        assert_equals(crashed.claim("aliases", "123"), True)
+        assert_equals(theirs.claim("aliases", "123"), True)
+        assert_equals(self.d.docs["claim:aliases:123"]["owner"], "host2:1")
+
+        # the crashed worker's release doesn't drop the new claim
+        crashed.release("aliases", "123")
+        assert_equals(self.d.docs["claim:aliases:123"]["owner"], "host2:1")
+
+    def test_claims_held_here_not_asked_for_again(self):
+        claims = CouchClaims(self.d, "host1:1", 60)
+        assert_equals(claims.claim("aliases", "123"), True)
+        assert_equals(claims.claim("aliases", "123"), False)
+        assert_equals(self.d.calls, ["save"])
+
+    def test_renew(self):
+        claims = CouchClaims(self.d, "host1:1", 60)
+        claims.claim("aliases", "123")
+        expires = self.d.docs["claim:aliases:123"]["expires"]
+
+        # not rewritten while most of the lease is left
+        assert_equals(claims.renew("aliases", "123"), True)
+        assert_equals(self.d.calls, ["save"])
+
+        # but is once half of it's gone
+        claims.held[("aliases", "123")] = (self.d.docs["claim:aliases:123"]["_rev"], time.time() + 20)
+        assert_equals(claims.renew("aliases", "123"), True)
+        assert self.d.docs["claim:aliases:123"]["expires"] >= expires
+        assert_equals(self.d.docs["claim:aliases:123"]["_rev"], "2")
+
+        # and can still be released
+        claims.release("aliases", "123")
+        assert_equals(self.d.docs, {})
+
+    def test_renew_lost_claim(self):
+        slow = CouchClaims(self.d, "host1:1", -1)
+        theirs = CouchClaims(self.d, "host2:1", 60)
+        slow.claim("aliases", "123")
+        theirs.claim("aliases", "123")
+
+        assert_equals(slow.renew("aliases", "123"), False)
+        assert_equals(self.d.docs["claim:aliases:123"]["owner"], "host2:1")
+        assert_equals(slow.renew("aliases", "123"), False)
+
+    def test_make_claims(self):
+        config = deepcopy(default_settings.QUEUE_CLAIMS)
+        assert isinstance(make_claims(self.d, config), CouchClaims)
+        config["store"] = "local"
+        assert isinstance(make_claims(self.d, config), LocalClaims)
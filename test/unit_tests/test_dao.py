@@ -25,7 +25,11 @@ class TestDAO(unittest.TestCase):
         self.d.create_db(TEST_DB_NAME)
         design_doc = self.d.db.get("_design/queues")
         assert_equals(set(design_doc["views"].keys()), 
-            set([u'metrics', u'by_alias', u'aliases']))
+            set([u'metrics', u'by_alias', u'aliases', u'snapshots', u'refresh', u'legacy_items',
+                u'aliases_depth', u'metrics_depth']))
+        assert_equals(design_doc["views"]["aliases_depth"]["map"],
+            design_doc["views"]["aliases"]["map"])
+        assert_equals(design_doc["views"]["aliases_depth"]["reduce"], "_count")
 
     def test_db_exists(self):
         self.d.create_db(TEST_DB_NAME)
@@ -65,6 +69,74 @@ class TestDAO(unittest.TestCase):
         assert_equals(del_worked, True)
         assert_equals(self.d.get(id), None)
 
+    def test_bulk_save(self):
+        self.d.create_db(TEST_DB_NAME)
+        self.d.connect_db(TEST_DB_NAME)
+        docs = [{"id": str(i)} for i in range(5)]
+
+        ret = self.d.bulk_save(docs, chunk_size=2)
+        assert_equals([id for (success, id, rev) in ret], ["0", "1", "2", "3", "4"])
+        assert_equals([success for (success, id, rev) in ret], [True] * 5)
+        assert_equals(self.d.get("3")["id"], "3")
+
+    def test_view_with_keys(self):
+        self.d.create_db(TEST_DB_NAME)
+        self.d.connect_db(TEST_DB_NAME)
+        self.d.save({"id": "123", "aliases": {"doi": ["10.1/a"]}})
+        self.d.save({"id": "456", "aliases": {"doi": ["10.1/b"]}})
+
+        res = self.d.view('queues/by_alias', keys=[["doi", "10.1/b"]])
+        assert_equals([row["id"] for row in res["rows"]], ["456"])
+
+    def test_get_rev(self):
+        self.d.create_db(TEST_DB_NAME)
+        self.d.connect_db(TEST_DB_NAME)
+        (id, rev) = self.d.save({"id": "123"})
+        assert_equals(self.d.get_rev("123"), rev)
+        assert_equals(self.d.get_rev("unknown"), None)
+
+    def test_wait_for_change(self):
+        self.d.create_db(TEST_DB_NAME)
+        self.d.connect_db(TEST_DB_NAME)
+        self.d.save({"id": "123"})
+        since = self.d.get_update_seq()
+
+        # nothing has changed since, so this times out
+        assert_equals(self.d.wait_for_change("123", since, 0.1), False)
+
+        # changes to other docs don't count
+        self.d.save({"id": "456"})
+        assert_equals(self.d.wait_for_change("123", since, 0.1), False)
+
+        self.d.save(self.d.get("123"))
+        assert_equals(self.d.wait_for_change("123", since, 10), True)
+
+    def test_changes(self):
+        self.d.create_db(TEST_DB_NAME)
+        self.d.connect_db(TEST_DB_NAME)
+        since = self.d.get_update_seq()
+
+        # nothing has changed since, so this times out
+        assert_equals(self.d.changes(since, 0.1)[0], [])
+
+        self.d.save({"id": "123", "aliases": {}})
+        self.d.save({"id": "snapshot:123", "values": {}})
+        (docs, last_seq) = self.d.changes(since, 10, filter="queues/items")
+        assert_equals([doc["_id"] for doc in docs], ["123"])
+        assert_equals(self.d.changes(last_seq, 0.1)[0], [])
+
+    def test_update_views(self):
+        self.d.create_db(TEST_DB_NAME)
+        self.d.connect_db(TEST_DB_NAME)
+        assert_equals(self.d.update_views(), False)
+
+        design_doc = self.d.get("_design/queues")
+        del design_doc["views"]["snapshots"]
+        self.d.db.save(design_doc)
+
+        assert_equals(self.d.update_views(), True)
+        assert "snapshots" in self.d.get("_design/queues")["views"]
+
     def test_create_new_db_and_connect(self):
        self.d.create_db(TEST_DB_NAME)
        self.d.connect_db(TEST_DB_NAME)
@@ -0,0 +1,61 @@
+import unittest, time
+from nose.tools import assert_equals
+
+from totalimpact.itemviews import ViewRecorder, view_doc, last_viewed_times
+from test.mocks import MockDao
+
+NOW = 1330000000.0
+
+
+class TestViewRecorder(unittest.TestCase):
+
+    def setUp(self):
+        self.d = MockDao([
+            view_doc("1", NOW - 7200),
+            view_doc("2", NOW - 100),
+            {"id": "3", "aliases": {}}
+            ])
+        self.recorder = ViewRecorder(self.d, 3600, flush_interval=60)
+
+    def test_record_doesnt_write(self):
+        self.recorder.record(["1", "2", "3"], NOW)
+        assert_equals(self.d.calls, [])
+        assert_equals(self.recorder.pending, {"1": NOW, "2": NOW, "3": NOW})
+
+    def test_flush(self):
+        self.recorder.record(["1", "2", "3"], NOW)
+        assert_equals(self.recorder.flush(), 2)
+
+        # the view doc written recently isn't written again, and the item
+        # itself isn't touched
+        assert_equals(self.d.docs["view:1"]["last_viewed"], NOW)
+        assert_equals(self.d.docs["view:2"]["last_viewed"], NOW - 100)
+        assert_equals(self.d.docs["view:3"]["last_viewed"], NOW)
+        assert_equals(self.d.docs["3"], {"id": "3", "_id": "3", "_rev": "1", "aliases": {}})
+        assert_equals(self.recorder.pending, {})
+        assert_equals(self.recorder.flush(), 0)
+
+    def test_flushes_in_background(self):
+        self.recorder.flush_interval = 0.01
+        self.recorder.start()
+        self.recorder.record(["3"], NOW)
+        for i in range(500):
+            if "view:3" in self.d.docs:
+                break
+            time.sleep(0.01)
+        assert_equals(self.d.docs["view:3"]["last_viewed"], NOW)
+
+        self.recorder.stop()
+        assert_equals(self.recorder.flusher.is_alive(), False)
+
+    def test_stop_flushes(self):
+        self.recorder.start()
+        self.recorder.record(["3"], NOW)
+        assert "view:3" not in self.d.docs
+
+        # as happens when the process exits
+        self.recorder.stop()
+        assert_equals(self.d.docs["view:3"]["last_viewed"], NOW)
+
+    def test_last_viewed_times(self):
+        assert_equals(last_viewed_times(self.d, 1), {"1": NOW - 7200, "2": NOW - 100})
@@ -1,5 +1,6 @@
-from nose.tools import raises, assert_equals, nottest
-import os, unittest, json, time
+from nose.tools import raises, assert_equals, assert_raises, nottest
+import os, unittest, json, time, pickle
+import couchdb
 from test.mocks import MockDao
 from copy import deepcopy
 
@@ -118,6 +119,26 @@ ITEM_DATA = {
 TEST_DB_NAME = "test_models"
 
 
+def snapshot_rows(docs):
+    ''' Makes the rows of the snapshots view from the snapshot docs '''
+    return [{"id": doc["_id"], "key": [doc["tiid"], metric_name, doc["ts"]], "value": value}
+        for doc in docs.values() if doc.get("type") == "metric_snapshot"
+        for (metric_name, value) in doc["values"].iteritems()]
+
+
+class TestGlobalItemLock():
+
+    def test_same_lock_for_same_item(self):
+        locks = models.GlobalItemLock(stripes=16)
+        assert locks.getItemLock("123") is locks.getItemLock("123")
+
+    def test_number_of_locks_is_bounded(self):
+        locks = models.GlobalItemLock(stripes=16)
+        item_locks = set([id(locks.getItemLock(str(i))) for i in range(1000)])
+        assert_equals(len(locks.stripes), 16)
+        assert len(item_locks) <= 16
+
+
 class TestSaveable():
     def setUp(self):
         pass
@@ -148,6 +169,74 @@ class TestSaveable():
 
         assert_equals(s.as_dict()['constituent_dict']['foo_obj']['bar'], foo.bar)
 
+    def test_save_new(self):
+        dao = MockDao()
+        s = models.Saveable(dao=dao, id="123")
+        s.foo = "a var"
+        assert_equals(s.save(), ("123", "1"))
+
+        # a new object is written without reading from the db first
+        assert_equals(dao.calls, ["save"])
+        assert_equals(s._rev, "1")
+
+        # and saving again uses the _rev from the last save
+        s.foo = "changed"
+        s.save()
+        assert_equals(dao.calls, ["save", "save"])
+        assert_equals(dao.docs["123"]["foo"], "changed")
+
+    def test_save_with_current_rev(self):
+        dao = MockDao([{"id": "123", "_rev": "3", "foo": "a var", "bar": ["x"]}])
+        s = models.Saveable(dao=dao, id="123")
+        s._rev = "3"
+        s.foo = "changed"
+        s.bar = []
+        s.save()
+
+        assert_equals(dao.calls, ["save"])
+        assert_equals(dao.docs["123"]["_rev"], "4")
+        # without a conflict there's no merge, so things we removed stay removed
+        assert_equals(dao.docs["123"]["bar"], [])
+
+    def test_save_merges_on_conflict(self):
+        dao = MockDao([{"id": "123", "_rev": "5", "foo": "a var", "vals": {"a": 1}}])
+        s = models.Saveable(dao=dao, id="123")
+        s._rev = "3"
+        s.foo = "changed"
+        s.vals = {"b": 2}
+        s.save()
+
+        assert_equals(dao.calls, ["save", "get", "save"])
+        assert_equals(dao.docs["123"]["foo"], "changed")
+        assert_equals(dao.docs["123"]["vals"], {"a": 1, "b": 2})
+        assert_equals(s._rev, "6")
+
+    @raises(couchdb.ResourceConflict)
+    def test_save_gives_up_after_retries(self):
+        class AlwaysConflictingDao(MockDao):
+            def save_and_commit(self, doc):
+                self.calls.append("save")
+                raise couchdb.ResourceConflict("conflict")
+
+        dao = AlwaysConflictingDao([{"id": "123", "_rev": "5"}])
+        s = models.Saveable(dao=dao, id="123")
+        try:
+            s.save()
+        finally:
+            assert_equals(dao.calls.count("save"), s.save_retries + 1)
+
+    def test_as_dict_doc_fields(self):
+        class Thing(models.Saveable):
+            doc_fields = {"id": None, "name": None, "size": lambda size: size * 2}
+
+        s = Thing(dao="dao", id="123")
+        s.name = "a name"
+        s.size = 2
+        s.other = ("not", "in", "doc_fields")
+        s._private = "not saved"
+        assert_equals(s.as_dict(),
+            {"id": "123", "name": "a name", "size": 4, "other": ["not", "in", "doc_fields"]})
+
     def test__update_dict(self):
         '''Test that items can update their values from an input dict.
 
@@ -223,7 +312,6 @@ class TestItemFactory():
         item = models.ItemFactory.get(
             self.d,
             "123",
-            provider.ProviderFactory.get_provider,
             default_settings.PROVIDERS)
         
         assert_equals(item.id, ITEM_DATA['_id'])
@@ -231,6 +319,63 @@ class TestItemFactory():
         assert_equals(item.as_dict()["aliases"], ITEM_DATA["aliases"])
 
         
+    @raises(LookupError)
+    def test_get_nonexistant_item_fails(self):
+        self.d.setResponses([None])
+        item = models.ItemFactory.get(
+            self.d,
+            "123",
+            default_settings.PROVIDERS)
+
+    def test_get_many(self):
+        item_data2 = deepcopy(ITEM_DATA)
+        item_data2["_id"] = "789"
+        self.d.setResponses([deepcopy(ITEM_DATA), item_data2])
+        items = models.ItemFactory.get_many(
+            self.d,
+            ["123", "789"],
+            default_settings.PROVIDERS)
+
+        assert_equals([item.id for item in items], ["123", "789"])
+        assert_equals(items[1].aliases.__class__.__name__, "Aliases")
+
+    def test_get_with_fields(self):
+        self.d.setResponses([deepcopy(ITEM_DATA)])
+        item = models.ItemFactory.get(
+            self.d,
+            "123",
+            default_settings.PROVIDERS,
+            fields=["aliases", "metrics:dryad"])
+
+        assert_equals(item.aliases.__class__.__name__, "Aliases")
+        # only the dryad metrics are made from the config...
+        assert_equals(item.metrics["dryad:package_views"]['values'], {})
+        # ...the rest are left as they are in the doc
+        assert_equals(item.metrics["wikipedia:mentions"], METRICS_DATA)
+        assert_equals(item.metrics["bar:views"], METRICS_DATA2)
+
+    def test_get_with_no_fields_saves_whole_doc(self):
+        self.d.setResponses([deepcopy(ITEM_DATA)])
+        item = models.ItemFactory.get(
+            self.d,
+            "123",
+            default_settings.PROVIDERS,
+            fields=[])
+
+        # aliases stay a dict, and the metrics aren't touched
+        assert_equals(item.aliases, ITEM_DATA["aliases"])
+        item_dict = item.as_dict()
+        for key in ["aliases", "metrics", "biblio"]:
+            assert_equals(item_dict[key], ITEM_DATA[key])
+
+    @raises(LookupError)
+    def test_get_many_with_missing_item_fails(self):
+        self.d.setResponses([deepcopy(ITEM_DATA), None])
+        items = models.ItemFactory.get_many(
+            self.d,
+            ["123", "789"],
+            default_settings.PROVIDERS)
+
     def test_get_creates_metrics(self):
         item_data = deepcopy(ITEM_DATA)
         item_data2 = deepcopy(ITEM_DATA)
@@ -240,7 +385,6 @@ class TestItemFactory():
         item = models.ItemFactory.get(
             self.d,
             "123",
-            provider.ProviderFactory.get_provider,
             default_settings.PROVIDERS)
 
         assert_equals(item.metrics["wikipedia:mentions"]['values'][KEY1], VAL1)
@@ -249,7 +393,6 @@ class TestItemFactory():
         item2 = models.ItemFactory.get(
             self.d,
             "123",
-            provider.ProviderFactory.get_provider,
             default_settings.PROVIDERS)
         print item2.metrics
         assert_equals(item2.metrics["dryad:package_views"]['values'], {})
@@ -259,24 +402,118 @@ class TestItemFactory():
         item = models.ItemFactory.get(
             self.d,
             "123",
-            provider.ProviderFactory.get_provider,
             default_settings.PROVIDERS)
 
         expected = {'category': 'NA', 'provider_url': 'http://www.wikipedia.org/', 'display_name': 'mentions', 'description': 'Wikipedia is the free encyclopedia that anyone can edit.', 'provider': 'Wikipedia', 'other_terms_of_use': 'NA', 'can_embed': 'NA', 'can_use_commercially': 'NA', 'can_aggregate': 'NA', 'icon': 'http://wikipedia.org/favicon.ico'}
         assert_equals(item.metrics["wikipedia:mentions"]["static_meta"], expected)
 
-    def test_adds_provenance_url(self):
+    def test_get_uses_stored_provenance_url(self):
+        self.d.setResponses([deepcopy(ITEM_DATA)])
+        item = models.ItemFactory.get(
+            self.d,
+            "123",
+            default_settings.PROVIDERS)
+
+        assert_equals(item.metrics["wikipedia:mentions"]["provenance_url"],
+            METRICS_DATA["provenance_url"])
+
+        # metrics with no stored provenance url get None, and no static_meta
+        assert_equals(item.metrics["dryad:package_views"]["provenance_url"], None)
+        assert_equals(item.metrics["dryad:package_views"]["static_meta"], {})
+
+    def test_update_provenance_urls(self):
         self.d.setResponses([deepcopy(ITEM_DATA)])
         item = models.ItemFactory.get(
             self.d,
             "123",
-            provider.ProviderFactory.get_provider,
             default_settings.PROVIDERS)
+        providers = [provider.ProviderFactory.get_provider("wikipedia")]
+        models.ItemFactory.update_provenance_urls(item, providers)
 
         print item.metrics
         
         assert_equals(item.metrics["wikipedia:mentions"]["provenance_url"],
             "http://en.wikipedia.org/wiki/Special:Search?search='10.1371/journal.pmed.0020124'&go=Go")
+        # metrics of providers we weren't given are left alone
+        assert_equals(item.metrics["dryad:package_views"]["provenance_url"], None)
+
+    def test_update_provenance_urls_provider_error(self):
+        self.d.setResponses([deepcopy(ITEM_DATA)])
+        item = models.ItemFactory.get(
+            self.d,
+            "123",
+            default_settings.PROVIDERS)
+        # a new instance, as we don't want to break the shared one
+        wikipedia = provider.ProviderFactory.load_provider("wikipedia")
+        def provenance_url_error(metric_name, aliases):
+            raise provider.ProviderTimeout()
+        wikipedia.provenance_url = provenance_url_error
+
+        models.ItemFactory.update_provenance_urls(item, [wikipedia])
+        assert_equals(item.metrics["wikipedia:mentions"]["provenance_url"], None)
+
+    def test_add_metrics_snapshot(self):
+        snapshot_dao = MockDao(view_rows={"queues/snapshots": snapshot_rows})
+        item = models.ItemFactory.make(snapshot_dao, default_settings.PROVIDERS)
+        models.ItemFactory.add_metrics_snapshot(snapshot_dao, item, "dryad",
+            {"dryad:package_views": 3, "dryad:total_downloads": 1}, "100.0")
+        models.ItemFactory.add_metrics_snapshot(snapshot_dao, item, "dryad",
+            {"dryad:package_views": 5, "dryad:total_downloads": 2}, "200.0")
+
+        # the item only keeps the latest values
+        assert_equals(item.metrics["dryad:package_views"]["values"], {"200.0": 5})
+        assert_equals(item.metrics["dryad:total_downloads"]["values"], {"200.0": 2})
+
+        # and each refresh is a snapshot doc
+        assert_equals(sorted(snapshot_dao.docs.keys()), [
+            "snapshot:%s:dryad:100.0" % item.id,
+            "snapshot:%s:dryad:200.0" % item.id])
+        assert_equals(snapshot_dao.docs["snapshot:%s:dryad:200.0" % item.id]["values"],
+            {"dryad:package_views": 5, "dryad:total_downloads": 2})
+
+    def test_add_metrics_snapshot_moves_old_values(self):
+        snapshot_dao = MockDao(view_rows={"queues/snapshots": snapshot_rows})
+        item = models.ItemFactory.make(snapshot_dao, default_settings.PROVIDERS)
+        item.metrics["wikipedia:mentions"]["values"] = {"100.0": 1, "200.0": 2}
+
+        models.ItemFactory.add_metrics_snapshot(snapshot_dao, item, "wikipedia",
+            {"wikipedia:mentions": 3}, "300.0")
+
+        assert_equals(item.metrics["wikipedia:mentions"]["values"], {"300.0": 3})
+        assert_equals(models.ItemFactory.get_metrics_history(snapshot_dao, item.id),
+            {"wikipedia:mentions": {"100.0": 1, "200.0": 2, "300.0": 3}})
+
+    def test_get_metrics_history_pages(self):
+        snapshot_dao = MockDao(view_rows={"queues/snapshots": snapshot_rows})
+        item = models.ItemFactory.make(snapshot_dao, default_settings.PROVIDERS)
+        other = models.ItemFactory.make(snapshot_dao, default_settings.PROVIDERS)
+        for ts in ["100.0", "200.0", "300.0", "400.0", "500.0"]:
+            for it in [item, other]:
+                models.ItemFactory.add_metrics_snapshot(snapshot_dao, it, "wikipedia",
+                    {"wikipedia:mentions": int(float(ts))}, ts)
+
+        snapshot_dao.calls = []
+        old_page_size = models.ItemFactory.history_page_size
+        models.ItemFactory.history_page_size = 2
+        try:
+            history = models.ItemFactory.get_metrics_history(snapshot_dao, item.id)
+        finally:
+            models.ItemFactory.history_page_size = old_page_size
+
+        assert_equals(history, {"wikipedia:mentions":
+            {"100.0": 100, "200.0": 200, "300.0": 300, "400.0": 400, "500.0": 500}})
+        assert_equals(snapshot_dao.calls.count("view"), 3)
+
+    def test_add_metrics_snapshot_last_changed(self):
+        snapshot_dao = MockDao(view_rows={"queues/snapshots": snapshot_rows})
+        item = models.ItemFactory.make(snapshot_dao, default_settings.PROVIDERS)
+        for (ts, value) in [("100.0", 1), ("200.0", 1), ("300.0", 2), ("400.0", 2)]:
+            models.ItemFactory.add_metrics_snapshot(snapshot_dao, item, "wikipedia",
+                {"wikipedia:mentions": value}, ts)
+            if ts == "200.0":
+                assert_equals(item.metrics["wikipedia:mentions"]["last_changed"], "100.0")
+
+        assert_equals(item.metrics["wikipedia:mentions"]["last_changed"], "300.0")
 
 
 '''
@@ -298,6 +535,13 @@ class TestItem():
         self.d.setResponses([deepcopy(ITEM_DATA)])
 
 
+    def test_as_dict(self):
+        item = models.ItemFactory.get_from_doc(self.d, deepcopy(ITEM_DATA),
+            default_settings.PROVIDERS)
+        item.something_else = {"a": [1, 2]}
+        assert_equals(item.as_dict(), models.todict(item, ignore=["dao"]))
+        assert_equals(item.as_dict()["aliases"], ITEM_DATA["aliases"])
+
     def test_mock_dao(self):
         assert_equals(self.d.get("123"), ITEM_DATA)
 
@@ -422,7 +666,7 @@ class TestAliases(unittest.TestCase):
         # check the data structure is correct
         expected = {"foo":["id1", "id2"], "bar":["id1"]}
         del a.last_modified, a.created, a.last_completed
-        assert a.__dict__ == expected, a
+        assert a.as_dict() == expected, a
 
     def test_add_unique(self):
         a = models.Aliases()
@@ -443,7 +687,34 @@ class TestAliases(unittest.TestCase):
                     "bar":["id1"], 
                     "baz" : ["id1", "id2"]}
         del a.last_modified, a.created, a.last_completed
-        assert_equals(a.__dict__, expected)
+        assert_equals(a.as_dict(), expected)
+
+    def test_add_alias_dedups(self):
+        a = models.Aliases()
+        a.add_alias("foo", "id1")
+        a.add_alias("foo", "id1")
+        assert_equals(a.foo, ["id1"])
+
+    def test_aliases_list_cache(self):
+        a = models.Aliases(seed=ALIAS_DATA)
+        assert_equals(len(a.get_aliases_list()), 3)
+
+        # changing what we were given doesn't change the aliases
+        a.get_aliases_list().append(("foo", "id1"))
+        assert_equals(len(a.get_aliases_list()), 3)
+
+        a.add_alias("foo", "id1")
+        assert ("foo", "id1") in a.get_aliases_list()
+        a.foo = ["id2"]
+        assert ("foo", "id1") not in a.get_aliases_list()
+        assert ("foo", "id2") in a.get_aliases_list()
+        a.clear_aliases()
+        assert_equals(a.get_aliases_list(), [])
+
+    def test_pickle_and_copy(self):
+        a = models.Aliases(seed=ALIAS_DATA)
+        assert_equals(pickle.loads(pickle.dumps(a)).as_dict(), ALIAS_DATA)
+        assert_equals(deepcopy(a).as_dict(), ALIAS_DATA)
 
         
     def test_add_potential_errors(self):
@@ -452,6 +723,17 @@ class TestAliases(unittest.TestCase):
         a.doi = ["error"]
         a.add_alias("doi", "noterror")
         assert_equals(a.doi, ["error", "noterror"])
+
+    def test_namespace_is_read_only(self):
+        a = models.Aliases(seed=ALIAS_DATA)
+        assert_raises(TypeError, a.doi.append, "10.1/new")
+        assert_raises(TypeError, a.doi.__setitem__, 0, "10.1/new")
+        assert_equals(a.doi, ["10.1371/journal.pmed.0020124"])
+        assert_equals(type(deepcopy(a.doi)), list)
+
+        a.doi = a.doi + ["10.1/new"]
+        assert_equals(a.get_aliases_list("doi"),
+            [("doi", "10.1371/journal.pmed.0020124"), ("doi", "10.1/new")])
         
     def test_single_namespaces(self):
         a = models.Aliases(seed=ALIAS_DATA)
@@ -1,9 +1,13 @@
-import unittest, json
+import unittest, json, threading, time
+from copy import deepcopy
 
 from totalimpact import queue
 from totalimpact import models
+from totalimpact.claims import LocalClaims
+from totalimpact.refreshes import refresh_doc
+from test.mocks import MockDao
 
-from nose.tools import nottest
+from nose.tools import nottest, assert_equals
 
 class TestQueue(unittest.TestCase):
 
@@ -47,3 +51,325 @@ class TestQueue(unittest.TestCase):
         assert len(mq.queue) == 0, mq
         
 
+
+
+ITEM_DOC = {
+    "_id": "123",
+    "last_requested": 200.0,
+    "aliases": {"doi": ["10.1/a"], "last_completed": 100.0},
+    "metrics": {
+        "wikipedia:mentions": {"values": {"150.0": 1}},
+        "dryad:package_views": {"values": {"50.0": 1}},
+        "dryad:total_downloads": {"values": {}},
+        "mendeley:readers": {"ignore": True, "values": {}}
+    }
+}
+
+class TestReadyItems(unittest.TestCase):
+
+    def test_needs_aliases(self):
+        doc = deepcopy(ITEM_DOC)
+        assert_equals(queue.needs_aliases(doc), True)
+        del doc["aliases"]["last_completed"]
+        assert_equals(queue.needs_aliases(doc), True)
+        doc["aliases"]["last_completed"] = 300.0
+        assert_equals(queue.needs_aliases(doc), False)
+        assert_equals(queue.needs_aliases({"_id": "snapshot:123", "values": {}}), False)
+
+    def test_providers_needing_metrics(self):
+        doc = deepcopy(ITEM_DOC)
+        # wikipedia was updated since the aliases were, and mendeley is ignored
+        assert_equals(queue.providers_needing_metrics(doc), ["dryad"])
+        del doc["aliases"]["last_completed"]
+        assert_equals(queue.providers_needing_metrics(doc), [])
+        assert_equals(queue.providers_needing_metrics({"_id": "123", "_deleted": True}), [])
+
+    def test_push_dedups_until_done(self):
+        ready = queue.ReadyItems(["dryad"])
+        assert_equals(ready.push("aliases", "123"), True)
+        assert_equals(ready.push("aliases", "123"), False)
+        assert_equals(ready.push("dryad", "123"), True)
+        assert_equals(ready.push("not_a_provider", "123"), False)
+
+        assert_equals(ready.get("aliases", 0.01), "123")
+        assert_equals(ready.get("aliases", 0.01), None)
+
+        # still pending until the worker is done with it
+        assert_equals(ready.push("aliases", "123"), False)
+        ready.done("aliases", "123")
+        assert_equals(ready.push("aliases", "123"), True)
+
+    def test_defer(self):
+        ready = queue.ReadyItems([])
+        ready.push("aliases", "123")
+        ready.get("aliases", 0)
+        ready.defer("aliases", "123", 60)
+        assert_equals(ready.pending, {})
+        assert_equals(ready.take_deferred(), [])
+        assert_equals(ready.take_deferred(time.time() + 61), ["123"])
+        assert_equals(ready.deferred, {})
+
+    def test_push_moves_to_more_urgent_lane(self):
+        ready = queue.ReadyItems([])
+        for item_id in ["1", "2", "3"]:
+            ready.push("aliases", item_id, "bulk")
+        assert_equals(ready.push("aliases", "2", "interactive"), True)
+        assert_equals(ready.qsize("aliases", "interactive"), 1)
+        assert_equals(ready.get("aliases", 0), "2")
+
+        # not back to a less urgent one, or twice
+        assert_equals(ready.push("aliases", "2", "bulk"), False)
+        assert_equals(ready.push("aliases", "2", "interactive"), False)
+        assert_equals(ready.qsize("aliases"), 2)
+
+    def test_offer(self):
+        ready = queue.ReadyItems(["wikipedia", "dryad"])
+        assert_equals(ready.offer(deepcopy(ITEM_DOC)), 2)
+        assert_equals(ready.qsize("aliases"), 1)
+        assert_equals(ready.qsize("aliases", "bulk"), 1)
+        assert_equals(ready.qsize("dryad"), 1)
+        assert_equals(ready.qsize("wikipedia"), 0)
+
+    def test_offer_uses_item_priority(self):
+        ready = queue.ReadyItems(["wikipedia", "dryad"])
+        doc = deepcopy(ITEM_DOC)
+        doc["priority"] = "interactive"
+        ready.offer(doc)
+        assert_equals(ready.qsize("aliases", "interactive"), 1)
+        assert_equals(ready.qsize("dryad", "interactive"), 1)
+
+    def test_lanes(self):
+        doc = deepcopy(ITEM_DOC)
+        assert_equals(queue.item_lane(doc), "bulk")
+        doc["priority"] = "interactive"
+        assert_equals(queue.item_lane(doc), "interactive")
+
+    def test_offer_refresh_request(self):
+        ready = queue.ReadyItems(["wikipedia", "dryad"])
+        doc = refresh_doc("123")
+        doc["_id"] = doc["id"]
+        doc["requested"] = {"wikipedia": 300.0, "dryad": 300.0}
+        doc["completed"] = {"dryad": 400.0}
+        assert_equals(ready.offer(doc), 1)
+        # refreshes go in the bulk lane
+        assert_equals(ready.qsize("wikipedia", "bulk"), 1)
+        assert_equals(ready.get("wikipedia", 0), "refresh:123")
+        assert_equals(ready.qsize("dryad"), 0)
+
+    def test_alias_queue_takes_pushed_items(self):
+        ready = queue.ReadyItems([])
+        claims = LocalClaims(60)
+        d = MockDao()
+        d.setResponses([deepcopy(ITEM_DOC)])
+        aq = queue.AliasQueue(d, ready_items=ready, claims=claims)
+        aq.push_wait = 0.01
+
+        assert_equals(aq.dequeue(), None)
+        ready.offer(deepcopy(ITEM_DOC))
+        item = aq.dequeue()
+        assert_equals(item.id, "123")
+        assert_equals(claims.claim("aliases", "123"), False)
+
+        item.save = lambda: None
+        aq.save_and_unqueue(item)
+        assert_equals(ready.pending, {})
+        assert_equals(claims.claim("aliases", "123"), True)
+
+    def test_pushed_item_claimed_elsewhere(self):
+        ready = queue.ReadyItems([])
+        claims = LocalClaims(60)
+        claims.claim("aliases", "123")
+        aq = queue.AliasQueue(MockDao(), ready_items=ready, claims=claims)
+
+        ready.offer(deepcopy(ITEM_DOC))
+        assert_equals(aq.dequeue(), None)
+        assert_equals(ready.pending, {})
+
+
+class TestLaneQueue(unittest.TestCase):
+
+    def test_takes_lanes_by_weight(self):
+        lanes = queue.LaneQueue({"interactive": 2, "bulk": 1})
+        for i in range(4):
+            lanes.put("i%i" % i, "interactive")
+            lanes.put("b%i" % i, "bulk")
+        assert_equals(lanes.qsize(), 8)
+        assert_equals(lanes.qsize("bulk"), 4)
+
+        got = [lanes.get(0) for i in range(8)]
+        assert_equals(got, ["i0", "i1", "b0", "i2", "i3", "b1", "b2", "b3"])
+        assert_equals(lanes.get(0), None)
+
+    def test_bulk_lane_not_starved(self):
+        lanes = queue.LaneQueue({"interactive": 8, "bulk": 1})
+        lanes.put("b0", "bulk")
+        got = []
+        for i in range(20):
+            lanes.put("i%i" % i, "interactive")
+            got.append(lanes.get(0))
+        assert "b0" in got[:9], got
+
+    def test_get_batch(self):
+        lanes = queue.LaneQueue({"interactive": 2, "bulk": 1})
+        for i in range(3):
+            lanes.put("i%i" % i, "interactive")
+            lanes.put("b%i" % i, "bulk")
+        # a lane's batch stops at its share while the other lane is waiting
+        assert_equals(lanes.get_batch(5, 0), ("interactive", ["i0", "i1"]))
+        assert_equals(lanes.get_batch(5, 0), ("bulk", ["b0"]))
+        assert_equals(lanes.get_batch(5, 0), ("interactive", ["i2"]))
+        # but not once it's the only one
+        assert_equals(lanes.get_batch(5, 0), ("bulk", ["b1", "b2"]))
+        assert_equals(lanes.get_batch(5, 0), (None, []))
+
+        lanes.put("b3", "bulk")
+        lanes.put_back(["b1", "b2"], "bulk")
+        assert_equals(lanes.get_batch(5, 0), ("bulk", ["b1", "b2", "b3"]))
+
+    def test_move(self):
+        lanes = queue.LaneQueue({"interactive": 8, "bulk": 1})
+        lanes.put("b0", "bulk")
+        lanes.put("b1", "bulk")
+        assert_equals(lanes.move("b1", "bulk", "interactive"), True)
+        assert_equals(lanes.move("b1", "bulk", "interactive"), False)
+        assert_equals(lanes.get(0), "b1")
+        assert_equals(lanes.get(0), "b0")
+
+    def test_get_waits(self):
+        lanes = queue.LaneQueue({"interactive": 8, "bulk": 1})
+        timer = threading.Timer(0.05, lambda: lanes.put("b0", "bulk"))
+        timer.start()
+        assert_equals(lanes.get(5), "b0")
+
+
+class TestViewPaging(unittest.TestCase):
+
+    def setUp(self):
+        # 0-3 are in the interactive lane, 4-6 in the bulk one
+        self.d = MockDao([{"id": str(i), "aliases": {}} for i in range(7)],
+            {"queues/aliases": [{"id": str(i), "key": [i // 4, float(i)], "value": None}
+                for i in range(7)]})
+
+    def test_view_rows(self):
+        rows = list(queue.view_rows(self.d, "queues/aliases", 3))
+        assert_equals([row["id"] for row in rows], [str(i) for i in range(7)])
+        assert_equals(self.d.calls.count("view"), 3)
+
+    def test_dequeue_reads_one_page(self):
+        aq = queue.AliasQueue(self.d, claims=LocalClaims(60))
+        aq.page_size = 3
+
+        assert_equals(aq.dequeue().id, "0")
+        assert_equals(aq.dequeue().id, "1")
+        assert_equals(self.d.calls.count("view"), 2)
+
+    def test_dequeue_batch(self):
+        claims = LocalClaims(60)
+        claims.claim("aliases", "1")
+        aq = queue.AliasQueue(self.d, claims=claims)
+        aq.page_size = 3
+
+        # a batch stops at the end of a lane
+        (lane, items) = aq.dequeue_batch(4)
+        assert_equals(lane, "interactive")
+        assert_equals([item.id for item in items], ["0", "2", "3"])
+        # the docs were all read in one request
+        assert_equals(self.d.calls.count("get_bulk"), 1)
+
+        (lane, items) = aq.dequeue_batch(4)
+        assert_equals([item.id for item in items], ["4", "5", "6"])
+        assert_equals(aq.dequeue_batch(4), (None, []))
+
+    def test_dequeue_batch_pushed(self):
+        ready = queue.ReadyItems([])
+        claims = LocalClaims(60)
+        claims.claim("aliases", "1")
+        # "2" was deleted after it was queued
+        d = MockDao([{"id": str(i), "aliases": {}} for i in range(6) if i != 2])
+        aq = queue.AliasQueue(d, ready_items=ready, claims=claims)
+        aq.push_wait = 0.01
+
+        for i in range(6):
+            ready.push("aliases", str(i))
+        # the batch is the first 4 queued, less the ones we can't have
+        (lane, items) = aq.dequeue_batch(4)
+        assert_equals([item.id for item in items], ["0", "3"])
+        assert_equals(ready.qsize("aliases"), 2)
+        # the ones we couldn't have are done with; the one someone else has
+        # is offered again when their claim could have run out
+        assert_equals(set(ready.pending),
+            set([("aliases", "0"), ("aliases", "3"), ("aliases", "4"), ("aliases", "5")]))
+        assert_equals(ready.deferred.keys(), ["1"])
+        assert_equals(claims.claim("aliases", "2"), True)
+
+    def test_claim_batch_pushed_one_lane(self):
+        ready = queue.ReadyItems([], {"interactive": 8, "bulk": 1})
+        claims = LocalClaims(60)
+        aq = queue.AliasQueue(MockDao(), ready_items=ready, claims=claims)
+        aq.push_wait = 0.01
+
+        ready.push("aliases", "b0", "bulk")
+        ready.push("aliases", "b1", "bulk")
+        ready.push("aliases", "i0", "interactive")
+        assert_equals(aq.claim_batch(4), ("interactive", ["i0"]))
+        assert_equals(aq.claim_batch(4), ("bulk", ["b0", "b1"]))
+
+        # an interactive item comes in while we're on the bulk batch, so we
+        # give back the rest of it
+        ready.push("aliases", "i1", "interactive")
+        assert_equals(aq.more_urgent_waiting("bulk"), True)
+        assert_equals(aq.more_urgent_waiting("interactive"), False)
+        aq.release(["b1"], "bulk")
+        assert_equals(claims.claim("aliases", "b1"), True)
+        claims.release("aliases", "b1")
+        assert_equals(aq.claim_batch(4), ("interactive", ["i1"]))
+        assert_equals(aq.claim_batch(4), ("bulk", ["b1"]))
+
+
+class TestRefreshes(unittest.TestCase):
+
+    def setUp(self):
+        item_doc = deepcopy(ITEM_DOC)
+        item_doc["id"] = "123"
+        refresh = refresh_doc("123")
+        refresh["requested"] = {"wikipedia": 300.0}
+        self.d = MockDao([item_doc, refresh])
+        self.ready = queue.ReadyItems(["wikipedia"])
+        self.claims = LocalClaims(60)
+        self.mq = queue.MetricsQueue(self.d, "wikipedia", self.ready, self.claims)
+        self.mq.push_wait = 0.01
+
+    def test_refresh_claimed_as_item(self):
+        self.ready.push("wikipedia", "refresh:123")
+        self.ready.push("wikipedia", "123")
+        (lane, items) = self.mq.dequeue_batch(2)
+        assert_equals([item.id for item in items], ["123"])
+        assert_equals(self.claims.claim("wikipedia", "123"), False)
+        # the item's own entry was dropped, as we have it already
+        assert_equals(self.ready.pending.keys(), [("wikipedia", "refresh:123")])
+
+    def test_save_completes_refresh(self):
+        self.ready.push("wikipedia", "refresh:123")
+        item = self.mq.dequeue()
+        self.mq.save_and_unqueue(item)
+
+        assert self.d.docs["refresh:123"]["completed"]["wikipedia"] > 300.0
+        assert_equals(self.ready.pending, {})
+        assert_equals(self.mq.refreshing, set())
+        assert_equals(self.claims.claim("wikipedia", "123"), True)
+
+    def test_release_puts_back_refresh(self):
+        self.ready.push("wikipedia", "refresh:123")
+        item = self.mq.dequeue()
+        self.mq.release([item.id], "bulk")
+
+        assert_equals(self.ready.get("wikipedia", 0), "refresh:123")
+        assert_equals(self.mq.refreshing, set())
+
+    def test_rows_refresh(self):
+        self.mq.ready_items = None
+        self.d.view_rows["queues/metrics"] = [
+            {"id": "refresh:123", "key": ["wikipedia", 1, 300.0, None], "value": None}]
+        item = self.mq.dequeue()
+        assert_equals(item.id, "123")
+        assert_equals(self.mq.refreshing, set(["123"]))
@@ -0,0 +1,46 @@
+import unittest
+import couchdb
+from nose.tools import assert_equals
+
+from totalimpact.refreshes import refresh_doc, refresh_tiid, pending_refreshes, complete_refresh
+from test.mocks import MockDao
+
+NOW = 1330000000.0
+
+
+class TestRefreshes(unittest.TestCase):
+
+    def setUp(self):
+        doc = refresh_doc("123")
+        doc["requested"] = {"wikipedia": NOW - 100, "dryad": NOW - 100}
+        doc["completed"] = {"dryad": NOW - 50}
+        self.d = MockDao([doc])
+
+    def test_refresh_tiid(self):
+        assert_equals(refresh_tiid("refresh:123"), "123")
+        assert_equals(refresh_tiid("123"), None)
+
+    def test_pending_refreshes(self):
+        assert_equals(pending_refreshes(self.d.docs["refresh:123"]), ["wikipedia"])
+        assert_equals(pending_refreshes({"_id": "123", "aliases": {}}), [])
+
+    def test_complete_refresh(self):
+        assert_equals(complete_refresh(self.d, "123", "wikipedia", NOW), True)
+        assert_equals(self.d.docs["refresh:123"]["completed"],
+            {"wikipedia": NOW, "dryad": NOW - 50})
+        assert_equals(pending_refreshes(self.d.docs["refresh:123"]), [])
+
+        # nothing to write when it's done already, or there's no request
+        assert_equals(complete_refresh(self.d, "123", "dryad", NOW), True)
+        assert_equals(complete_refresh(self.d, "456", "dryad", NOW), True)
+        assert_equals(self.d.calls.count("save"), 1)
+
+    def test_complete_refresh_retries(self):
+        class ConflictingDao(MockDao):
+            def save_and_commit(self, doc):
+                self.calls.append("save")
+                raise couchdb.ResourceConflict("conflict")
+
+        d = ConflictingDao(self.d.docs.values())
+        assert_equals(complete_refresh(d, "123", "wikipedia", NOW, retries=3), False)
+        assert_equals(d.calls.count("save"), 3)
@@ -0,0 +1,114 @@
+import unittest
+from nose.tools import assert_equals
+
+from totalimpact import default_settings
+from totalimpact.models import ItemFactory
+from totalimpact.retention import snapshot_bucket, snapshots_to_drop, MetricsCompactor
+from test.mocks import MockDao
+
+POLICY = {
+    "enabled": True,
+    "keep_all_days": 30,
+    "keep_daily_days": 365,
+    "interval": 86400,
+    "page_size": 3
+}
+DAY = 86400
+NOW = 1330000000.0
+
+def snapshot(ts, value=1):
+    return ItemFactory.snapshot_doc("tiid1", "dryad", str(ts),
+        {"dryad:package_views": value, "dryad:total_downloads": value})
+
+def legacy_item_rows(docs):
+    ''' Makes the rows of the legacy_items view from the docs '''
+    return [{"id": doc["_id"], "key": None, "value": None} for doc in docs.values()
+        if "metrics" in doc and "aliases" in doc
+        and max([len(metric["values"]) for metric in doc["metrics"].values()]) > 1]
+
+
+class TestRetentionPolicy(unittest.TestCase):
+
+    def test_snapshot_bucket(self):
+        assert_equals(snapshot_bucket(NOW - 10 * DAY, NOW, POLICY), None)
+        assert_equals(snapshot_bucket(NOW - 40 * DAY, NOW, POLICY)[0], "day")
+        assert_equals(snapshot_bucket(NOW - 400 * DAY, NOW, POLICY)[0], "month")
+
+    def test_keeps_recent_snapshots(self):
+        docs = [snapshot(NOW - hours * 3600) for hours in range(48)]
+        assert_equals(snapshots_to_drop(docs, NOW, POLICY), [])
+
+    def test_keeps_newest_each_day(self):
+        day_start = NOW - 40 * DAY - (NOW % DAY)
+        docs = [snapshot(day_start + hours * 3600) for hours in range(0, 24, 6)]
+        dropped = snapshots_to_drop(docs, NOW, POLICY)
+        assert_equals(len(dropped), 3)
+        assert docs[-1] not in dropped
+
+    def test_keeps_newest_each_month(self):
+        docs = [snapshot(NOW - days * DAY) for days in range(400, 430)]
+        dropped = snapshots_to_drop(docs, NOW, POLICY)
+        kept = [doc for doc in docs if doc not in dropped]
+        assert len(kept) in (1, 2)
+        assert docs[0] in kept
+
+    def test_drops_old_failures(self):
+        docs = [snapshot(NOW - DAY, None), snapshot(NOW - 40 * DAY, None), snapshot(NOW - 41 * DAY)]
+        assert_equals(snapshots_to_drop(docs, NOW, POLICY), [docs[1]])
+
+
+class TestMetricsCompactor(unittest.TestCase):
+
+    def test_run(self):
+        docs = [snapshot(NOW - DAY), snapshot(NOW - 40 * DAY - 10), snapshot(NOW - 40 * DAY)]
+        docs.append(ItemFactory.snapshot_doc("tiid2", "dryad", str(NOW - 40 * DAY - 10),
+            {"dryad:package_views": None}))
+        d = MockDao(docs)
+
+        compactor = MetricsCompactor(d, default_settings.PROVIDERS, POLICY)
+        assert_equals(compactor.run(now=NOW), (0, 2))
+        assert_equals(sorted(d.docs.keys()), sorted([docs[0]["id"], docs[2]["id"]]))
+
+    def test_run_shrinks_items(self):
+        item = ItemFactory.make(None, default_settings.PROVIDERS)
+        item.aliases.add_alias("doi", "10.1/a")
+        item.metrics["wikipedia:mentions"]["values"] = {"100.0": 1, "200.0": 2, "300.0": 3}
+        d = MockDao([item.as_dict()], {"queues/legacy_items": legacy_item_rows})
+
+        compactor = MetricsCompactor(d, default_settings.PROVIDERS, POLICY)
+        assert_equals(compactor.run(now=NOW)[0], 1)
+
+        assert_equals(d.docs[item.id]["metrics"]["wikipedia:mentions"]["values"], {"300.0": 3})
+        assert_equals(len([id for id in d.docs if id.startswith("snapshot:")]), 3)
+
+        # already shrunk, so nothing to do next time
+        assert_equals(compactor.run(now=NOW)[0], 0)
+
+    def test_run_reads_only_what_it_needs(self):
+        item = ItemFactory.make(None, default_settings.PROVIDERS)
+        docs = [snapshot(NOW - i * DAY) for i in range(5)]
+        docs += [item.as_dict(), {"id": "_design/queues", "views": {}}]
+        d = MockDao(docs, {"queues/legacy_items": legacy_item_rows})
+
+        compactor = MetricsCompactor(d, default_settings.PROVIDERS, POLICY)
+        compactor.run(now=NOW)
+        assert_equals([viewname for (viewname, params) in d.queries],
+            ["_all_docs", "_all_docs", "queues/legacy_items"])
+        assert_equals(d.queries[0][1]["startkey"], "snapshot:")
+        assert_equals(d.queries[0][1]["endkey"], u"snapshot:\ufff0")
+        # the item's only got the latest values, so isn't listed
+        assert_equals(d.calls.count("save"), 0)
+
+    def test_read(self):
+        docs = [snapshot(NOW - i * DAY) for i in range(5)]
+        d = MockDao(docs)
+
+        compactor = MetricsCompactor(d, default_settings.PROVIDERS, POLICY)
+        assert_equals(len(list(compactor.read('_all_docs'))), 5)
+        assert_equals(d.calls.count("view"), 2)
+
+        # gives up as soon as it's stopped
+        read = []
+        for doc in compactor.read('_all_docs', stopped=lambda: len(read) == 2):
+            read.append(doc)
+        assert_equals(len(read), 2)
@@ -0,0 +1,153 @@
+import unittest
+from nose.tools import assert_equals
+
+from totalimpact import default_settings
+from totalimpact.itemviews import view_doc
+from totalimpact.models import snapshot_time
+from totalimpact.refreshes import refresh_doc
+from totalimpact.scheduler import refresh_interval, providers_to_refresh, RefreshScheduler
+from test.mocks import MockDao
+
+POLICY = {
+    "enabled": True,
+    "refresh_interval": 100,
+    "max_backoff": 8,
+    "idle_days": 30,
+    "view_resolution": 3600,
+    "interval": 3600,
+    "page_size": 2
+}
+PROVIDERS = {
+    "wikipedia": {},
+    "dryad": {"refresh_interval": 1000}
+}
+NOW = 1330000000.0
+
+def item_doc(id, last_modified, last_changed=None):
+    return {
+        "id": id,
+        "_id": id,
+        "_rev": "1",
+        "last_requested": NOW - 86400,
+        "aliases": {"doi": ["10.1/" + id], "last_completed": NOW - 86400},
+        "metrics": {
+            "wikipedia:mentions": {
+                "values": {str(last_modified): 1},
+                "last_changed": str(last_changed or last_modified)
+                },
+            "dryad:package_views": {"values": {str(last_modified): 1}}
+            }
+    }
+
+def refresh_rows(docs):
+    ''' Makes the rows of the refresh view from the item docs '''
+    rows = []
+    for doc in docs.values():
+        if not doc.get("aliases", {}).get("last_completed"):
+            continue
+        last_modified = {}
+        for (metric_name, metric) in doc.get("metrics", {}).iteritems():
+            provider_name = metric_name.split(":")[0]
+            for ts in metric["values"]:
+                last_modified[provider_name] = max(snapshot_time(ts),
+                    last_modified.get(provider_name, 0))
+        rows += [{"id": doc["_id"], "key": [provider_name, modified], "value": None}
+            for (provider_name, modified) in last_modified.iteritems() if modified]
+    return rows
+
+
+class TestRefreshPolicy(unittest.TestCase):
+
+    def test_refresh_interval_backs_off(self):
+        changing = [{"values": {"500.0": 1}, "last_changed": "500.0"}]
+        assert_equals(refresh_interval(changing, 100, 8), 100)
+
+        stable = [{"values": {"500.0": 1}, "last_changed": "300.0"}]
+        assert_equals(refresh_interval(stable, 100, 8), 300)
+
+        stable_for_ages = [{"values": {"5000.0": 1}, "last_changed": "100.0"}]
+        assert_equals(refresh_interval(stable_for_ages, 100, 8), 800)
+
+        # one metric changing is enough
+        assert_equals(refresh_interval(changing + stable, 100, 8), 100)
+
+    def test_providers_to_refresh(self):
+        doc = item_doc("a", NOW - 200)
+        # wikipedia's interval has passed, dryad's hasn't
+        assert_equals(providers_to_refresh(doc, NOW, PROVIDERS, POLICY), ["wikipedia"])
+
+        # not once a refresh has been asked for
+        assert_equals(providers_to_refresh(doc, NOW, PROVIDERS, POLICY,
+            requested={"wikipedia": NOW - 10}), [])
+
+    def test_idle_items_not_refreshed(self):
+        doc = item_doc("a", NOW - 200)
+        doc["last_requested"] = NOW - 40 * 86400
+        assert_equals(providers_to_refresh(doc, NOW, PROVIDERS, POLICY), [])
+
+        assert_equals(providers_to_refresh(doc, NOW, PROVIDERS, POLICY, NOW - 86400),
+            ["wikipedia"])
+
+        # items from before view docs have it in the item
+        doc["last_viewed"] = NOW - 86400
+        assert_equals(providers_to_refresh(doc, NOW, PROVIDERS, POLICY), ["wikipedia"])
+
+    def test_never_fetched_left_to_queue(self):
+        doc = item_doc("a", NOW - 200)
+        doc["metrics"]["wikipedia:mentions"]["values"] = {}
+        assert_equals(providers_to_refresh(doc, NOW, PROVIDERS, POLICY), [])
+
+
+class TestRefreshScheduler(unittest.TestCase):
+
+    def test_run(self):
+        docs = [item_doc("a", NOW - 200), item_doc("b", NOW - 50),
+            item_doc("c", NOW - 200, NOW - 5000), item_doc("d", NOW - 2000)]
+        d = MockDao(docs, {"queues/refresh": refresh_rows})
+
+        scheduler = RefreshScheduler(d, PROVIDERS, POLICY)
+        # c's metrics haven't changed for a while, so can wait longer
+        assert_equals(scheduler.run(now=NOW), 3)
+        assert_equals(d.docs["refresh:a"]["requested"], {"wikipedia": NOW})
+        assert "refresh:b" not in d.docs
+        assert "refresh:c" not in d.docs
+        assert_equals(d.docs["refresh:d"]["requested"], {"wikipedia": NOW, "dryad": NOW})
+        # the items aren't written to
+        assert_equals([d.docs[id]["_rev"] for id in "abcd"], ["1", "1", "1", "1"])
+
+        # nothing more to do until they've been refreshed
+        assert_equals(scheduler.run(now=NOW), 0)
+
+    def test_run_reads_only_stale_items(self):
+        docs = [item_doc("a", NOW - 200), item_doc("b", NOW - 50)]
+        d = MockDao(docs, {"queues/refresh": refresh_rows})
+
+        RefreshScheduler(d, PROVIDERS, POLICY).run(now=NOW)
+        queries = [params for (viewname, params) in d.queries if viewname == "queues/refresh"]
+        assert_equals([(params["startkey"], params["endkey"]) for params in queries],
+            [(["dryad"], ["dryad", NOW - 1000]), (["wikipedia"], ["wikipedia", NOW - 100])])
+        # only a was read, and its refresh doc looked for
+        assert_equals(d.calls.count("get_bulk"), 1)
+
+    def test_run_after_refresh_done(self):
+        refresh = refresh_doc("a")
+        refresh["requested"] = {"wikipedia": NOW - 300}
+        refresh["completed"] = {"wikipedia": NOW - 250}
+        d = MockDao([item_doc("a", NOW - 200), refresh], {"queues/refresh": refresh_rows})
+
+        assert_equals(RefreshScheduler(d, PROVIDERS, POLICY).run(now=NOW), 1)
+        assert_equals(d.docs["refresh:a"]["requested"], {"wikipedia": NOW})
+        assert_equals(d.docs["refresh:a"]["_rev"], "2")
+
+    def test_run_reads_view_docs(self):
+        idle = item_doc("a", NOW - 200)
+        idle["last_requested"] = NOW - 40 * 86400
+        viewed = item_doc("b", NOW - 200)
+        viewed["last_requested"] = NOW - 40 * 86400
+        d = MockDao([idle, viewed, view_doc("b", NOW - 86400)],
+            {"queues/refresh": refresh_rows})
+
+        scheduler = RefreshScheduler(d, PROVIDERS, POLICY)
+        assert_equals(scheduler.run(now=NOW), 1)
+        assert "refresh:a" not in d.docs
+        assert_equals(d.docs["refresh:b"]["requested"], {"wikipedia": NOW})
@@ -0,0 +1,95 @@
+import unittest
+from nose.tools import assert_equals
+
+from totalimpact.queue import ReadyItems
+from totalimpact.stats import BackendStats, queue_depths, queue_report
+from test.mocks import MockDao
+
+NOW = 1330000000.0
+
+
+VIEW_ROWS = {
+    "queues/aliases": [
+        {"id": "1", "key": [0, NOW - 10], "value": None},
+        {"id": "2", "key": [1, NOW - 300], "value": None},
+        {"id": "3", "key": [1, NOW - 200], "value": None}
+        ],
+    "queues/metrics": [
+        {"id": "4", "key": ["dryad", 1, NOW - 50, 0], "value": None}
+        ]
+    }
+# the _depth views count the rows of the queue views
+VIEW_ROWS["queues/aliases_depth"] = VIEW_ROWS["queues/aliases"]
+VIEW_ROWS["queues/metrics_depth"] = VIEW_ROWS["queues/metrics"]
+
+
+class TestQueueStats(unittest.TestCase):
+
+    def test_queue_depths(self):
+        d = MockDao(view_rows=VIEW_ROWS)
+        depths = queue_depths(d)
+        assert_equals(depths["aliases"]["interactive"], {"depth": 1, "oldest_requested": NOW - 10})
+        assert_equals(depths["aliases"]["bulk"], {"depth": 2, "oldest_requested": NOW - 300})
+        assert_equals(depths["dryad"], {"bulk": {"depth": 1, "oldest_requested": NOW - 50}})
+
+        # the queue views are only read for their oldest row in each lane
+        assert_equals(d.queries[:2], [
+            ("queues/aliases_depth", {"group_level": 1}),
+            ("queues/aliases", {"startkey": [0], "endkey": [0, {}], "limit": 1})])
+        assert_equals(len(d.queries), 5)
+
+    def test_backend_stats(self):
+        stats = BackendStats("host:1", ReadyItems(["dryad"]))
+        stats.published = (NOW - 10, {})
+        stats.count_dequeued("aliases", 5)
+        stats.count_provider_call("dryad", "metrics", None, 0.5)
+        stats.count_provider_call("dryad", "metrics", "http_timeout", 2.0)
+
+        doc = stats.as_doc(NOW)
+        assert_equals(doc["queues"]["aliases"], {"dequeued": 5, "dequeue_rate": 0.5, "ready": 0})
+        assert_equals(doc["queues"]["dryad"]["dequeued"], 0)
+        counts = doc["providers"]["dryad"]["metrics"]
+        assert_equals(counts["success"], 1)
+        assert_equals(counts["errors"], {"http_timeout": 1})
+        assert_equals(counts["latency"], {"count": 2, "total": 2.5, "max": 2.0})
+
+        # the rate is over the time since we last published
+        stats.count_dequeued("aliases", 1)
+        assert_equals(stats.as_doc(NOW + 10)["queues"]["aliases"]["dequeue_rate"], 0.1)
+
+    def test_publish(self):
+        d = MockDao(view_rows=VIEW_ROWS)
+        stats = BackendStats("host:1")
+        stats.publish(d, NOW)
+        stats.publish(d, NOW + 60)
+        assert_equals(d.docs["backend_stats:host:1"]["updated"], NOW + 60)
+
+        # a restarted process takes over its old doc
+        stats = BackendStats("host:1")
+        stats.publish(d, NOW + 120)
+        assert_equals(d.docs["backend_stats:host:1"]["_rev"], "3")
+
+    def test_queue_report(self):
+        d = MockDao(view_rows=VIEW_ROWS)
+        for owner in ["host:1", "host:2", "gone:3"]:
+            stats = BackendStats(owner)
+            stats.published = (NOW - 10, {})
+            stats.count_dequeued("aliases", 10)
+            stats.count_provider_call("dryad", "metrics", None, 1.0)
+            if owner == "gone:3":
+                stats.publish(d, NOW - 1000)
+            else:
+                stats.publish(d, NOW)
+
+        report = queue_report(d, ["dryad", "wikipedia"], NOW, 300)
+        aliases = report["queues"]["aliases"]
+        assert_equals(aliases["depth"], 3)
+        assert_equals(aliases["oldest_age"], 300)
+        assert_equals(aliases["lanes"]["interactive"], {"depth": 1, "oldest_age": 10})
+        assert_equals(aliases["dequeued"], 20)
+        assert_equals(aliases["dequeue_rate"], 2.0)
+        assert_equals(report["queues"]["wikipedia"]["depth"], 0)
+        assert_equals(report["queues"]["wikipedia"]["oldest_age"], None)
+        assert_equals(report["providers"]["dryad"]["metrics"]["success"], 2)
+        assert_equals(sorted([backend["owner"] for backend in report["backends"]]),
+            ["host:1", "host:2"])
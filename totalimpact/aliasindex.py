@@ -0,0 +1,162 @@
+import threading, time
+from totalimpact.dao import view_rows
+from totalimpact.tilogging import logging
+
+# set up logging
+logger = logging.getLogger(__name__)
+
+
+def lookup_tiids(dao, namespace, nid):
+    '''Returns the list of tiids that have the given alias.
+
+    Runs a keyed query against the by_alias view, so the cost does not
+    depend on how many aliases are in the db.'''
+    res = dao.view('queues/by_alias', key=[namespace, nid])
+    return [row["id"] for row in res["rows"]]
+
+
+def lookup_tiids_bulk(dao, aliases):
+    '''Bulk version of lookup_tiids, making a single view query.
+
+    returns a dict of (namespace, id) -> list of tiids, with an entry for
+    every alias passed in.'''
+    ret = dict([(tuple(alias), []) for alias in aliases])
+    if not ret:
+        return ret
+
+    res = dao.view('queues/by_alias', keys=[list(alias) for alias in ret])
+    for row in res["rows"]:
+        (namespace, nid) = row["key"]
+        ret.setdefault((namespace, nid), []).append(row["id"])
+    return ret
+
+
+class AliasIndex(object):
+    """ In-process map of (namespace, id) -> [tiid, ...]
+
+        The whole map is loaded from the queues/by_alias view, and reloaded
+        in a background thread once it is older than max_age seconds, so
+        lookups are a dict access whatever the size of the db, and never
+        wait for a load; until the new map is ready they use the old one.
+        Aliases we haven't seen yet (eg added by another process since the
+        last load, or before the first load is done) fall through to a keyed
+        view query, and the answer is remembered.
+    """
+
+    def __init__(self, dao, max_age=600, page_size=10000):
+        self.dao = dao
+        self.max_age = max_age
+        self.page_size = page_size
+        self.lock = threading.Lock()
+        self.index = {}
+        self.loaded_at = None
+        # the thread reloading the index, if there is one
+        self.loader = None
+        # aliases added while the index is being reloaded, which the view
+        # may have been read too early to see
+        self.added_while_loading = None
+
+    def load(self):
+        self.lock.acquire()
+        if self.added_while_loading is None:
+            self.added_while_loading = []
+        self.lock.release()
+
+        index = {}
+        try:
+            for row in view_rows(self.dao, 'queues/by_alias', self.page_size):
+                (namespace, nid) = row["key"]
+                index.setdefault((namespace, nid), []).append(row["id"])
+        except:
+            self.lock.acquire()
+            self.added_while_loading = None
+            self.lock.release()
+            raise
+
+        self.lock.acquire()
+        for (namespace, nid, tiid) in self.added_while_loading:
+            tiids = index.setdefault((namespace, nid), [])
+            if tiid not in tiids:
+                tiids.append(tiid)
+        self.added_while_loading = None
+        self.index = index
+        self.loaded_at = time.time()
+        self.lock.release()
+        logger.debug("loaded alias index with %i aliases" % len(index))
+
+    def is_stale(self):
+        if self.loaded_at is None:
+            return True
+        return (time.time() - self.loaded_at) > self.max_age
+
+    def refresh(self):
+        '''Starts reloading the index in a background thread, unless one is
+        reloading it already.
+
+        returns the thread, or None if one was already running'''
+        self.lock.acquire()
+        try:
+            if self.loader is not None:
+                return None
+            self.loader = threading.Thread(target=self.load_in_background)
+            self.loader.daemon = True
+            self.added_while_loading = []
+        finally:
+            self.lock.release()
+
+        self.loader.start()
+        return self.loader
+
+    def load_in_background(self):
+        try:
+            self.load()
+        except Exception, e:
+            logger.error("couldn't reload the alias index: %s" % e)
+        finally:
+            self.lock.acquire()
+            self.loader = None
+            self.lock.release()
+
+    def add(self, namespace, nid, tiid):
+        self.lock.acquire()
+        tiids = self.index.setdefault((namespace, nid), [])
+        if tiid not in tiids:
+            tiids.append(tiid)
+        if self.added_while_loading is not None:
+            self.added_while_loading.append((namespace, nid, tiid))
+        self.lock.release()
+
+    def get_tiids(self, namespace, nid):
+        if self.is_stale():
+            self.refresh()
+
+        tiids = self.index.get((namespace, nid))
+        if tiids is None:
+            tiids = lookup_tiids(self.dao, namespace, nid)
+            for tiid in tiids:
+                self.add(namespace, nid, tiid)
+
+        return list(tiids)
+
+    def get_tiids_bulk(self, aliases):
+        '''Bulk version of get_tiids. Aliases not in the index are looked up
+        with a single view query.'''
+        if self.is_stale():
+            self.refresh()
+
+        ret = {}
+        missing = []
+        for alias in aliases:
+            (namespace, nid) = alias
+            tiids = self.index.get((namespace, nid))
+            if tiids is None:
+                missing.append((namespace, nid))
+            else:
+                ret[(namespace, nid)] = list(tiids)
+
+        for (alias, tiids) in lookup_tiids_bulk(self.dao, missing).iteritems():
+            for tiid in tiids:
+                self.add(alias[0], alias[1], tiid)
+            ret[alias] = tiids
+
+        return ret
@@ -2,11 +2,16 @@
 
 from flask import Flask, jsonify, json, request, redirect, abort, make_response
 from flask import render_template, flash
-import os, json, time
+import os, json, time, threading, zlib
+import couchdb
 from pprint import pprint
 
 from totalimpact import dao
-from totalimpact.models import Item, Collection, ItemFactory, CollectionFactory
+from totalimpact.aliasindex import AliasIndex, lookup_tiids, lookup_tiids_bulk
+from totalimpact.itemviews import ViewRecorder
+from totalimpact.models import Item, Collection, ItemFactory, CollectionFactory, Saveable
+from totalimpact.queue import LANES
+from totalimpact.stats import queue_report
 from totalimpact.providers.provider import ProviderFactory, ProviderConfigurationError
 from totalimpact.tilogging import logging
 from totalimpact import default_settings
@@ -40,17 +45,107 @@ def configure_app(app):
 app = create_app()
 
 mydao = None
+mydao_config = None
+mydao_lock = threading.Lock()
+alias_index = None
+view_recorder = None
 
 @app.before_request
 def connect_to_db():
-    '''sets up the db. this has to happen before every request, so that
-    we can pass in alternate config values for testing'''
-    global mydao
-    mydao = dao.Dao(
+    '''makes sure mydao is connected to the db in the config.
+
+    There is one Dao for the whole process, shared by all requests, so we
+    don't pay for connecting to couch on every request. It is only rebuilt
+    when the db config changes, so we can pass in alternate config values
+    for testing.'''
+    global mydao, mydao_config
+    db_config = (
         app.config["DB_NAME"],
         app.config["DB_URL"],
         app.config["DB_USERNAME"],
-        app.config["DB_PASSWORD"]) 
+        app.config["DB_PASSWORD"])
+    if mydao is not None and mydao_config == db_config:
+        return
+
+    mydao_lock.acquire()
+    try:
+        if mydao is None or mydao_config != db_config:
+            mydao = dao.Dao(*db_config)
+            mydao_config = db_config
+    finally:
+        mydao_lock.release()
+
+
+JSON_STYLES = ("pretty", "compact")
+# content types worth gzipping
+GZIP_MIMETYPES = ("application/json", "text/html")
+
+def json_style():
+    '''Returns the style of JSON this request should get: "pretty" or
+    "compact".
+
+    Set by the json query param, or else by a style param on application/json
+    in the Accept header, or else by the JSON_STYLE config.'''
+    style = request.args.get("json")
+    if style in JSON_STYLES:
+        return style
+
+    for accepted in request.headers.get("Accept", "").split(","):
+        params = [param.strip() for param in accepted.split(";")]
+        if params[0] == "application/json":
+            for param in params[1:]:
+                if param in ["style=" + s for s in JSON_STYLES]:
+                    return param.split("=")[1]
+
+    return app.config["JSON_STYLE"]
+
+def to_json(obj, style=None):
+    '''Serialises obj for a response, in the given style or else the style
+    this request asked for.'''
+    if (style or json_style()) == "compact":
+        return json.dumps(obj, separators=(',', ':'))
+    return json.dumps(obj, sort_keys=True, indent=4)
+
+def gzip_chunks(chunks, level):
+    '''Compresses an iterable of strings into a gzip stream, a chunk at a time,
+    so streamed responses stay streamed.'''
+    compressor = zlib.compressobj(level, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+    for chunk in chunks:
+        if isinstance(chunk, unicode):
+            chunk = chunk.encode("utf-8")
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+@app.after_request
+def gzip_response(resp):
+    '''gzips JSON and HTML responses for clients that accept it'''
+    gzip_config = app.config["GZIP"]
+    if not gzip_config["enabled"]:
+        return resp
+    if resp.mimetype not in GZIP_MIMETYPES or resp.status_code != 200:
+        return resp
+    if resp.direct_passthrough or "Content-Encoding" in resp.headers:
+        return resp
+
+    # whatever we send, caches have to keep gzipped and plain copies apart
+    resp.vary.add("Accept-Encoding")
+    if "gzip" not in request.accept_encodings:
+        return resp
+
+    if resp.is_sequence:
+        data = resp.data
+        if len(data) < gzip_config["min_size"]:
+            return resp
+        resp.data = "".join(gzip_chunks([data], gzip_config["level"]))
+    else:
+        # streamed (eg GET /items), so we don't know the size up front
+        resp.response = gzip_chunks(resp.response, gzip_config["level"])
+        resp.headers.pop("Content-Length", None)
+
+    resp.headers["Content-Encoding"] = "gzip"
+    return resp
 
 
 # adding a simple route to confirm working API
@@ -62,7 +157,26 @@ def hello():
         "moreinfo": "http://total-impact.tumblr.com/",
         "version": app.config["VERSION"]
     }
-    resp = make_response( json.dumps(msg, sort_keys=True, indent=4), 200)        
+    resp = make_response( to_json(msg), 200)        
+    resp.mimetype = "application/json"
+    return resp
+
+
+'''
+GET /queues
+returns how many items are waiting in the alias queue and each provider's
+metrics queue (in all, and in each priority lane), how old the oldest
+waiting request is in seconds, and how fast the backend processes are
+taking items off them; plus each provider's success, error and latency
+counts. See QUEUE_STATS in the config.
+'''
+@app.route('/queues', methods=['GET'])
+def queues():
+    stats_config = app.config["QUEUE_STATS"]
+    report = queue_report(mydao, app.config["PROVIDERS"].keys(), time.time(),
+        stats_config["max_age"])
+
+    resp = make_response( to_json(report), 200 )
     resp.mimetype = "application/json"
     return resp
 
@@ -74,58 +188,199 @@ GET /tiid/:namespace/:id
 '''
 @app.route('/tiid/<ns>/<path:nid>', methods=['GET'])
 def tiid(ns, nid):
-    viewname = 'queues/by_alias'
-    res = mydao.view(viewname)
-    rows = res["rows"]
-    tiids = [row["id"] for row in rows if row['key'] == [ns,nid]]
+    tiids = get_tiids_for_alias(ns, nid)
 
     if not tiids:
         abort(404)
-    resp = make_response( json.dumps(tiids, sort_keys=True, indent=4 ), 303) 
+    resp = make_response( to_json(tiids), 303) 
     resp.mimetype = "application/json"
     return resp
 
-def create_item(namespace, id):
-    '''Utility function to keep DRY in single/multiple item creation endpoins'''
-    item = ItemFactory.make(mydao, app.config["PROVIDERS"])
+def get_alias_index():
+    '''Returns the in-process alias index, or None if it's not enabled'''
+    global alias_index
+    if not app.config["ALIAS_INDEX"]["enabled"]:
+        return None
+
+    # rebuild the index if we've been pointed at a different db (eg in tests)
+    if alias_index is None or alias_index.dao.db_name != mydao.db_name:
+        alias_index = AliasIndex(mydao, app.config["ALIAS_INDEX"]["max_age"])
+    return alias_index
+
+def get_tiids_for_alias(namespace, nid):
+    '''Looks up the tiids for an alias, through the in-process alias index if
+    it is enabled in the config, or else by a keyed query on the view.'''
+    index = get_alias_index()
+    if index is None:
+        return lookup_tiids(mydao, namespace, nid)
+    return index.get_tiids(namespace, nid)
+
+def get_tiids_for_aliases(aliases):
+    '''Bulk version of get_tiids_for_alias.
+
+    returns a dict of (namespace, id) -> list of tiids'''
+    index = get_alias_index()
+    if index is None:
+        return lookup_tiids_bulk(mydao, aliases)
+    return index.get_tiids_bulk(aliases)
+
+def get_priority(default):
+    '''Returns the priority lane the request asked for new items to go in
+    with its priority param, or default. Aborts with 400 on an unknown lane.'''
+    priority = request.args.get("priority", default)
+    if priority not in LANES:
+        abort(400)
+    return priority
+
+def promote_items(tiids):
+    '''Moves extant items into the interactive lane, for when someone asks
+    for an item that was imported in bulk. Saving the new priority sends the
+    item back through the backend's changes feed, which moves any work still
+    waiting on it to the interactive lane. Items that are interactive
+    already aren't written.
+
+    Only the priority is changed; if an item was saved in between, we read
+    it again and retry, like Saveable.save.'''
+    tries = 0
+    while tiids:
+        docs = [doc for doc in mydao.get_bulk(tiids)
+            if doc is not None and doc.get("priority") != "interactive"]
+        for doc in docs:
+            doc["priority"] = "interactive"
+
+        tiids = []
+        for (success, docid, rev_or_exc) in mydao.bulk_save(docs):
+            if success:
+                continue
+            if isinstance(rev_or_exc, couchdb.ResourceConflict) and tries < Saveable.save_retries:
+                tiids.append(docid)
+            else:
+                logger.error("couldn't move %s to the interactive lane: %s" % (docid, rev_or_exc))
+        tries += 1
+
+def create_item(namespace, id, priority="interactive"):
+    '''Utility function to keep DRY in single/multiple item creation endpoins
+
+    If we already have an item with this namespace and id, we don't make a
+    new one (see issue 86). New items are put in the given priority lane; an
+    extant item asked for in the interactive lane is moved to it.
+
+    New items get their tiid from the alias (see ItemFactory.alias_tiid), so
+    if another request makes the same item between our lookup and our save,
+    couch gives us a conflict and we return its tiid; no lock is needed.
+
+    returns a (tiid, created) tuple, where created is False if the tiid is
+    that of an extant item.'''
+    tiids = get_tiids_for_alias(namespace, id)
+    if tiids:
+        logger.debug("alias %s:%s already has tiid %s" % (namespace, id, tiids[0]))
+        if priority == "interactive":
+            promote_items(tiids[:1])
+        return (tiids[0], False)
+
+    item = ItemFactory.make(mydao, app.config["PROVIDERS"],
+        id=ItemFactory.alias_tiid(namespace, id))
     item.aliases.add_alias(namespace, id)
-
-    ## FIXME - see issue 86
-    ## Should look up this namespace and id and see if we already have a tiid
-    ## If so, return its tiid with a 200.
-    # right now this makes a new item every time, creating many dupes
+    item.priority = priority
 
     # does not filter by whether we actually can process the namespace, since
     # we may be able to someday soon. It's user's job to not pass in junk.
-    item.save()
-
     try:
-        return item.id
-    except AttributeError:
-        abort(500)     
-
+        mydao.save_and_commit(item.as_dict())
+        created = True
+    except couchdb.ResourceConflict:
+        logger.debug("item %s for alias %s:%s was made by another request"
+            % (item.id, namespace, id))
+        created = False
+        if priority == "interactive":
+            promote_items([item.id])
+
+    if alias_index is not None:
+        alias_index.add(namespace, id, item.id)
+    return (item.id, created)
+
+
+def create_items(aliases, priority="bulk"):
+    '''Bulk version of create_item.
+
+    Looks up all the aliases in one go, then makes items for the new ones and
+    writes them with bulk saves, rather than saving them one at a time. As in
+    create_item, a conflict means another request made the item first, and
+    extant items asked for in the interactive lane are moved to it.
+
+    returns a dict of (namespace, id) -> (tiid, status), where status is
+    "created", "exists", or "failed" (with a tiid of None).'''
+    ret = {}
+    new_items = []
+    unique_aliases = list(set(aliases))
+
+    extant_tiids = get_tiids_for_aliases(unique_aliases)
+    for alias in unique_aliases:
+        if extant_tiids.get(alias):
+            ret[alias] = (extant_tiids[alias][0], "exists")
+        else:
+            item = ItemFactory.make(mydao, app.config["PROVIDERS"],
+                id=ItemFactory.alias_tiid(alias[0], alias[1]))
+            item.aliases.add_alias(alias[0], alias[1])
+            item.priority = priority
+            new_items.append((alias, item))
+
+    if new_items:
+        results = mydao.bulk_save([item.as_dict() for (alias, item) in new_items])
+        for ((alias, item), (success, docid, rev_or_exc)) in zip(new_items, results):
+            if success:
+                ret[alias] = (item.id, "created")
+            elif isinstance(rev_or_exc, couchdb.ResourceConflict):
+                ret[alias] = (item.id, "exists")
+            else:
+                logger.error("couldn't save new item for %s: %s" % (str(alias), rev_or_exc))
+                ret[alias] = (None, "failed")
+                continue
+            if alias_index is not None:
+                alias_index.add(alias[0], alias[1], item.id)
+
+    if priority == "interactive":
+        promote_items(list(set([tiid for (tiid, status) in ret.values() if status == "exists"])))
+    return ret
 
 @app.route('/items', methods=['POST'])
 def items_namespace_post():
     '''Creates multiple items based on a POSTed list of aliases.
     
     Note that this requires the POST content-type be sent as application/json..
-    this could be seen as a bug or feature...'''
+    this could be seen as a bug or feature...
+
+    returns a list with an entry for each posted alias, in the order posted:
+        {"alias": [namespace, id], "tiid": tiid, "status": status}
+    where status is "created", "exists" (we already had an item for this
+    alias), or "failed" (with a null tiid).
+    201 if any items were created, 200 otherwise
 
-    # get aliases into tuples instead of lists so can hash into a set
+    New items go in the interactive lane if there are up to bulk_threshold
+    of them, else the bulk lane, unless ?priority= says otherwise.
+    '''
+
+    # get aliases into tuples instead of lists so can hash them
     aliases_list = [(namespace, nid) for [namespace, nid] in request.json]
     logger.debug("In api /items with aliases " + str(aliases_list))
 
-    unique_aliases = list(set(aliases_list))
-    tiids = []
-    for alias in unique_aliases:
-        logger.debug("In api /items with alias " + str(alias))
-        tiid = create_item(alias[0], alias[1])
-        logger.debug("... created with tiid " + tiid)
-        tiids.append(tiid)
+    if len(aliases_list) <= app.config["QUEUE_LANES"]["bulk_threshold"]:
+        priority = get_priority("interactive")
+    else:
+        priority = get_priority("bulk")
 
-    response_code = 201 # Created
-    resp = make_response(json.dumps(tiids), response_code)
+    created_items = create_items(aliases_list, priority)
+
+    response = []
+    for alias in aliases_list:
+        (tiid, status) = created_items[alias]
+        response.append({"alias": list(alias), "tiid": tiid, "status": status})
+
+    if "created" in [status for (tiid, status) in created_items.values()]:
+        response_code = 201 # Created
+    else:
+        response_code = 200 # OK, nothing new was made
+    resp = make_response(to_json(response), response_code)
     resp.mimetype = "application/json"
     return resp
 
@@ -135,29 +390,131 @@ def item_namespace_post(namespace, id):
 
     POST /item/:namespace/:id
     201 location: {tiid}
+    200 location: {tiid} if we already had an item with this alias
+    400 if ?priority= isn't a lane we know
     500?  if fails to create
     example /item/PMID/234234232
     '''
-    tiid = create_item(namespace, id)
-    response_code = 201 # Created
+    (tiid, created) = create_item(namespace, id, get_priority("interactive"))
+    if created:
+        response_code = 201 # Created
+    else:
+        response_code = 200 # OK
    
-    resp = make_response(json.dumps(tiid), response_code)
+    resp = make_response(to_json(tiid), response_code)
     resp.mimetype = "application/json"
     return resp
 
 
-def make_item_dict(tiid):
-    '''Utility function for /item and /items endpoints
-    Will cause the request to abort with 404 if item is missing from db'''
+def make_etag(rev, *variant):
+    '''Makes the etag for a doc from its couch _rev.
+
+    The config version is included because parts of our responses (like
+    static_meta) come from the config. variant is anything else that changes
+    the representation, like the format.'''
+    return "-".join([rev, app.config["VERSION"]] + [str(v) for v in variant])
+
+def get_wait():
+    '''Returns how many seconds the request asked to long-poll for with its
+    wait param (capped at the config's max_wait), or 0.'''
     try:
-        item = ItemFactory.get(mydao,
-            tiid,
-            ProviderFactory.get_provider,
-            app.config["PROVIDERS"])
-        item_dict = item.as_dict()
-    except LookupError:
+        wait = float(request.args.get("wait", 0))
+    except ValueError:
+        abort(400)
+    return max(0, min(wait, app.config["LONG_POLL"]["max_wait"]))
+
+def not_modified_resp(id, *variant):
+    '''Returns a 304 response if the request's If-None-Match has the current
+    etag of the doc, else None.
+
+    Only the doc's _rev is fetched from the db, so when the client is up to
+    date we don't read, deserialise or serialise the doc at all.
+
+    If the request has a wait param and the client is up to date, we
+    long-poll: the request is held open on the db's _changes feed until the
+    doc changes (and we return None, so the caller sends the new doc) or
+    the wait is up (and we return the 304). Clients waiting for an item's
+    aliases and metrics then get them as soon as they're saved, without
+    polling.'''
+    # (werkzeug's ETags is False when it only has weak etags, like ours)
+    if not request.headers.get("If-None-Match"):
+        return None
+
+    wait = get_wait()
+    if wait:
+        # we'll wait for changes from before we read the rev, so a change
+        # made in between isn't missed
+        since = mydao.get_update_seq()
+
+    rev = mydao.get_rev(id)
+    if rev is None:
+        return None
+
+    etag = make_etag(rev, *variant)
+    if not request.if_none_match.contains_weak(etag):
+        return None
+
+    if wait and mydao.wait_for_change(id, since, wait):
+        return None
+
+    resp = make_response("", 304)
+    resp.set_etag(etag, weak=True)
+    return resp
+
+def get_view_recorder():
+    '''Returns the in-process view recorder, or None if metrics aren't being
+    refreshed, so views don't matter'''
+    global view_recorder
+    if not app.config["METRICS_REFRESH"]["enabled"]:
+        return None
+
+    # make a new one if we've been pointed at a different db (eg in tests)
+    if view_recorder is None or view_recorder.dao.db_name != mydao.db_name:
+        if view_recorder is not None:
+            view_recorder.stop()
+        view_recorder = ViewRecorder(mydao,
+            app.config["METRICS_REFRESH"]["view_resolution"],
+            app.config["METRICS_REFRESH"]["view_flush_interval"])
+        view_recorder.start()
+    return view_recorder
+
+def record_views(tiids):
+    '''Records that the items were viewed, so their metrics are kept fresh.
+    This doesn't write to the db; see ViewRecorder.'''
+    recorder = get_view_recorder()
+    if recorder is not None:
+        recorder.record(tiids)
+
+def make_item_dict(tiid, history=False):
+    '''Utility function for the /item endpoints
+    Will cause the request to abort with 404 if item is missing from db
+
+    The item doc only has the latest value of each metric. If history is
+    True, all the metric values are loaded from the item's snapshots.
+
+    Records that the item was viewed, so its metrics are kept fresh.
+
+    returns (item_dict, rev)'''
+    item_doc = mydao.get(tiid)
+    if item_doc is None:
         abort(404)
-    return item_dict
+
+    record_views([tiid])
+    item = ItemFactory.get_from_doc(mydao,
+        item_doc,
+        app.config["PROVIDERS"])
+    item_dict = item.as_dict()
+
+    if history:
+        metrics_history = ItemFactory.get_metrics_history(mydao, tiid)
+        for (metric_name, values) in metrics_history.iteritems():
+            if metric_name in item_dict["metrics"]:
+                # new dicts, as as_dict() shares the item's
+                metric = dict(item_dict["metrics"][metric_name])
+                metric["values"] = dict(metric["values"])
+                metric["values"].update(values)
+                item_dict["metrics"][metric_name] = metric
+    return (item_dict, item._rev)
 
 def make_item_resp(tiid, item_dict, format):
     item_dict["tiid"] = tiid;
@@ -168,36 +525,89 @@ def make_item_resp(tiid, item_dict, format):
         resp = make_response(render_template("item.html", item=item_dict ))
         resp.content_type = "text/html"
     else:
-        resp = make_response(json.dumps(item_dict, sort_keys=True, indent=4))
+        resp = make_response(to_json(item_dict))
         resp.mimetype = "application/json"
     return resp
 
 '''GET /item/:tiid
 404 if tiid not found in db
+304 if the If-None-Match header has the item's current etag
+
+The item only has the latest value of each metric, unless ?history=true is
+given, when it has them all.
+
+GET /item/:tiid?wait=:seconds
+with If-None-Match: long-polls, returning the item as soon as it changes,
+or 304 if it hasn't changed after :seconds
 '''
 @app.route('/item/<tiid>', methods=['GET'])
 @app.route('/item/<tiid>.<format>', methods=['GET'])
 def item(tiid, format=None):
     # TODO check request headers for format as well.
-    item_dict = make_item_dict(tiid)
-    return make_item_resp(tiid, item_dict, format)
+    history = request.args.get("history") == "true"
+    resp = not_modified_resp(tiid, format, json_style(), history)
+    if resp is not None:
+        # the client has the item already, but still viewed it
+        record_views([tiid])
+        return resp
+
+    (item_dict, rev) = make_item_dict(tiid, history)
+    resp = make_item_resp(tiid, item_dict, format)
+    resp.set_etag(make_etag(rev, format, json_style(), history), weak=True)
+    return resp
+
+'''
+POST /item/:tiid/provenance_urls
+recomputes the provenance urls of the item's metrics from its current aliases
+and saves them. The backend stores these when it finishes an item's aliases;
+this is for items whose urls are missing or out of date.
+404 if tiid not found in db
+'''
+@app.route('/item/<tiid>/provenance_urls', methods=['POST'])
+def item_provenance_urls(tiid):
+    try:
+        item = ItemFactory.get(mydao, tiid, app.config["PROVIDERS"])
+    except LookupError:
+        abort(404)
+
+    providers = ProviderFactory.get_providers(app.config["PROVIDERS"])
+    ItemFactory.update_provenance_urls(item, providers)
+    item.save()
+
+    return make_item_resp(tiid, item.as_dict(), None)
 
 '''
 GET /items/:tiid,:tiid,...
-returns a json list of item objects (100 max)
+returns a json list of item objects (MAX_ITEMS_PER_GET max, extra tiids ignored)
 404 unless all tiids return items from db
 '''
 @app.route('/items/<tiids>', methods=['GET'])
 def items(tiids, format=None):
-    items = []
+    tiid_list = tiids.split(',')[:app.config["MAX_ITEMS_PER_GET"]]
 
-    for index,tiid in enumerate(tiids.split(',')):
-        if index > 99: break    # weak, change
-        items.append(make_item_dict(tiid))
-
-    resp = make_response(json.dumps(item_dict, sort_keys=True, indent=4))
-    resp.mimetype = "application/json"
-    return resp
+    # all the docs come back from the db in one request
+    item_docs = mydao.get_bulk(tiid_list)
+    if None in item_docs:
+        abort(404)
+    record_views(tiid_list)
+
+    # the items are made and serialised one at a time as the response is sent
+    # (after the request context has gone, so we look at the request first)
+    def generate(request_dao, providers_config, style):
+        yield "["
+        for index, item_doc in enumerate(item_docs):
+            item = ItemFactory.get_from_doc(request_dao,
+                item_doc,
+                providers_config)
+            item_dict = item.as_dict()
+            item_dict["tiid"] = item.id
+            if index > 0:
+                yield ","
+            yield to_json(item_dict, style)
+        yield "]"
+
+    return app.response_class(generate(mydao, app.config["PROVIDERS"], json_style()),
+        mimetype="application/json")
         
 
 
@@ -233,7 +643,7 @@ def provider_memberitems(provider_name):
 
     memberitems = provider.member_items(query, cache_enabled=False)
     
-    resp = make_response( json.dumps(memberitems, sort_keys=True, indent=4), 200 )
+    resp = make_response( to_json(memberitems), 200 )
     resp.mimetype = "application/json"
     return resp
 
@@ -256,7 +666,7 @@ def provider_aliases(provider_name, id):
         
     all_aliases = [(provider.example_id[0], id)] + new_aliases
 
-    resp = make_response( json.dumps(all_aliases, sort_keys=True, indent=4) )
+    resp = make_response( to_json(all_aliases) )
     resp.mimetype = "application/json"
     return resp
 
@@ -274,7 +684,7 @@ def provider_metrics(provider_name, id):
 
     metrics = provider.get_metrics_for_id(id, url, cache_enabled=False)
 
-    resp = make_response( json.dumps(metrics, sort_keys=True, indent=4) )
+    resp = make_response( to_json(metrics) )
     resp.mimetype = "application/json"
     return resp
 
@@ -291,7 +701,7 @@ def provider_biblio(provider_name, id):
         url = None
 
     biblio = provider.get_biblio_for_id(id, url, cache_enabled=False)
-    resp = make_response( json.dumps(biblio, sort_keys=True, indent=4) )
+    resp = make_response( to_json(biblio) )
     resp.mimetype = "application/json"
     return resp
 
@@ -325,6 +735,11 @@ returns 404 or 204
 def collection(cid=''):
     response_code = None
 
+    if request.method == "GET":
+        resp = not_modified_resp(cid, json_style())
+        if resp is not None:
+            return resp
+
     try:
         coll = CollectionFactory.make(mydao, id=cid)
     except LookupError:
@@ -369,8 +784,10 @@ def collection(cid=''):
         else:
             abort(404)
 
-    resp = make_response( json.dumps( coll.as_dict(), sort_keys=True, indent=4 ), response_code)
+    resp = make_response( to_json(coll.as_dict()), response_code)
     resp.mimetype = "application/json"
+    if request.method == "GET":
+        resp.set_etag(make_etag(coll._rev, json_style()), weak=True)
     return resp
 
 
@@ -381,9 +798,13 @@ if __name__ == "__main__":
     except LookupError:
         print "CANNOT CONNECT TO DATABASE, maybe doesn't exist?"
         raise LookupError
+    mydao.update_views()
+
+    # load the providers up front, rather than on the first requests
+    ProviderFactory.get_providers(app.config["PROVIDERS"])
 
     logger = logging.getLogger()
 
-    # run it
-    app.run(host='0.0.0.0', port=5001, debug=False)
+    # run it. Threaded, so long-polling requests don't hold up the others.
+    app.run(host='0.0.0.0', port=5001, debug=False, threaded=True)
 
@@ -1,11 +1,50 @@
 #!/usr/bin/env python
 
-import threading, time, sys
+import sys
+from optparse import OptionParser
+
+def make_option_parser():
+    parser = OptionParser()
+    parser.add_option("-p", "--pid",
+                      action="store", dest="pid", default=None,
+                      help="pid file")
+    parser.add_option("-s", "--startup-log",
+                      action="store", dest="startup_log", default=None,
+                      help="startup log")
+    parser.add_option("-l", "--log",
+                      action="store", dest="log", default=None,
+                      help="runtime log")
+    parser.add_option("-d", "--daemon",
+                      action="store_true", dest="daemon", default=False,
+                      help="run as a daemon")
+    parser.add_option("-g", "--gevent",
+                      action="store_true", dest="gevent", default=False,
+                      help="run the workers as gevent greenlets, not threads")
+    return parser
+
+def patch_for_gevent(options):
+    '''Patches the standard library for gevent if the options ask for the
+    workers to run as greenlets rather than OS threads. This has to happen
+    before anything else imports it, so backend.py does it first thing.'''
+    if options.gevent:
+        from gevent import monkey
+        monkey.patch_all()
+
+if __name__ == "__main__":
+    # the args are parsed by the same parser as below, so -g and -dg count
+    patch_for_gevent(make_option_parser().parse_args()[0])
+
+import threading, time
 import traceback
 from totalimpact import dao, api
-from totalimpact.queue import AliasQueue, MetricsQueue
+from totalimpact.queue import AliasQueue, MetricsQueue, ReadyItems, LANES
+from totalimpact.dao import view_rows
 from totalimpact.providers.provider import ProviderFactory, ProviderConfigurationError
-from totalimpact.models import Error
+from totalimpact.models import Error, ItemFactory
+from totalimpact.retention import MetricsCompactor
+from totalimpact.claims import make_claims, default_owner
+from totalimpact.scheduler import RefreshScheduler
+from totalimpact.stats import BackendStats
 
 from totalimpact.tilogging import logging
 
@@ -17,7 +56,6 @@ import daemon
 import lockfile
 from totalimpact.pidsupport import PidFile
 
-from optparse import OptionParser
 import os
 
 logger = logging.getLogger('backend')
@@ -101,6 +139,166 @@ class StoppableThread(threading.Thread):
         self.sleeping = False
 
 
+class MetricsCompactorThread(StoppableThread):
+    """ Applies the metrics retention policy to the db every so often
+        (see MetricsCompactor)
+    """
+
+    def __init__(self, dao, providers_config, policy):
+        super(MetricsCompactorThread, self).__init__()
+        self.compactor = MetricsCompactor(dao, providers_config, policy)
+        self.interval = policy["interval"]
+        self.thread_id = "MetricsCompactorThread"
+
+    def run(self):
+        ctxfilter.threadInit()
+        ctxfilter.local.backend['thread'] = self.thread_id
+        while not self.stopped():
+            try:
+                self.compactor.run(stopped=self.stopped)
+            except Exception, e:
+                logger.error("metrics compactor failed: %s" % e)
+            self._interruptable_sleep(self.interval)
+
+
+class MetricsRefreshThread(StoppableThread):
+    """ Requests refreshes of the metrics of items people are looking at,
+        every so often (see RefreshScheduler)
+    """
+
+    def __init__(self, dao, providers_config, policy):
+        super(MetricsRefreshThread, self).__init__()
+        self.scheduler = RefreshScheduler(dao, providers_config, policy)
+        self.interval = policy["interval"]
+        self.thread_id = "MetricsRefreshThread"
+
+    def run(self):
+        ctxfilter.threadInit()
+        ctxfilter.local.backend['thread'] = self.thread_id
+        while not self.stopped():
+            try:
+                self.scheduler.run(stopped=self.stopped)
+            except Exception, e:
+                logger.error("metrics refresh scheduler failed: %s" % e)
+            self._interruptable_sleep(self.interval)
+
+
+class StatsPublisherThread(StoppableThread):
+    """ Saves this process's BackendStats to the db every so often, for
+        GET /queues
+    """
+
+    def __init__(self, dao, stats, interval):
+        super(StatsPublisherThread, self).__init__()
+        self.dao = dao
+        self.stats = stats
+        self.interval = interval
+        self.thread_id = "StatsPublisherThread"
+
+    def run(self):
+        ctxfilter.threadInit()
+        ctxfilter.local.backend['thread'] = self.thread_id
+        while not self.stopped():
+            self.publish()
+            self._interruptable_sleep(self.interval)
+        # so the last counts aren't lost
+        self.publish()
+
+    def publish(self):
+        try:
+            self.stats.publish(self.dao)
+        except Exception, e:
+            logger.error("publishing backend stats failed: %s" % e)
+
+
+class ChangesDispatcher(StoppableThread):
+    """ Finds the items that need their aliases or metrics updating, and
+        pushes them to the worker threads through a ReadyItems
+
+        It reads the queue views when it starts, then follows the db's
+        _changes feed from the update sequence the db was at before that, so
+        nothing is missed and the db isn't polled while nothing is changing.
+
+        Items a worker couldn't claim, as another worker had them, are
+        offered again once that worker's claim could have run out (see
+        ReadyItems), in case it never finishes them. The views are read
+        again every reload_interval seconds too, to catch anything else.
+    """
+
+    # how many rows of the queue views to read at a time
+    page_size = 500
+
+    def __init__(self, dao, ready_items, timeout, reload_interval=None):
+        super(ChangesDispatcher, self).__init__()
+        self.dao = dao
+        self.ready_items = ready_items
+        self.timeout = timeout
+        self.reload_interval = reload_interval
+        self.since = None
+        self.loaded = None
+        self.thread_id = "ChangesDispatcher"
+
+    def load_backlog(self):
+        '''Queues the items already on the queue views.
+
+        returns the update sequence to follow the _changes feed from'''
+        since = self.dao.get_update_seq()
+        # the views' keys have the position of the item's lane in LANES
+        for row in view_rows(self.dao, 'queues/aliases', self.page_size):
+            self.ready_items.push("aliases", row["id"], LANES[row["key"][0]])
+        for row in view_rows(self.dao, 'queues/metrics', self.page_size):
+            self.ready_items.push(row["key"][0], row["id"], LANES[row["key"][1]])
+        self.loaded = time.time()
+        return since
+
+    def backlog_due(self):
+        if self.since is None:
+            return True
+        if self.reload_interval is None:
+            return False
+        return time.time() - self.loaded > self.reload_interval
+
+    def dispatch_changes(self):
+        '''Waits for the next changes to the db, and queues the changed items
+        that are ready to be worked on.
+
+        returns the number of ids queued'''
+        (docs, self.since) = self.dao.changes(self.since, self.timeout, filter="queues/items")
+        queued = 0
+        for doc in docs:
+            # the filter leaves out deletions, but in case one gets through,
+            # there's nothing to queue for a deleted doc
+            if doc.get("_deleted"):
+                continue
+            queued += self.ready_items.offer(doc)
+        return queued
+
+    def offer_deferred(self):
+        '''Offers the deferred items that are due again, if they still need
+        working on.
+
+        returns the number of ids queued'''
+        queued = 0
+        for doc in self.dao.get_bulk(self.ready_items.take_deferred()):
+            if doc is not None:
+                queued += self.ready_items.offer(doc)
+        return queued
+
+    def run(self):
+        ctxfilter.threadInit()
+        ctxfilter.local.backend['thread'] = self.thread_id
+        while not self.stopped():
+            try:
+                if self.backlog_due():
+                    self.since = self.load_backlog()
+                queued = self.dispatch_changes() + self.offer_deferred()
+                if queued:
+                    logger.debug("dispatched %i items" % queued)
+            except Exception, e:
+                logger.error("changes dispatcher failed, retrying: %s" % e)
+                self._interruptable_sleep(5)
+
+
 class ContextFilter(logging.Filter):
     """ Filter to add contextual information regarding items to logs
 
@@ -167,12 +365,21 @@ class QueueConsumer(StoppableThread):
         item = None
         while item is None and not self.stopped():
             item = self.queue.dequeue()
-            if item is None:
+            if item is None and getattr(self.queue, "ready_items", None) is None:
                 # if the queue is empty, wait 0.5 seconds before checking
-                # again
+                # again (queues with pushed items wait in dequeue)
                 time.sleep(0.5)
         return item
 
+    def dequeue_batch(self, n):
+        # like dequeue, but takes up to n items from one lane at once
+        (lane, items) = (None, [])
+        while not items and not self.stopped():
+            (lane, items) = self.queue.dequeue_batch(n)
+            if not items and getattr(self.queue, "ready_items", None) is None:
+                time.sleep(0.5)
+        return (lane, items)
+
 
 
 class ProviderThread(QueueConsumer):
@@ -188,6 +395,12 @@ class ProviderThread(QueueConsumer):
         Metric and Alias providers.
     """
 
+    # how many items to claim from the queue at a time
+    batch_size = 1
+
+    # set to a BackendStats to count the items done and the provider calls
+    stats = None
+
     def __init__(self, dao, queue):
         self.dao = dao
         QueueConsumer.__init__(self, queue)
@@ -218,14 +431,39 @@ class ProviderThread(QueueConsumer):
         self.startup()
 
         while not self.stopped():
-            # get the first item on the queue - this waits until
+            # claim and load the next batch of items on the queue - this waits until
             # there is something to return
-            logger.debug("%s - waiting for queue item" % self.thread_id)
-            item = self.dequeue()
+            logger.debug("%s - waiting for queue items" % self.thread_id)
+            (lane, items) = self.dequeue_batch(self.batch_size)
+            if self.stats is not None and items:
+                self.stats.count_dequeued(self.queue.queue_name, len(items))
             
-            # Check we have an item, if we have been signalled to stop, then
-            # item may be None
-            if item:
+            # the ids of the items in the batch we've lost the claims on
+            lost = set()
+
+            # If we have been signalled to stop, then items may be empty
+            for (index, item) in enumerate(items):
+                if item.id in lost:
+                    # our claim ran out while we did the ones before it, and
+                    # another worker has it now
+                    continue
+                unstarted_ids = [unstarted.id for unstarted in items[index:]
+                    if unstarted.id not in lost]
+                if self.stopped():
+                    # let other workers have the ones we haven't started
+                    self.queue.release(unstarted_ids, lane)
+                    break
+                if index > 0 and self.queue.more_urgent_waiting(lane):
+                    # someone's waiting on an item in a more urgent lane, so
+                    # give back the rest of this batch and go and get it.
+                    # They're read again when they're next taken
+                    self.queue.release(unstarted_ids, lane)
+                    break
+                if index > 0:
+                    lost.update(self.queue.renew(unstarted_ids))
+                    if item.id in lost:
+                        continue
+
                 # if we get to here, an item has been popped off the queue and we
                 # now want to calculate it's metrics. 
                 # Repeatedly process this item until we hit the error limit
@@ -243,7 +481,7 @@ class ProviderThread(QueueConsumer):
                 ctxfilter.local.backend['item'] = ''
 
             # Flag for testing. We should finish the run loop as soon
-            # as we've processed a single item.
+            # as we've processed a single batch.
             if run_only_once:
                 return
 
@@ -275,6 +513,7 @@ class ProviderThread(QueueConsumer):
         while not error_limit_reached and not success and not self.stopped():
 
             error_type = None
+            started = time.time()
 
             # Get a replacement provider access template_url if in config
             try:
@@ -352,6 +591,14 @@ class ProviderThread(QueueConsumer):
                 error_limit_reached = True
 
             finally:
+                if self.stats is not None:
+                    if error_type is None and not success:
+                        self.stats.count_provider_call(provider.provider_name, method,
+                            'unknown_error', time.time() - started)
+                    else:
+                        self.stats.count_provider_call(provider.provider_name, method,
+                            error_type, time.time() - started)
+
                 # If we had any errors, update the error counts and sleep if 
                 # we need to do so, before retrying. If we exceed the error limit
                 # for the given error type, set error_limit_reached to be true
@@ -384,9 +631,9 @@ class ProviderThread(QueueConsumer):
 
 class ProvidersAliasThread(ProviderThread):
     
-    def __init__(self, providers, dao, queueid=None):
+    def __init__(self, providers, dao, queueid=None, ready_items=None, claims=None):
         self.providers = providers
-        queue = AliasQueue(dao, queueid)
+        queue = AliasQueue(dao, queueid, ready_items, claims)
         ProviderThread.__init__(self, dao, queue)
         self.providers = providers
         self.thread_id = "AliasThread"
@@ -447,6 +694,11 @@ class ProvidersAliasThread(ProviderThread):
             ctxfilter.local.backend['provider'] = ''
             logger.info("final alias list is %s" % item.aliases.get_aliases_list())
 
+            # Now we have all the aliases we're going to get, store the
+            # provenance urls so that reading the item doesn't need to call
+            # the providers for them
+            ItemFactory.update_provenance_urls(item, self.providers)
+
             # Update last completed time to remove thread from the queue
             #item.aliases.last_completed = time.time()
             #item.save()
@@ -459,9 +711,9 @@ class ProviderMetricsThread(ProviderThread):
         requests for a single provider. It will deal with retries and 
         timeouts as required.
     """
-    def __init__(self, provider, dao):
+    def __init__(self, provider, dao, ready_items=None, claims=None):
         self.provider = provider
-        queue = MetricsQueue(dao, provider.provider_name)
+        queue = MetricsQueue(dao, provider.provider_name, ready_items, claims)
         ProviderThread.__init__(self, dao, queue)
         self.thread_id = "MetricsThread:" + str(self.provider.provider_name)
 
@@ -478,20 +730,17 @@ class ProviderMetricsThread(ProviderThread):
         
         ts = str(time.time())
 
-        if success:
-            if metrics:
-                for key in metrics.keys():
-                    item.metrics[key]['values'][ts] = metrics[key]
-            else:
-                # The provider returned None for this item. This is either
-                # a non result or a permanent failure
-                for key in self.provider.metric_names:
-                    item.metrics[key]['values'][ts] = None
+        if success and metrics:
+            values = metrics
         else:
-            # metrics failed, write None values in for the metric
-            # values so we don't attempt to reprocess this item
-            for key in self.provider.metric_names:
-                item.metrics[key]['values'][ts] = None
+            # The provider returned None for this item (either a non result
+            # or a permanent failure), or metrics failed. Write None values in
+            # for the metric values so we don't attempt to reprocess this item
+            values = dict([(key, None) for key in self.provider.metric_names])
+
+        # the snapshot is saved on its own; the item just keeps the latest
+        ItemFactory.add_metrics_snapshot(self.dao, item,
+            self.provider.provider_name, values, ts)
         item.save()
 
 
@@ -504,7 +753,16 @@ from totalimpact import default_settings
 from totalimpact.api import app
 
 
-def main(logfile=None):
+def check_gevent_patched():
+    '''Raises RuntimeError unless gevent has patched the standard library,
+    as greenlets that block on an unpatched socket hold up all the rest'''
+    from gevent import monkey
+    if not monkey.is_module_patched("socket"):
+        raise RuntimeError("gevent workers need the standard library patched "
+            "before the backend is imported; run backend.py with --gevent")
+
+
+def main(logfile=None, use_gevent=False):
 
     logger = logging.getLogger()
 
@@ -514,6 +772,8 @@ def main(logfile=None):
         app.config["DB_USERNAME"],
         app.config["DB_PASSWORD"]
     ) 
+    # make sure the db has all the views the queues use
+    mydao.update_views()
 
     # Adding this by handle. fileConfig doesn't allow filters to be added
     from totalimpact.backend import ctxfilter
@@ -530,15 +790,49 @@ def main(logfile=None):
     from totalimpact.backend import TotalImpactBackend, ProviderMetricsThread, ProvidersAliasThread, StoppableThread, QueueConsumer
     from totalimpact.providers.provider import Provider, ProviderFactory
 
+    # With --gevent the threads below are greenlets (see the top of this
+    # file): they all share one OS thread, and each one yields while it
+    # waits on a provider or the db. So workers can be set in the
+    # hundreds, and each provider's workers setting is then the most
+    # requests that can be in flight to it at once.
+    if use_gevent:
+        check_gevent_patched()
+        print "Running the workers as gevent greenlets"
+        # running as a daemon forks us and closes our files, so start
+        # gevent's event loop afresh
+        import gevent
+        gevent.reinit()
+
     # Start all of the backend processes
     print "Starting alias retrieval thread"
     providers = ProviderFactory.get_providers(app.config["PROVIDERS"])
 
+    # workers claim items before working on them, so other backend
+    # processes don't work on them too
+    claims = make_claims(mydao, app.config["QUEUE_CLAIMS"])
+
+    # one dispatcher follows the db's changes and hands items to the workers,
+    # rather than every worker polling the queue views
+    ready_items = None
+    dispatcher_threads = []
+    if app.config["QUEUE_FEED"]["enabled"]:
+        ready_items = ReadyItems([provider.provider_name for provider in providers],
+            app.config["QUEUE_LANES"]["weights"])
+        thread = ChangesDispatcher(mydao, ready_items, app.config["QUEUE_FEED"]["timeout"],
+            app.config["QUEUE_CLAIMS"]["lease"])
+        thread.start()
+        dispatcher_threads.append(thread)
+
+    # counts what the workers get done, for GET /queues
+    stats = BackendStats(default_owner(), ready_items)
+
     alias_threads = []
     thread_count = app.config["ALIASES"]["workers"]
     for idx in range(thread_count):
-        at = ProvidersAliasThread(providers, mydao, idx)
+        at = ProvidersAliasThread(providers, mydao, idx, ready_items, claims)
         at.thread_id = 'AliasThread(%i)' % idx
+        at.batch_size = app.config["QUEUE_BATCH"]["size"]
+        at.stats = stats
         at.start()
         alias_threads.append(at)
 
@@ -546,15 +840,39 @@ def main(logfile=None):
     # Start each of the metric providers
     metrics_threads = []
     for provider in providers:
-        providers = ProviderFactory.get_providers(app.config["PROVIDERS"])
         thread_count = app.config["PROVIDERS"][provider.provider_name]["workers"]
         print "  ", provider.provider_name
         for idx in range(thread_count):
-            thread = ProviderMetricsThread(provider, mydao)
+            thread = ProviderMetricsThread(provider, mydao, ready_items, claims)
             metrics_threads.append(thread)
             thread.thread_id = thread.thread_id + '(%i)' % idx
+            thread.batch_size = app.config["QUEUE_BATCH"]["size"]
+            thread.stats = stats
             thread.start()
 
+    compactor_threads = []
+    if app.config["METRICS_RETENTION"]["enabled"]:
+        print "Starting metrics compactor thread"
+        thread = MetricsCompactorThread(mydao, app.config["PROVIDERS"],
+            app.config["METRICS_RETENTION"])
+        thread.start()
+        compactor_threads.append(thread)
+
+    refresh_threads = []
+    if app.config["METRICS_REFRESH"]["enabled"]:
+        print "Starting metrics refresh thread"
+        thread = MetricsRefreshThread(mydao, app.config["PROVIDERS"],
+            app.config["METRICS_REFRESH"])
+        thread.start()
+        refresh_threads.append(thread)
+
+    stats_threads = []
+    if app.config["QUEUE_STATS"]["enabled"]:
+        print "Starting stats publisher thread"
+        thread = StatsPublisherThread(mydao, stats, app.config["QUEUE_STATS"]["interval"])
+        thread.start()
+        stats_threads.append(thread)
+
     # Install a signal handler so we'll break out of the main loop
     # on receipt of relevant signals
     class ExitSignal(Exception):
@@ -572,9 +890,9 @@ def main(logfile=None):
     except (KeyboardInterrupt, ExitSignal), e:
         pass
 
-    from totalimpact.queue import alias_queue_seen
-    from totalimpact.queue import metric_queue_seen
-
+    print "Stopping changes dispatcher"
+    for thread in dispatcher_threads:
+        thread.stop()
     print "Stopping alias threads"
     for at in alias_threads:
         at.stop()
@@ -587,25 +905,27 @@ def main(logfile=None):
     print "Waiting on alias thread"
     for at in alias_threads:
         at.join()
+    print "Stopping metrics compactor thread"
+    for thread in compactor_threads:
+        thread.stop()
+        thread.join()
+    print "Stopping metrics refresh thread"
+    for thread in refresh_threads:
+        thread.stop()
+        thread.join()
+    print "Stopping stats publisher thread"
+    for thread in stats_threads:
+        thread.stop()
+        thread.join()
+    print "Waiting on changes dispatcher"
+    for thread in dispatcher_threads:
+        thread.join()
     print "All stopped"
 
  
 if __name__ == "__main__":
 
-    parser = OptionParser()
-    parser.add_option("-p", "--pid",
-                      action="store", dest="pid", default=None,
-                      help="pid file")
-    parser.add_option("-s", "--startup-log",
-                      action="store", dest="startup_log", default=None,
-                      help="startup log")
-    parser.add_option("-l", "--log",
-                      action="store", dest="log", default=None,
-                      help="runtime log")
-    parser.add_option("-d", "--daemon",
-                      action="store_true", dest="daemon", default=False,
-                      help="run as a daemon")
-
+    parser = make_option_parser()
     (options, args) = parser.parse_args()
     # Root of the totalimpact directory
     rootdir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
@@ -631,9 +951,9 @@ if __name__ == "__main__":
             context.pidfile = PidFile(os.path.join(rootdir, 'run', 'backend.pid'))
         context.working_directory = rootdir
         with context:
-            main(logfile)
+            main(logfile, options.gevent)
 
     else:
-        main(logfile)
+        main(logfile, options.gevent)
     
 
@@ -0,0 +1,161 @@
+import os, socket, threading, time
+import couchdb
+from totalimpact.tilogging import logging
+
+# set up logging
+logger = logging.getLogger(__name__)
+
+CLAIM_ID_PREFIX = "claim:"
+
+
+def default_owner():
+    '''Names this backend process, for the claims it makes'''
+    return "%s:%i" % (socket.gethostname(), os.getpid())
+
+def make_claims(dao, claims_config):
+    '''Makes the claims store named in the QUEUE_CLAIMS config'''
+    if claims_config["store"] == "couch":
+        return CouchClaims(dao, default_owner(), claims_config["lease"])
+    elif claims_config["store"] == "local":
+        return LocalClaims(claims_config["lease"])
+    raise ValueError("unknown claims store %s" % claims_config["store"])
+
+
+class LocalClaims(object):
+    """ Keeps claims in memory, so only works within one backend process.
+
+        Every claim on an item in a queue lasts lease seconds, or until it
+        is released.
+    """
+
+    def __init__(self, lease):
+        self.lease = lease
+        self.expires = {}
+        self.lock = threading.Lock()
+
+    def claim(self, queue_name, item_id):
+        '''returns True if we got the claim, False if someone else has it'''
+        now = time.time()
+        self.lock.acquire()
+        try:
+            if self.expires.get((queue_name, item_id), 0) > now:
+                return False
+            self.expires[(queue_name, item_id)] = now + self.lease
+            return True
+        finally:
+            self.lock.release()
+
+    def renew(self, queue_name, item_id):
+        '''Extends a claim we hold by another lease.
+
+        returns True, as no one else can have taken it over'''
+        self.lock.acquire()
+        self.expires[(queue_name, item_id)] = time.time() + self.lease
+        self.lock.release()
+        return True
+
+    def release(self, queue_name, item_id):
+        self.lock.acquire()
+        self.expires.pop((queue_name, item_id), None)
+        self.lock.release()
+
+
+class CouchClaims(object):
+    """ Keeps claims in the db, so backend processes on any number of hosts
+        can share the queues.
+
+        A claim is a doc with an id made from the queue and item, so only
+        one process can make it; couch turns away the rest with a conflict.
+        It records its owner and when its lease expires. Once a claim has
+        expired (say its worker crashed) anyone can take it over, again
+        guarded by the doc's _rev. Releasing a claim deletes its doc.
+
+        The claims this process holds are remembered, so asking for one of
+        them again doesn't go to the db. Workers renew the claims on the
+        items they haven't got to yet, which rewrites them with a new expiry
+        once half their lease has gone.
+
+        Expiry times come from each host's clock, so the hosts' clocks
+        should be kept in step.
+    """
+
+    def __init__(self, dao, owner, lease):
+        self.dao = dao
+        self.owner = owner
+        self.lease = lease
+        # the (_rev, expiry) of the claims we hold, so we can renew and
+        # delete them
+        self.held = {}
+
+    def claim_id(self, queue_name, item_id):
+        return "%s%s:%s" % (CLAIM_ID_PREFIX, queue_name, item_id)
+
+    def claim_doc(self, queue_name, item_id, now):
+        return {
+            "id": self.claim_id(queue_name, item_id),
+            "type": "queue_claim",
+            "owner": self.owner,
+            "expires": now + self.lease
+        }
+
+    def claim(self, queue_name, item_id):
+        '''returns True if we got the claim, False if someone else has it'''
+        now = time.time()
+        (rev, expires) = self.held.get((queue_name, item_id), (None, 0))
+        if expires > now:
+            # another of our workers has it
+            return False
+
+        doc = self.claim_doc(queue_name, item_id, now)
+        try:
+            (id, rev) = self.dao.save(doc)
+        except couchdb.ResourceConflict:
+            # someone has claimed it already; see if their lease is up
+            current = self.dao.get(doc["id"])
+            if current is None or current["expires"] > time.time():
+                return False
+
+            logger.info("taking over expired claim %s from %s" % (
+                doc["id"], current["owner"]))
+            doc["_rev"] = current["_rev"]
+            try:
+                (id, rev) = self.dao.save(doc)
+            except couchdb.ResourceConflict:
+                # someone else took it over first
+                return False
+
+        self.held[(queue_name, item_id)] = (rev, doc["expires"])
+        return True
+
+    def renew(self, queue_name, item_id):
+        '''Extends a claim we hold by another lease, if half of it has gone.
+
+        returns False if we've lost the claim: our lease ran out and someone
+        else took it over'''
+        now = time.time()
+        (rev, expires) = self.held.get((queue_name, item_id), (None, 0))
+        if rev is None:
+            return False
+        if expires - now > self.lease / 2.0:
+            return True
+
+        doc = self.claim_doc(queue_name, item_id, now)
+        doc["_rev"] = rev
+        try:
+            (id, rev) = self.dao.save(doc)
+        except couchdb.ResourceConflict:
+            logger.info("lost claim %s" % doc["id"])
+            self.held.pop((queue_name, item_id), None)
+            return False
+        self.held[(queue_name, item_id)] = (rev, doc["expires"])
+        return True
+
+    def release(self, queue_name, item_id):
+        (rev, expires) = self.held.pop((queue_name, item_id), (None, 0))
+        if rev is None:
+            return
+        doc = {"_id": self.claim_id(queue_name, item_id), "_rev": rev}
+        for (success, docid, rev_or_exc) in self.dao.bulk_delete([doc]):
+            if not success:
+                # someone took it over after our lease ran out
+                logger.info("couldn't release claim %s: %s" % (docid, rev_or_exc))
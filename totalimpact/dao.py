@@ -5,6 +5,22 @@ from totalimpact import default_settings
 # set up logging
 logger = logging.getLogger(__name__)
 
+def view_rows(dao, viewname, page_size, **params):
+    '''Generates the rows of a view, reading page_size rows at a time, so
+    callers that stop early don't read the whole view'''
+    params["limit"] = page_size + 1
+    while True:
+        rows = dao.view(viewname, **params)["rows"]
+        for row in rows[:page_size]:
+            yield row
+
+        if len(rows) <= page_size:
+            return
+        # the next page starts from the row we read one past this page
+        params["startkey"] = rows[page_size]["key"]
+        params["startkey_docid"] = rows[page_size]["id"]
+
+
 class Dao(object):
 
     def __init__(self, db_name=None, db_url=None, db_username=None, db_password=None):
@@ -14,6 +30,8 @@ class Dao(object):
         self.db_username = db_username if db_username != None else default_settings.DB_USERNAME
         self.db_password = db_password if db_password != None else default_settings.DB_PASSWORD
         
+        # the server's session keeps a thread-safe pool of keep-alive
+        # connections, so one Dao can be shared by all the threads in a process
         self.couch = couchdb.Server( url = self.db_url )
         if self.db_username:
             self.couch.resource.credentials = ( 
@@ -56,21 +74,42 @@ class Dao(object):
     def delete_db(self, db_name):
         self.couch.delete(db_name);
 
-    def create_db(self, db_name):
-        '''makes a new database with the given name.
-        uploads couch views stored in the config directory'''
+    def make_design_doc(self):
+        '''makes the design doc with the couch views and _changes filters
+        stored in the config directory'''
         view = {
                     "_id": "_design/queues",
                     "language": "javascript",
                     "views": {
                         "metrics": {},
                         "aliases": {},
-                        "by_alias": {}
-                        } 
+                        "by_alias": {},
+                        "snapshots": {},
+                        "refresh": {},
+                        "legacy_items": {},
+                        # the queue views again, with their rows counted,
+                        # for GET /queues. They share the queue views' index.
+                        "aliases_depth": {"reduce": "_count"},
+                        "metrics_depth": {"reduce": "_count"}
+                        },
+                    "filters": {
+                        "items": None
+                        }
                     }
         for view_name in view["views"]:
-            file = open('./config/couch/views/{0}.js'.format(view_name))
+            # the _depth views have the map of the view they count
+            map_name = view_name.replace("_depth", "")
+            file = open('./config/couch/views/{0}.js'.format(map_name))
             view["views"][view_name]["map"] = file.read()
+        for filter_name in view["filters"]:
+            file = open('./config/couch/filters/{0}.js'.format(filter_name))
+            view["filters"][filter_name] = file.read()
+        return view
+
+    def create_db(self, db_name):
+        '''makes a new database with the given name.
+        uploads couch views stored in the config directory'''
+        view = self.make_design_doc()
 
         try:
             self.db = self.couch.create(db_name)
@@ -80,6 +119,22 @@ class Dao(object):
         self.db.save( view )
         return True
 
+    def update_views(self):
+        '''uploads the couch views and filters from the config directory if
+        they differ from the ones in the db, so dbs made before a view was
+        added or changed get it too.
+
+        returns True if the views were updated'''
+        view = self.make_design_doc()
+        current = self.db.get(view["_id"])
+        if current is not None:
+            if (current.get("views") == view["views"] and
+                    current.get("filters") == view["filters"]):
+                return False
+            view["_rev"] = current["_rev"]
+        self.db.save( view )
+        return True
+
     @property
     def json(self):
         return json.dumps(self.data, sort_keys=True, indent=4)
@@ -90,6 +145,73 @@ class Dao(object):
         else:
             return None
 
+    def get_rev(self, _id):
+        """ returns the current _rev of a doc, or None if it isn't in the db
+
+            Only makes a HEAD request, so the doc itself isn't read.
+        """
+        if not _id:
+            return None
+        try:
+            (status, headers, data) = self.db.resource.head(_id)
+        except couchdb.ResourceNotFound:
+            return None
+        return headers["etag"].strip('"')
+
+    def get_update_seq(self):
+        """ returns the db's current update sequence, for wait_for_change """
+        return self.db.info()["update_seq"]
+
+    def wait_for_change(self, _id, since, timeout):
+        """ waits for a doc to change after the update sequence since
+
+            Makes a single longpoll request to the _changes feed, filtered to
+            the one doc, so couch holds it open until the doc changes or
+            timeout seconds pass.
+
+            returns True if the doc changed, False if we timed out
+        """
+        (status, headers, result) = self.db.resource.post_json('_changes',
+            body={"doc_ids": [_id]},
+            feed="longpoll",
+            filter="_doc_ids",
+            since=since,
+            timeout=int(timeout * 1000))
+        return len(result["results"]) > 0
+
+    def changes(self, since, timeout, filter=None):
+        """ gets the docs changed after the update sequence since
+
+            Makes a single longpoll request to the _changes feed, so if
+            nothing has changed yet couch holds it open until something does
+            or timeout seconds pass. filter is the name of a filter in the
+            design doc, like "queues/items".
+
+            returns (docs, last_seq); pass last_seq as since next time
+        """
+        params = {
+            "feed": "longpoll",
+            "since": since,
+            "timeout": int(timeout * 1000),
+            "include_docs": "true"
+            }
+        if filter:
+            params["filter"] = filter
+        (status, headers, result) = self.db.resource.get_json('_changes', **params)
+        return ([row["doc"] for row in result["results"] if "doc" in row],
+            result["last_seq"])
+
+    def get_bulk(self, ids):
+        """ gets many docs with a single _all_docs request
+
+            returns a list of docs in the same order as ids, with None for
+            any that aren't in the db
+        """
+        if not ids:
+            return []
+        res = self.view('_all_docs', include_docs=True, keys=ids)
+        return [row.get("doc") for row in res["rows"]]
+
     def save(self, doc):
         """ returns (id, rev) tuple of the save document
             raises exceptions on failure """
@@ -101,6 +223,31 @@ class Dao(object):
         self.db.commit()
         return ret
 
+    def bulk_save(self, docs, chunk_size=500):
+        """ saves a list of docs with one _bulk_docs request per chunk_size docs
+
+            returns a list of (success, id, rev_or_exception) tuples, in the
+            same order as docs. Doesn't raise on a failed doc; check success.
+        """
+        for doc in docs:
+            doc["_id"] = doc["id"]
+
+        ret = []
+        for start in range(0, len(docs), chunk_size):
+            ret += self.db.update(docs[start:start + chunk_size])
+        return ret
+
+    def bulk_delete(self, docs):
+        """ deletes a list of docs, each with its _id and _rev, with a single
+            _bulk_docs request
+
+            returns a list of (success, id, rev_or_exception) tuples
+        """
+        if not docs:
+            return []
+        return self.db.update([{"_id": doc["_id"], "_rev": doc["_rev"], "_deleted": True}
+            for doc in docs])
+
 
     def query(self,**kwargs):
         # pass queries through to couchdb, as per couchdb-python query
@@ -108,24 +255,31 @@ class Dao(object):
         return self.db.query(**kwargs)
         
     def view(self, viewname, **kwargs):
-        # error with couchdb view whenever there are params, so doing direct
-        #return self.db.view(viewname, kwargs)
-        import httplib
-        import urllib
-        host = str(self.db_url).rstrip('/').replace('http://','')
+        # couchdb-python's db.view() doesn't encode our params the way couch
+        # wants them, so we json-encode them and query the view resource
+        # directly. This still goes through the server's session, so reuses
+        # its pool of keep-alive connections.
         if viewname == '_all_docs':
-            fullpath = '/' + self.db_name + '/' + viewname
+            resource = self.db.resource(viewname)
         else:
-            fullpath = '/' + self.db_name + '/_design/queues/_view/' + viewname.replace('queues/','') + '?'
-        for key,val in kwargs.iteritems():
-            if not fullpath.endswith('&'): fullpath += '&'
-            fullpath += key + '=' + urllib.quote_plus(json.dumps(val))
-        c =  httplib.HTTPConnection(host)
-        c.request('GET', fullpath)
-        result = c.getresponse()
-        result_json = json.loads(result.read())
-
-        if (u'reason', u'missing_named_view') in result_json.items():
+            resource = self.db.resource('_design', 'queues', '_view', viewname.replace('queues/',''))
+
+        # a list of keys can be too long for a url, so it goes in a POST body
+        keys = kwargs.pop("keys", None)
+        params = dict([(key, json.dumps(val)) for (key, val) in kwargs.iteritems()])
+
+        # except doc ids, which couch wants as they are
+        for key in ["startkey_docid", "endkey_docid"]:
+            if key in kwargs:
+                params[key] = kwargs[key]
+
+        try:
+            if keys is None:
+                (status, headers, result_json) = resource.get_json(**params)
+            else:
+                (status, headers, result_json) = resource.post_json(body={"keys": keys}, **params)
+        except couchdb.ResourceNotFound:
+            # missing_named_view
             raise LookupError
 
         return result_json
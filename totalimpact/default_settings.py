@@ -242,10 +242,141 @@ PROVIDERS = {
     }
 }
 
+# How many alias worker threads the backend runs (each provider's metrics
+# workers are set in PROVIDERS). Started with --gevent, the backend runs its
+# workers as greenlets, which are cheap enough to have hundreds of; each
+# provider's workers is then how many requests it can have in flight.
 ALIASES = {
     "workers" : 10
 }
 
+# Most items that can be asked for in one GET /items/:tiid,:tiid,... request
+MAX_ITEMS_PER_GET = 100
+
+# In-process alias -> tiid index used by the API for alias lookups. When
+# disabled, each lookup is a keyed query on the by_alias view. max_age is
+# how many seconds the index is used before being reloaded from the view;
+# the reload runs in the background, and lookups use the old index (or,
+# before the first load, keyed queries) until it's done.
+ALIAS_INDEX = {
+    "enabled" : False,
+    "max_age" : 600
+}
+
+# How JSON responses are written. "pretty" is indented with sorted keys, and
+# is easy to read; "compact" has no whitespace and is much smaller for items
+# with long metric histories. Clients can choose per request with
+# ?json=compact or ?json=pretty, or with an Accept header like
+# "application/json; style=compact".
+JSON_STYLE = "pretty"
+
+# gzip responses for clients that send "Accept-Encoding: gzip". Responses
+# smaller than min_size bytes aren't worth it and are sent as they are.
+GZIP = {
+    "enabled" : True,
+    "min_size" : 500,
+    "level" : 6
+}
+
+# Clients can long-poll for changes to an item or collection with
+# GET /item/:tiid?wait=:seconds and an If-None-Match of the etag they have.
+# This is the most seconds a request will be held open for.
+LONG_POLL = {
+    "max_wait" : 60
+}
+
+# How long metric snapshots are kept. All the snapshots from the last
+# keep_all_days are kept. Older than that, only the newest snapshot of each
+# day is kept, and older than keep_daily_days, only the newest of each
+# month. Failed refreshes (where every value is None) aren't kept past
+# keep_all_days. The backend compacts the db every interval seconds, page_size
+# docs at a time.
+METRICS_RETENTION = {
+    "enabled" : True,
+    "keep_all_days" : 30,
+    "keep_daily_days" : 365,
+    "interval" : 86400,
+    "page_size" : 500
+}
+
+# The backend refreshes the metrics of items people are looking at. A
+# provider's metrics on an item are refreshed every refresh_interval seconds
+# (which can be set per provider, with "refresh_interval" in PROVIDERS),
+# stretched out the longer their values have stayed the same, up to
+# max_backoff times. Items nobody has requested or viewed in idle_days
+# aren't refreshed. The API keeps the views it sees in memory and writes
+# them out (to a view doc per item) every view_flush_interval seconds,
+# rewriting an item's view doc at most every view_resolution seconds. The
+# backend looks for items due a refresh every interval seconds, reading the
+# items whose metrics are older than their refresh_interval page_size at a
+# time, and asks for refreshes in a refresh request doc per item.
+METRICS_REFRESH = {
+    "enabled" : True,
+    "refresh_interval" : 86400,
+    "max_backoff" : 8,
+    "idle_days" : 30,
+    "view_resolution" : 3600,
+    "view_flush_interval" : 60,
+    "interval" : 3600,
+    "page_size" : 500
+}
+
+# The backend follows the db's _changes feed to find the items that need
+# their aliases or metrics updating, and hands them to the worker threads,
+# rather than every worker polling the queue views. Each request to the feed
+# is held open for up to timeout seconds while nothing changes; stopping the
+# backend can wait that long. Set enabled to False to poll the views instead.
+QUEUE_FEED = {
+    "enabled" : True,
+    "timeout" : 10
+}
+
+# Each worker thread claims up to size items from its queue at a time, all
+# from the same priority lane, rather than going back to the queue for each
+# one. The items are read from the db together and worked on one after another,
+# and a worker gives back the rest of a batch if items in a more urgent lane
+# come in.
+QUEUE_BATCH = {
+    "size" : 10
+}
+
+# GET /queues reports how many items are waiting in each queue and how long
+# the oldest has waited, from the queue views (counted by their _depth
+# views), and what the backend processes have got done: items taken off each
+# queue, and each provider's successes, errors and latency. Each backend
+# process saves its counts to the db every interval seconds; ones not saved
+# in max_age seconds are taken to be from processes that have stopped.
+QUEUE_STATS = {
+    "enabled" : True,
+    "interval" : 60,
+    "max_age" : 300
+}
+
+# Items are worked on in two priority lanes: "interactive" for items someone
+# is waiting on, and "bulk" for big imports and scheduled refreshes. When
+# both lanes have items waiting, the workers take them in proportion to the
+# lanes' weights, so a big import doesn't hold up interactive items but still
+# gets done. Items made with POST /item, or with POST /items of up to
+# bulk_threshold aliases, are interactive; either can be given ?priority=bulk
+# or ?priority=interactive to say otherwise.
+QUEUE_LANES = {
+    "weights" : {"interactive" : 8, "bulk" : 1},
+    "bulk_threshold" : 100
+}
+
+# Backend workers claim an item before working on it, so that several
+# backend processes can share the queues without doing an item twice.
+# Claims are kept in the db ("couch"), or in memory ("local", which is only
+# right for a single backend process). A claim lasts lease seconds; if its
+# worker hasn't finished the item by then (say it crashed), the item goes
+# back on the queue. Make it longer than an item can take, retries included.
+# Workers renew the claims on the rest of a batch between items, so the
+# lease doesn't have to cover a whole batch.
+QUEUE_CLAIMS = {
+    "store" : "couch",
+    "lease" : 1800
+}
+
 
 # used by the class-loader to explore alternative paths from which to load
 # classes depending on the context in which the configuration is used
@@ -0,0 +1,113 @@
+import atexit, threading, time
+from totalimpact.dao import view_rows
+from totalimpact.tilogging import logging
+
+# set up logging
+logger = logging.getLogger(__name__)
+
+VIEW_ID_PREFIX = "view:"
+
+
+def view_doc_id(tiid):
+    return VIEW_ID_PREFIX + tiid
+
+def view_doc(tiid, last_viewed=0):
+    return {"id": view_doc_id(tiid), "type": "item_views", "tiid": tiid,
+        "last_viewed": last_viewed}
+
+def last_viewed_times(dao, page_size):
+    '''Reads when each item was last viewed, from the view docs.
+
+    returns a dict of tiid -> last_viewed'''
+    ret = {}
+    for row in view_rows(dao, '_all_docs', page_size, include_docs=True,
+            startkey=VIEW_ID_PREFIX, endkey=VIEW_ID_PREFIX + u"\ufff0"):
+        ret[row["doc"]["tiid"]] = row["doc"]["last_viewed"]
+    return ret
+
+
+class ViewRecorder(object):
+    """ Records when items are viewed through the API, for the refresh
+        scheduler.
+
+        Views are kept in memory and written out every flush_interval
+        seconds by a background thread (see start), so reading an item never
+        waits on a write; whatever is left is written out when the process
+        exits. They go in a view:<tiid> doc per item rather than in the
+        item, so they don't conflict with the backend's saves of the item,
+        or wake up clients long-polling on it. An item's view doc is only
+        rewritten if it is more than resolution seconds old.
+    """
+
+    def __init__(self, dao, resolution, flush_interval=60):
+        self.dao = dao
+        self.resolution = resolution
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        # tiid -> when it was last viewed, since we last flushed
+        self.pending = {}
+        # the thread flushing the views, once we've started, and the event
+        # that tells it to stop
+        self.flusher = None
+        self.stopping = threading.Event()
+
+    def record(self, tiids, now=None):
+        if now is None:
+            now = time.time()
+        self.lock.acquire()
+        for tiid in tiids:
+            self.pending[tiid] = now
+        self.lock.release()
+
+    def flush(self):
+        '''Writes out the views recorded since the last flush.
+
+        returns the number of view docs written'''
+        self.lock.acquire()
+        (pending, self.pending) = (self.pending, {})
+        self.lock.release()
+        if not pending:
+            return 0
+
+        tiids = pending.keys()
+        docs = []
+        for (tiid, doc) in zip(tiids, self.dao.get_bulk([view_doc_id(tiid) for tiid in tiids])):
+            if doc is None:
+                doc = view_doc(tiid)
+            if pending[tiid] - doc["last_viewed"] >= self.resolution:
+                doc["last_viewed"] = pending[tiid]
+                docs.append(doc)
+
+        written = 0
+        for (success, docid, rev_or_exc) in self.dao.bulk_save(docs):
+            if success:
+                written += 1
+            else:
+                # another API process just recorded a view of it
+                logger.debug("couldn't record view of %s: %s" % (docid, rev_or_exc))
+        return written
+
+    def start(self):
+        '''Starts flushing every flush_interval seconds in a background
+        thread, and flushes whatever is left when the process exits'''
+        self.flusher = threading.Thread(target=self.run_flusher)
+        self.flusher.daemon = True
+        self.flusher.start()
+        atexit.register(self.stop)
+
+    def stop(self):
+        '''Stops the background thread, and writes out the views left'''
+        self.stopping.set()
+        if self.flusher is not None:
+            self.flusher.join()
+        self.run_flush()
+
+    def run_flusher(self):
+        while not self.stopping.wait(self.flush_interval):
+            self.run_flush()
+
+    def run_flush(self):
+        try:
+            self.flush()
+        except Exception, e:
+            logger.error("couldn't record item views: %s" % e)
@@ -1,8 +1,10 @@
 from werkzeug import generate_password_hash, check_password_hash
 import totalimpact.dao as dao
+from totalimpact.dao import view_rows
 from totalimpact import default_settings
-from totalimpact.providers.provider import ProviderFactory
+from totalimpact.providers.provider import ProviderFactory, ProviderError
 import time, uuid, json, hashlib, inspect, re, copy, string, random
+import couchdb
 
 import threading
 from pprint import pprint
@@ -23,6 +25,9 @@ def todict(obj, classkey=None, ignore=None):
         for k in obj.keys():
             obj[k] = todict(obj[k], classkey, ignore)
         return obj
+    elif isinstance(obj, Aliases):
+        # has __slots__, not a __dict__
+        return obj.as_dict()
     elif hasattr(obj, "__iter__"):
         return [todict(v, classkey) for v in obj]
     elif hasattr(obj, "__dict__"):
@@ -37,24 +42,51 @@ def todict(obj, classkey=None, ignore=None):
         return obj
 
 class GlobalItemLock:
+    """ Per-item write locks, striped over a fixed number of locks
 
-    def __init__(self):
-        self.lock = threading.Lock()
-        self.itemLock = {}
+        Each item id hashes to one of the stripes, so memory stays the same
+        however many items we see, and getting a lock doesn't go through a
+        master lock. Items that share a stripe just take turns saving.
+        Only hold one item's lock at a time, or two items on the same
+        stripe will deadlock.
+    """
+
+    def __init__(self, stripes=1024):
+        self.stripes = [threading.Lock() for i in range(stripes)]
 
     def getItemLock(self, item_id):
-        self.lock.acquire()
-        if not self.itemLock.has_key(item_id):
-            self.itemLock[item_id] = threading.Lock()
-        self.lock.release()
-        return self.itemLock[item_id]
+        return self.stripes[hash(item_id) % len(self.stripes)]
  
 
 itemlock = GlobalItemLock()
 
 
+def snapshot_time(ts):
+    '''Returns the time of a metric value's ts key as a float, or 0 if it
+    isn't a number'''
+    try:
+        return float(ts)
+    except ValueError:
+        return 0
+
+
+def serialise_aliases(aliases):
+    if isinstance(aliases, dict):
+        # an item loaded without its aliases; see ItemFactory.get_from_doc
+        return aliases
+    return aliases.as_dict()
+
+
 class Saveable(object):
 
+    # how many times save() will merge and retry after a conflict
+    save_retries = 5
+
+    # The attributes that go in the db doc, with the function that
+    # serialises each, or None for plain json values (strings, numbers, and
+    # lists and dicts of them) which go in the doc as they are.
+    doc_fields = {"id": None}
+
     def __init__(self, dao, id=None):
         self.dao = dao
 
@@ -64,11 +96,28 @@ class Saveable(object):
             self.id = id
 
     def as_dict(self, obj=None, classkey=None):
-        ''' Recursively convert this object's members into a dictionary structure for 
+        ''' Convert this object's members into a dictionary structure for 
             serialisation to the database.
+
+            Members in doc_fields are serialised as it says, so plain json
+            like the metric histories isn't walked through at all. Anything
+            else (like extra fields from an older doc) falls back to the
+            recursive todict().
         '''
-        start_time = time.time()
-        dict_repr = todict(self,ignore=['dao'])
+        dict_repr = {}
+        for key, value in self.__dict__.iteritems():
+            if key.startswith('_') or key == 'dao':
+                continue
+            try:
+                serialise = self.doc_fields[key]
+            except KeyError:
+                if not callable(value):
+                    dict_repr[key] = todict(value, ignore=['dao'])
+                continue
+            if serialise is None:
+                dict_repr[key] = value
+            else:
+                dict_repr[key] = serialise(value)
         return dict_repr
 
     def _update_dict(self, input, my_dict=None):
@@ -101,31 +150,44 @@ class Saveable(object):
 
     def save(self):
         """ Save the object to the database, handling merging of data 
-            should the object have already been updated elsewhere """
-        # Blocking call to acquire a lock for this section
-        retry = True
-        import couchdb
-
+            should the object have already been updated elsewhere
+
+            We write with the _rev the object was loaded at (none for a new
+            object), so usually a save doesn't need to read from the db at
+            all. Only if couch says the doc has changed since we loaded it
+            do we read it, merge it with _update_dict and write again, up to
+            save_retries times before giving up with the ResourceConflict.
+        """
         # Get the lock for this item for write
         lock = itemlock.getItemLock(self.id)
         lock.acquire()
-        while retry:
-            try:
-                # Find the current state of the item in the database
-                # which we will update
-                new_dict = self.dao.get(self.id)
-                dict_to_save = self._update_dict(new_dict)
-                # If we are updating an object, then we should
-                # set _rev from the object we have just read so
-                # we don't get conflict errors on commit.
-                if new_dict:
-                    dict_to_save['_rev'] = new_dict['_rev']
-                res = self.dao.save_and_commit(dict_to_save)
-                retry = False
-            except couchdb.ResourceConflict, e:
-                logger.info("Couch conflict, will retry")
-        lock.release()
-
+        try:
+            dict_to_save = self.as_dict()
+            rev = getattr(self, "_rev", None)
+            tries = 0
+            while True:
+                if rev:
+                    dict_to_save['_rev'] = rev
+                try:
+                    res = self.dao.save_and_commit(dict_to_save)
+                    break
+                except couchdb.ResourceConflict, e:
+                    tries += 1
+                    if tries > self.save_retries:
+                        logger.error("Couch conflict saving %s, giving up" % self.id)
+                        raise
+                    logger.info("Couch conflict, will merge and retry")
+
+                    # Find the current state of the item in the database
+                    # and merge our changes into it
+                    new_dict = self.dao.get(self.id)
+                    dict_to_save = self._update_dict(new_dict)
+                    rev = new_dict['_rev'] if new_dict else None
+        finally:
+            lock.release()
+
+        # so we can save again without conflicting with ourselves
+        self._rev = res[1]
         return res
 
     def delete(self):
@@ -134,7 +196,17 @@ class Saveable(object):
 
 
 class Item(Saveable):
-    pass
+
+    doc_fields = {
+        "id": None,
+        "created": None,
+        "last_modified": None,
+        "last_requested": None,
+        "aliases": serialise_aliases,
+        "biblio": None,
+        "metrics": None,
+        "priority": None
+    }
 
 
 class ItemFactory():
@@ -142,15 +214,46 @@ class ItemFactory():
 
     item_class = Item
 
+    # how many snapshots get_metrics_history reads per view query
+    history_page_size = 1000
+
     @classmethod
-    def get(cls, dao, id, provider_maker, providers_config):
-        now = time.time()
+    def get(cls, dao, id, providers_config, fields=None):
         item_doc = dao.get(id)
-        item = cls.item_class(dao, id=id)
 
         if item_doc is None:
             raise LookupError
 
+        return cls.get_from_doc(dao, item_doc, providers_config, fields)
+
+    @classmethod
+    def get_many(cls, dao, ids, providers_config, fields=None):
+        '''Like get, but loads all the items with a single db request.
+
+        returns a list of items in the same order as ids. Raises LookupError
+        if any of them aren't in the db.'''
+        item_docs = dao.get_bulk(ids)
+
+        if None in item_docs:
+            raise LookupError
+
+        return [cls.get_from_doc(dao, item_doc, providers_config, fields)
+            for item_doc in item_docs]
+
+    @classmethod
+    def get_from_doc(cls, dao, item_doc, providers_config, fields=None):
+        '''Makes an item from a doc already read from the db
+
+        fields lets callers that only use part of the item skip making the
+        rest. None makes everything; otherwise it is a list of:
+            "aliases"           make item.aliases an Aliases obj
+            "metrics"           fill in every metric in the config
+            "metrics:provider"  fill in just that provider's metrics
+        Anything not asked for is left as it is in the doc, so saving the
+        item still writes the whole doc back.'''
+        now = time.time()
+        item = cls.item_class(dao, id=item_doc["_id"])
+
         item.last_requested = now
 
         # first, just copy everything from the item_doc the DB gave us
@@ -158,44 +261,175 @@ class ItemFactory():
             if k not in ["_id", "_rev"]:
                 setattr(item, k, item_doc[k])
 
+        # keep the revision we read; as_dict leaves it out, as it starts with _
+        item._rev = item_doc.get("_rev")
+
         # the aliases property needs to be an Aliases obj, not a dict.
-        item.aliases = Aliases(seed=item_doc['aliases'])
+        if fields is None or "aliases" in fields:
+            item.aliases = Aliases(seed=item_doc['aliases'])
 
         # make the Metric objects. We have to make keys for each metric in the config
         # so that Providers will know which metrics to update later on.
         # Then we fill these Metric objects's dictionaries with the metricSnaps
         # from the db.
 
-        item.metrics = {}
-        metric_names = cls.get_metric_names(providers_config)
-        for full_metric_name in metric_names:
-            try:
-                my_metric = item_doc["metrics"][full_metric_name]
-            except KeyError: #this metric ain't in the item_doc from the db
-                my_metric = {'values': {} }
-            
+        if fields is None or "metrics" in fields:
+            item.metrics = {}
+            provider_names = providers_config.keys()
+        else:
+            item.metrics = dict(item_doc.get("metrics", {}))
+            provider_names = [field.split(":", 1)[1] for field in fields
+                if field.startswith("metrics:")]
+
+        for provider_name in provider_names:
+            for metric_name in providers_config[provider_name]["metrics"]:
+                full_metric_name = provider_name + ":" + metric_name
+                try:
+                    my_metric = item_doc["metrics"][full_metric_name]
+                except KeyError: #this metric ain't in the item_doc from the db
+                    my_metric = {'values': {} }
+
+                # the provenance url is stored by the backend once it has the
+                # item's aliases (see update_provenance_urls), as working it out
+                # can mean calling the provider.
+                provenance_url = my_metric.setdefault("provenance_url", None)
+
+                # populate the static_meta only if it has a provenance url
+                if provenance_url:
+                    metric_static_meta = providers_config[provider_name]["metrics"][metric_name]["static_meta"]
+                    my_metric["static_meta"] = metric_static_meta
+                else:
+                    my_metric["static_meta"] = {}
+
+                item.metrics[full_metric_name] = my_metric
+
+        return item
+
+    @classmethod
+    def update_provenance_urls(cls, item, providers):
+        '''Works out the provenance url of each of the item's metrics from its
+        current aliases, and stores it in the metric.
+
+        This can make http calls to the providers, so it is done when the
+        item's aliases are updated rather than every time the item is read.
+        If a provider fails, that provider's metrics get no provenance url.'''
+        aliases_list = item.aliases.get_aliases_list()
+        providers_by_name = dict([(provider.provider_name, provider) for provider in providers])
+
+        for full_metric_name, metric in item.metrics.iteritems():
             (provider_name, metric_name) = full_metric_name.split(":")
+            try:
+                provider = providers_by_name[provider_name]
+            except KeyError:
+                # not a provider we're running
+                continue
 
-            # make the provenance url
-            # FIXME problem if alias needed for provenance url not obtained yet?
-            aliases_list = item.aliases.get_aliases_list()
-            provider = provider_maker(provider_name)
+            try:
+                metric["provenance_url"] = provider.provenance_url(metric_name, aliases_list)
+            except ProviderError, e:
+                logger.info("couldn't get provenance url for %s on item %s: %s" % (
+                    full_metric_name, item.id, e))
+                metric["provenance_url"] = None
 
-            provenance_url = provider.provenance_url(metric_name, aliases_list)
-            my_metric["provenance_url"] = provenance_url
+    @classmethod
+    def snapshot_doc(cls, tiid, provider_name, ts, values):
+        '''Makes the doc for a snapshot of one provider's metrics on an item.
+
+        The id is made from the tiid, provider and time, so saving the same
+        snapshot twice just conflicts rather than making a duplicate.'''
+        return {
+            "id": "snapshot:%s:%s:%s" % (tiid, provider_name, ts),
+            "type": "metric_snapshot",
+            "tiid": tiid,
+            "provider": provider_name,
+            "ts": ts,
+            "values": values
+        }
 
-            # populate the static_meta only if it has a provenance url
-            if provenance_url:
-                metric_static_meta = providers_config[provider_name]["metrics"][metric_name]["static_meta"]
-                my_metric["static_meta"] = metric_static_meta
+    @classmethod
+    def save_snapshots(cls, dao, tiid, provider_name, snapshots):
+        '''Saves snapshots of a provider's metrics on an item, with a single
+        db request. snapshots is a dict of ts -> {full metric name: value}.
+
+        Snapshots that are already saved just conflict and are skipped.'''
+        docs = [cls.snapshot_doc(tiid, provider_name, ts, values)
+            for (ts, values) in snapshots.iteritems()]
+        for (success, docid, rev_or_exc) in dao.bulk_save(docs):
+            if not success and not isinstance(rev_or_exc, couchdb.ResourceConflict):
+                logger.error("couldn't save metrics snapshot %s: %s" % (docid, rev_or_exc))
+
+    @classmethod
+    def add_metrics_snapshot(cls, dao, item, provider_name, values, ts):
+        '''Records a new snapshot of a provider's metrics on the item.
+
+        values is a dict of full metric name -> value. The snapshot is saved
+        as its own doc (append-only), and the item keeps only the latest
+        value of each metric, so item docs stay the same size however often
+        their metrics are refreshed. Use get_metrics_history for the rest.
+
+        Any older values still in the item (from before snapshots were
+        stored separately) are saved as snapshots too, in the same request.
+
+        Each metric's last_changed is set to ts if its value changed, so the
+        refresh scheduler can leave alone metrics that don't change much.
+        Save the item afterwards.'''
+        snapshots = {}
+        for metric_name in values:
+            for (old_ts, old_value) in item.metrics[metric_name]['values'].iteritems():
+                snapshots.setdefault(old_ts, {})[metric_name] = old_value
+        snapshots[ts] = values
+        cls.save_snapshots(dao, item.id, provider_name, snapshots)
+
+        for (metric_name, value) in values.iteritems():
+            metric = item.metrics[metric_name]
+            old_values = metric['values']
+            if old_values:
+                latest_ts = max(old_values, key=snapshot_time)
+                if old_values[latest_ts] == value:
+                    metric.setdefault('last_changed', latest_ts)
+                else:
+                    metric['last_changed'] = ts
             else:
-                my_metric["static_meta"] = {}
+                metric['last_changed'] = ts
+            metric['values'] = {ts: value}
 
+    @classmethod
+    def move_metrics_history(cls, dao, item):
+        '''Moves all but the latest value of each of the item's metrics out
+        to snapshot docs, for items saved before snapshots were stored
+        separately. Save the item afterwards.
+
+        returns True if there was anything to move'''
+        snapshots_by_provider = {}
+        for (metric_name, metric) in item.metrics.iteritems():
+            if len(metric['values']) < 2:
+                continue
+            provider_name = metric_name.split(":")[0]
+            snapshots = snapshots_by_provider.setdefault(provider_name, {})
+            for (ts, value) in metric['values'].iteritems():
+                snapshots.setdefault(ts, {})[metric_name] = value
+
+            latest_ts = max(metric['values'], key=snapshot_time)
+            metric['values'] = {latest_ts: metric['values'][latest_ts]}
+
+        for (provider_name, snapshots) in snapshots_by_provider.iteritems():
+            cls.save_snapshots(dao, item.id, provider_name, snapshots)
+        return len(snapshots_by_provider) > 0
 
-            item.metrics[full_metric_name] = my_metric
+    @classmethod
+    def get_metrics_history(cls, dao, tiid):
+        '''Loads all the snapshots of an item's metrics.
 
-        return item
+        The snapshots view is read history_page_size rows at a time, so an
+        item with a long history doesn't come back in one huge response.
 
+        returns a dict of full metric name -> {ts: value}'''
+        history = {}
+        for row in view_rows(dao, 'queues/snapshots', cls.history_page_size,
+                startkey=[tiid], endkey=[tiid, {}]):
+            (row_tiid, metric_name, ts) = row["key"]
+            history.setdefault(metric_name, {})[ts] = row["value"]
+        return history
 
     @classmethod
     def get_metric_names(self, providers_config):
@@ -207,9 +441,20 @@ class ItemFactory():
         return full_metric_names
 
     @classmethod
-    def make(cls, dao, providers_config):
+    def alias_tiid(cls, namespace, nid):
+        '''The tiid a new item made for this alias gets.
+
+        It's derived from the alias, so if two requests (in this process or
+        any other) both make an item for the same new alias, couch takes the
+        first save and gives the other a conflict, instead of us ending up
+        with two items.'''
+        alias = u"%s:%s" % (namespace, nid)
+        return hashlib.md5(alias.encode("utf-8")).hexdigest()
+
+    @classmethod
+    def make(cls, dao, providers_config, id=None):
         now = time.time()
-        item = cls.item_class(dao=dao)
+        item = cls.item_class(dao=dao, id=id)
         
         # make all the top-level stuff
         item.aliases = Aliases()
@@ -237,7 +482,14 @@ class Error(Saveable):
         "id": "uuid4-goes-here",
         "stack_trace": "Python Stacktrace"
     }"""
-    pass
+
+    doc_fields = {
+        "id": None,
+        "error_type": None,
+        "message": None,
+        "provider": None,
+        "stack_trace": None
+    }
 
 class CollectionFactory():
 
@@ -288,6 +540,16 @@ class Collection(Saveable):
         "item_tiids": ["abcd3", "abcd4"]
     }
     """
+
+    doc_fields = {
+        "id": None,
+        "collection_name": None,
+        "title": None,
+        "owner": None,
+        "created": None,
+        "last_modified": None,
+        "item_tiids": None
+    }
         
     def item_ids(self):
         if not hasattr(self, "item_tiids"): 
@@ -346,6 +608,25 @@ class Biblio(object):
         return self.data
 
 
+class NamespaceIds(list):
+    """ The ids of one namespace of an Aliases, as got by attribute (eg
+        aliases.doi). It's a copy, so changing it can't change the aliases;
+        rather than have that silently do nothing, it can't be changed at
+        all. Use add_alias, or set the attribute to a new list.
+    """
+
+    def _read_only(self, *args, **kwargs):
+        raise TypeError("aliases can't be changed through their namespace list; use add_alias")
+
+    append = extend = insert = remove = pop = sort = reverse = _read_only
+    __setitem__ = __delitem__ = __setslice__ = __delslice__ = _read_only
+    __iadd__ = __imul__ = _read_only
+
+    def __reduce__(self):
+        # copies and pickles are plain lists
+        return (list, (list(self),))
+
+
 class Aliases(object):
     """
     {
@@ -359,11 +640,23 @@ class Aliases(object):
 
     note we're not keeping the TIID in here any more. it needs to be on the the
     item, since that's what it describes. having it in two places == bad.
+
+    Each namespace's ids are kept as a list (for their order) and in a set
+    of (namespace, id) tuples (for checking if we have an alias already).
+    The flattened list of all the aliases is cached until they change.
+    Namespaces can still be got and set as attributes, eg aliases.doi, but
+    what you get is read-only (see NamespaceIds).
     """
     
     not_aliases = ["created", "last_modified", "last_completed"]
+
+    __slots__ = ["created", "last_modified", "last_completed",
+        "_namespaces", "_alias_set", "_aliases_list"]
     
     def __init__(self, seed=None):
+        object.__setattr__(self, "_namespaces", {})
+        object.__setattr__(self, "_alias_set", set())
+        object.__setattr__(self, "_aliases_list", None)
         self.created = time.time() # will get overwritten if need be
         self.last_completed = None # will get set by the aliases worker once complete
         try:
@@ -372,19 +665,64 @@ class Aliases(object):
         except TypeError:
             pass
 
-    def add_alias(self, namespace, id):
+    def __getattr__(self, name):
+        # only called for names that aren't slots (or slots that aren't set)
+        if name in self.not_aliases or name.startswith("_"):
+            raise AttributeError(name)
         try:
-            attr = getattr(self, namespace)
-            attr.append(id)
-        except AttributeError:
-            setattr(self, namespace, [id])
+            return NamespaceIds(self._namespaces[name])
+        except KeyError:
+            raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        if name in self.__slots__:
+            object.__setattr__(self, name, value)
+        else:
+            self._set_namespace(name, value)
+
+    def __delattr__(self, name):
+        if name in self.__slots__:
+            object.__delattr__(self, name)
+        else:
+            self._set_namespace(name, [])
+
+    def __getstate__(self):
+        return self.as_dict()
+
+    def __setstate__(self, state):
+        self.__init__(seed=state)
+
+    def _set_namespace(self, namespace, ids):
+        # crazy hack TODO fix lists/strings flying about
+        if not hasattr(ids, "append"):
+            ids = [ids]
+
+        self._alias_set.difference_update(
+            [(namespace, id) for id in self._namespaces.get(namespace, [])])
+        if ids:
+            self._namespaces[namespace] = []
+            for id in ids:
+                self._add(namespace, id)
+        else:
+            self._namespaces.pop(namespace, None)
+        self._aliases_list = None
+
+    def _add(self, namespace, id):
+        if (namespace, id) in self._alias_set:
+            return False
+        self._alias_set.add((namespace, id))
+        self._namespaces.setdefault(namespace, []).append(id)
+        self._aliases_list = None
+        return True
+
+    def add_alias(self, namespace, id):
+        self._add(namespace, id)
         self.last_modified = time.time()
 
     #FIXME: this should take namespace and id, not a list of them
     def add_unique(self, alias_list):
         for ns, id in alias_list:
-            if id not in getattr(self, ns, []):
-                self.add_alias(ns, id)
+            self._add(ns, id)
         self.last_modified = time.time()
     
     def get_aliases_list(self, namespace_list=None): 
@@ -393,44 +731,48 @@ class Aliases(object):
         
         returns a list of (namespace, id) tuples
         '''
-        # if this is a get on everything, just summon up the items
+        # if this is a get on everything, use the cached list
         if namespace_list is None:
-            namespace_list = self.get_namespace_list()
+            if self._aliases_list is None:
+                self._aliases_list = self._get_aliases_list(self._namespaces.keys())
+            return list(self._aliases_list)
         
         # if the caller doesn't pass us a list, but just a single value, wrap it
         # up for them
         if not hasattr(namespace_list, "append"):
             namespace_list = [namespace_list]
         
-        # otherwise, get for the specific namespaces
+        return self._get_aliases_list(namespace_list)
+
+    def _get_aliases_list(self, namespace_list):
         ret = []
         for namespace in namespace_list:
-            try:
-                ids = getattr(self, namespace)
-            
-                # crazy hack TODO fix lists/strings flying about
-                if not hasattr(ids, "append"):
-                    ids = [ids]
-                ret += [(namespace, id) for id in ids]
-            except AttributeError:
-                # this alias doesn't have that namespace...no worries, move on.
-                pass
-
+            # if this alias doesn't have that namespace...no worries, move on.
+            ret += [(namespace, id) for id in self._namespaces.get(namespace, [])]
         return ret
 
     def get_namespace_list(self):
-        return [x for x in self.__dict__ if x not in self.not_aliases]
+        return self._namespaces.keys()
 
     def clear_aliases(self):
         # Wipe out the aliases and set last_modified. This should be used
         # when an alias update has failed, so that we can dequeue the item
         # without then going on to process metrics incorrectly.
-        for attr in self.get_namespace_list():
-            delattr(self, attr)
+        self._namespaces.clear()
+        self._alias_set.clear()
+        self._aliases_list = None
         self.last_modified = time.time()
 
-    # FIXME I don't think we need this any more?
     def as_dict(self):
-        return self.__dict__
+        # a new dict, so changes to the doc don't change these aliases
+        ret = {}
+        for name in self.not_aliases:
+            try:
+                ret[name] = getattr(self, name)
+            except AttributeError:
+                pass
+        for (namespace, ids) in self._namespaces.iteritems():
+            ret[namespace] = list(ids)
+        return ret
 
 
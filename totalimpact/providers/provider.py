@@ -9,21 +9,48 @@ logger = logging.getLogger(__name__)
 
 class ProviderFactory(object):
 
+    # Provider instances for this process, by name. Providers don't keep any
+    # per-item state, so one instance of each is shared by all the threads
+    # rather than importing and making a new one on every call.
+    registry = {}
+    registry_lock = threading.Lock()
+
     @classmethod
-    def get_provider(cls, provider_name):
+    def load_provider(cls, provider_name):
+        """ Imports and makes a new instance of the named provider """
         provider_module = importlib.import_module('totalimpact.providers.'+provider_name)
         provider = getattr(provider_module, provider_name.title())
         instance = provider()
+        instance.provider_name = provider_name
         return instance
 
+    @classmethod
+    def get_provider(cls, provider_name):
+        """ Returns the shared instance of the named provider, loading it
+            the first time it is asked for """
+        try:
+            return cls.registry[provider_name]
+        except KeyError:
+            pass
+
+        cls.registry_lock.acquire()
+        try:
+            if not cls.registry.has_key(provider_name):
+                cls.registry[provider_name] = cls.load_provider(provider_name)
+            return cls.registry[provider_name]
+        finally:
+            cls.registry_lock.release()
+
     @classmethod
     def get_providers(cls, config_providers):
-        """ config is the application configuration """
+        """ config is the application configuration 
+
+            Call this at startup to load all the providers into the registry
+        """
         providers = []
         for provider_name, v in config_providers.iteritems():
             try:
                 prov = ProviderFactory.get_provider(provider_name)
-                prov.provider_name = provider_name
                 providers.append(prov)
             except ProviderConfigurationError:
                 logger.error("Unable to configure provider ... skipping " + str(v))
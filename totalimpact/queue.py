@@ -1,7 +1,10 @@
 import time
+from collections import deque
 from totalimpact import default_settings
-from totalimpact.models import Item, ItemFactory
-from totalimpact.providers.provider import ProviderFactory
+from totalimpact.dao import view_rows
+from totalimpact.models import Item, ItemFactory, snapshot_time
+from totalimpact.claims import LocalClaims
+from totalimpact.refreshes import refresh_tiid, refresh_doc_id, pending_refreshes, complete_refresh
 
 from totalimpact.tilogging import logging
 log = logging.getLogger(__name__)
@@ -12,6 +15,16 @@ import threading
 # d = {"doi" : ["10.1371/journal.pcbi.1000361", "10.1016/j.meegid.2011.02.004"], "url" : ["http://cottagelabs.com"]}
 
 class Queue():
+
+    # set to a ReadyItems to take items pushed by the backend's dispatcher,
+    # rather than reading the queue views
+    ready_items = None
+
+    # how many seconds dequeue waits for a pushed item before returning None
+    push_wait = 0.5
+
+    # how many rows to read from the queue view at a time
+    page_size = 100
         
     # return next item from this queue (e.g. whatever is on the top of the list)
     # and remove the item from the queue in the process
@@ -31,90 +44,474 @@ class Queue():
     # to update their last_modified as appropriate.
     def save_and_unqueue(self, item):
         item.save()
+
+    def dequeue(self):
+        (lane, items) = self.dequeue_batch(1)
+        if items:
+            return items[0]
+        return None
+
+    def dequeue_batch(self, n):
+        '''Claims up to n items, all from the same priority lane, and loads
+        them all with one db request.
+
+        returns (lane, list of items), with a lane of None if there weren't
+        any to claim'''
+        (lane, item_ids) = self.claim_batch(n)
+        return (lane, self.load(item_ids))
+
+    def claim_batch(self, n):
+        '''Claims up to n items, all from the same priority lane.
+
+        returns (lane, list of ids), with a lane of None if there weren't
+        any to claim'''
+        if self.ready_items is not None:
+            return self.claim_pushed(n)
+        return self.claim_rows(n)
+
+    def claim_rows(self, n):
+        # the view is read a page at a time, until we've claimed n items. Its
+        # rows are sorted by lane, so we stop at the end of the first lane
+        lane = None
+        item_ids = []
+        for row in self.rows():
+            row_lane = LANES[self.row_lane(row)]
+            if lane is not None and row_lane != lane:
+                break
+            item_id = self.claim(row["id"])
+            if item_id is not None:
+                log.debug("found item %s" % item_id)
+                lane = row_lane
+                item_ids.append(item_id)
+                if len(item_ids) >= n:
+                    break
+        return (lane, item_ids)
+
+    def claim_pushed(self, n):
+        # wait for the first ids, then take whatever else is already queued
+        # in the same lane
+        (lane, pushed_ids) = self.ready_items.get_batch(self.queue_name, n, self.push_wait)
+        item_ids = []
+        for queued_id in pushed_ids:
+            item_id = self.claim(queued_id)
+            if item_id is not None:
+                item_ids.append(item_id)
+            else:
+                # another worker has it
+                self.ready_items.defer(self.queue_name, queued_id, self.claims.lease)
+        if not item_ids:
+            lane = None
+        return (lane, item_ids)
+
+    def claim(self, queued_id):
+        '''Claims the item a queue entry is for.
+
+        returns the item's id, or None if another worker has it'''
+        if self.claims.claim(self.queue_name, queued_id):
+            return queued_id
+        return None
+
+    def queued_id(self, item_id):
+        '''The id of the queue entry we claimed an item from'''
+        return item_id
+
+    def more_urgent_waiting(self, lane):
+        '''True if items in a more urgent lane than this one are waiting.
+        Only known for pushed items; we don't read the view to find out.'''
+        if self.ready_items is None:
+            return False
+        return sum([self.ready_items.qsize(self.queue_name, more_urgent)
+            for more_urgent in LANES[:LANES.index(lane)]]) > 0
+
+    def release(self, item_ids, lane):
+        '''Gives back claimed items we haven't started, for the next worker
+        (or us) to take in their turn'''
+        queued_ids = [self.queued_id(item_id) for item_id in item_ids]
+        for item_id in item_ids:
+            self.claims.release(self.queue_name, item_id)
+        if self.ready_items is not None:
+            self.ready_items.put_back(self.queue_name, queued_ids, lane)
+
+    def renew(self, item_ids):
+        '''Renews our claims on items we haven't started yet, so they don't
+        run out before we get to them.
+
+        returns the ids of the items we've lost the claims on, which someone
+        else is working on now'''
+        lost = []
+        for item_id in item_ids:
+            if not self.claims.renew(self.queue_name, item_id):
+                lost.append(item_id)
+                if self.ready_items is not None:
+                    self.ready_items.defer(self.queue_name, self.queued_id(item_id),
+                        self.claims.lease)
+                self.unqueue(item_id)
+        return lost
+
+    def load(self, item_ids):
+        items = []
+        for (item_id, item_doc) in zip(item_ids, self.dao.get_bulk(item_ids)):
+            if item_doc is None:
+                # it's been deleted since it was queued
+                self.unqueue(item_id)
+                continue
+            items.append(ItemFactory.get_from_doc(self.dao, 
+                          item_doc, 
+                          default_settings.PROVIDERS,
+                          fields=self.fields))
+        return items
+
+    def unqueue(self, item_id):
+        queued_id = self.queued_id(item_id)
+        self.claims.release(self.queue_name, item_id)
+        if self.ready_items is not None:
+            self.ready_items.done(self.queue_name, queued_id)
         
 
 ######################################################
 #
-# In-memory queue datastructures
+# Pushed queues
 #
-# These are used to track the which items in the couchdb views which we have
-# already seen, and avoid repeat processing of them. The aliases queue purely
-# stores itemid, whereas the metrics queue needs to store (itemid, provider)
-# as we do this on a per provider basis
-# 
+# Rather than every worker re-reading the queue views, the backend runs one
+# dispatcher that follows the db's _changes feed and offers each changed doc
+# to a ReadyItems. That works out which queues the item (or refresh request,
+# see refreshes.py) is ready for, the same way the queue views do, and the
+# workers take ids from it.
+#
+
+# The priority lanes items are worked on in, most urgent first: items
+# someone is waiting on, then imports and scheduled refreshes. The queue
+# views sort items by the position of their lane in this list.
+LANES = ["interactive", "bulk"]
+
+def item_lane(doc):
+    '''The lane an item's work goes in, from its priority. Items from before
+    there were lanes go in the bulk lane.'''
+    if doc.get("priority") in LANES:
+        return doc["priority"]
+    return "bulk"
+
+def needs_aliases(doc):
+    '''True if the queues/aliases view would list the doc'''
+    if not isinstance(doc.get("aliases"), dict) or "last_requested" not in doc:
+        return False
+    last_completed = doc["aliases"].get("last_completed")
+    return last_completed is None or last_completed < doc["last_requested"]
+
+def providers_needing_metrics(doc):
+    '''The providers the queues/metrics view would list the doc under'''
+    if not isinstance(doc.get("metrics"), dict) or not isinstance(doc.get("aliases"), dict):
+        return []
+    last_completed = doc["aliases"].get("last_completed")
+    if not last_completed:
+        return []
+
+    last_modified = {}
+    for (metric_name, metric) in doc["metrics"].iteritems():
+        if not metric.get("ignore"):
+            provider_name = metric_name.split(":")[0]
+            metric_modified = max([snapshot_time(ts) for ts in metric.get("values", {})] or [0])
+            last_modified[provider_name] = max(metric_modified, last_modified.get(provider_name, 0))
+
+    return [provider_name for (provider_name, modified) in last_modified.iteritems()
+        if modified < last_completed]
+
+
+class LaneQueue(object):
+    """ A thread-safe FIFO queue with a lane for each priority.
+
+        When more than one lane has items waiting, get() takes them in
+        proportion to the lanes' weights (weighted round robin): with weights
+        of 8 and 1, eight items from the first lane for each one from the
+        second. So a long backlog in one lane doesn't hold up the others,
+        and doesn't starve either.
+    """
+
+    def __init__(self, weights):
+        self.weights = weights
+        self.lanes = dict([(lane, deque()) for lane in weights])
+        self.credits = dict(weights)
+        self.cond = threading.Condition()
+
+    def put(self, item, lane):
+        self.cond.acquire()
+        self.lanes[lane].append(item)
+        self.cond.notify()
+        self.cond.release()
+
+    def get(self, timeout):
+        '''Takes the next item, waiting up to timeout seconds.
+
+        returns None if nothing was put in that time'''
+        end = time.time() + timeout
+        self.cond.acquire()
+        try:
+            while True:
+                lane = self.next_lane()
+                if lane is not None:
+                    self.credits[lane] -= 1
+                    return self.lanes[lane].popleft()
+
+                remaining = end - time.time()
+                if remaining <= 0:
+                    return None
+                self.cond.wait(remaining)
+        finally:
+            self.cond.release()
+
+    def get_batch(self, n, timeout):
+        '''Takes up to n items, all from the lane get() would take the next
+        one from, waiting up to timeout seconds for the first. Each counts
+        against the lane's weight; a batch stops short at the end of the
+        lane's share if other lanes have items waiting.
+
+        returns (lane, list of items), or (None, []) if nothing was put in
+        that time'''
+        end = time.time() + timeout
+        self.cond.acquire()
+        try:
+            while True:
+                lane = self.next_lane()
+                if lane is not None:
+                    break
+                remaining = end - time.time()
+                if remaining <= 0:
+                    return (None, [])
+                self.cond.wait(remaining)
+
+            items = []
+            while self.lanes[lane] and len(items) < n:
+                if items and self.credits[lane] <= 0 and self.qsize() > len(self.lanes[lane]):
+                    break
+                self.credits[lane] -= 1
+                items.append(self.lanes[lane].popleft())
+            return (lane, items)
+        finally:
+            self.cond.release()
+
+    def put_back(self, items, lane):
+        '''Puts items taken from a lane back at its front, in order'''
+        self.cond.acquire()
+        self.lanes[lane].extendleft(reversed(items))
+        self.cond.notify()
+        self.cond.release()
+
+    def next_lane(self):
+        waiting = [lane for lane in self.lanes if self.lanes[lane]]
+        if not waiting:
+            return None
+
+        with_credit = [lane for lane in waiting if self.credits[lane] > 0]
+        if not with_credit:
+            # the lanes with items waiting have all had their share this
+            # round, so start the next one
+            self.credits = dict(self.weights)
+            with_credit = waiting
+        return max(with_credit, key=lambda lane: self.weights[lane])
+
+    def move(self, item, from_lane, to_lane):
+        '''Moves an item waiting in one lane to the back of another.
+
+        returns False if it wasn't waiting in from_lane'''
+        self.cond.acquire()
+        try:
+            try:
+                self.lanes[from_lane].remove(item)
+            except ValueError:
+                return False
+            self.lanes[to_lane].append(item)
+            return True
+        finally:
+            self.cond.release()
+
+    def qsize(self, lane=None):
+        if lane is None:
+            return sum([len(items) for items in self.lanes.values()])
+        return len(self.lanes[lane])
+
+
+class ReadyItems(object):
+    """ In-memory queues of the ids of items that are ready to be worked on:
+        one for aliases, and one for each provider's metrics, each with a
+        lane for each priority (see LaneQueue).
+
+        An id is pending from when it's queued until the worker that took it
+        calls done(), and isn't queued again in between, so the worker's own
+        saves don't put the item straight back on the queue. If it's pushed
+        again in a more urgent lane while it's still waiting (eg someone asks
+        for an item that was imported in bulk), it's moved to that lane.
+
+        Ids a worker takes but gives back go straight back on their queue.
+        Ids a worker can't have, as another worker (maybe in another backend
+        process) has claimed them, are deferred: the dispatcher offers them
+        again once that worker's claim could have run out, in case it never
+        finishes them.
+    """
+
+    def __init__(self, provider_names, lane_weights=None):
+        if lane_weights is None:
+            lane_weights = default_settings.QUEUE_LANES["weights"]
+        self.queues = {"aliases": LaneQueue(lane_weights)}
+        for provider_name in provider_names:
+            self.queues[provider_name] = LaneQueue(lane_weights)
+        # (queue name, id) -> the lane it was queued in
+        self.pending = {}
+        # id -> when to offer it again
+        self.deferred = {}
+        self.lock = threading.Lock()
+
+    def push(self, queue_name, item_id, lane="bulk"):
+        '''returns True if the id was queued'''
+        if queue_name not in self.queues:
+            return False
+
+        self.lock.acquire()
+        try:
+            queued_lane = self.pending.get((queue_name, item_id))
+            if queued_lane is not None:
+                if LANES.index(lane) >= LANES.index(queued_lane):
+                    return False
+                # only look for it in the old lane once; if a worker has
+                # taken it already, there's nothing to move
+                self.pending[(queue_name, item_id)] = lane
+                return self.queues[queue_name].move(item_id, queued_lane, lane)
+            self.pending[(queue_name, item_id)] = lane
+        finally:
+            self.lock.release()
+
+        self.queues[queue_name].put(item_id, lane)
+        return True
+
+    def offer(self, doc):
+        '''Queues a changed doc on each of the queues it is ready for.
+
+        returns the number of queues it was put on'''
+        queued = 0
+        if needs_aliases(doc):
+            queued += self.push("aliases", doc["_id"], item_lane(doc))
+        for provider_name in providers_needing_metrics(doc):
+            queued += self.push(provider_name, doc["_id"], item_lane(doc))
+        # refreshes go in the bulk lane whatever the item's priority
+        for provider_name in pending_refreshes(doc):
+            queued += self.push(provider_name, doc["_id"], "bulk")
+        return queued
+
+    def get(self, queue_name, timeout):
+        '''Takes the next id off a queue, waiting up to timeout seconds.
 
-alias_queue_seen = {}
-alias_queue_lock = threading.Lock()
+        returns None if nothing was queued in that time'''
+        return self.queues[queue_name].get(timeout)
+
+    def get_batch(self, queue_name, n, timeout):
+        '''Takes up to n ids off a queue, all from the same lane (see
+        LaneQueue.get_batch).
+
+        returns (lane, list of ids)'''
+        return self.queues[queue_name].get_batch(n, timeout)
+
+    def put_back(self, queue_name, item_ids, lane):
+        '''Puts ids a worker took but didn't start back at the front of
+        their lane. They stay pending.'''
+        self.queues[queue_name].put_back(item_ids, lane)
+
+    def done(self, queue_name, item_id):
+        self.lock.acquire()
+        self.pending.pop((queue_name, item_id), None)
+        self.lock.release()
+
+    def defer(self, queue_name, item_id, delay):
+        '''Takes an id another worker has claimed off a queue, to be
+        offered again in delay seconds (see take_deferred)'''
+        self.lock.acquire()
+        self.pending.pop((queue_name, item_id), None)
+        self.deferred[item_id] = max(time.time() + delay, self.deferred.get(item_id, 0))
+        self.lock.release()
+
+    def take_deferred(self, now=None):
+        '''returns the deferred ids that are due to be offered again'''
+        if now is None:
+            now = time.time()
+        self.lock.acquire()
+        try:
+            due = [item_id for (item_id, at) in self.deferred.iteritems() if at <= now]
+            for item_id in due:
+                del self.deferred[item_id]
+            return due
+        finally:
+            self.lock.release()
+
+    def qsize(self, queue_name, lane=None):
+        return self.queues[queue_name].qsize(lane)
+
+
+######################################################
+#
+# Claims
+#
+# A worker claims an item before working on it and releases the claim when
+# it's done, so no two workers (in this process, or with CouchClaims in any
+# backend process) work on the same item in the same queue at once. Queues
+# that aren't given a claims store share this in-memory one.
+# 
 
-metric_queue_seen = {}
-metric_queue_lock = threading.Lock()
+local_claims = LocalClaims(default_settings.QUEUE_CLAIMS["lease"])
 
 #######################################################
         
 
 class AliasQueue(Queue):
     
-    def __init__(self, dao, queueid=None):
+    # the alias thread only works on the aliases (and biblio, which is a
+    # plain dict anyway), so don't make all the metrics
+    fields = ["aliases"]
+
+    queue_name = "aliases"
+
+    def __init__(self, dao, queueid=None, ready_items=None, claims=None):
         self.dao = dao
         self.queueid = queueid
+        self.ready_items = ready_items
+        self.claims = claims or local_claims
+
+    def rows(self, **params):
+        # the view rows just have the id and key; ask for include_docs to
+        # get the items too
+        return view_rows(self.dao, 'queues/aliases', self.page_size, **params)
+
+    def row_lane(self, row):
+        # see config/couch/views/aliases.js
+        return row["key"][0]
 
     @property
     def queueids(self):
-        viewname = 'queues/aliases'
-        res = self.dao.view(viewname)
-        return [row["id"] for row in res["rows"]]
+        return [row["id"] for row in self.rows()]
 
     @property
     def queue(self):
-        # due to error in couchdb this reads from json output - see dao view
-        res = self.queueids
         items = []
-        for id in res:
-            my_item = ItemFactory.get(self.dao, 
-		                  id, 
-		                  ProviderFactory.get_provider, 
+        for row in self.rows(include_docs=True):
+            my_item = ItemFactory.get_from_doc(self.dao, 
+		                  row["doc"], 
 		                  default_settings.PROVIDERS)
             items.append(my_item)
 
         return items
 
-    def dequeue(self):
-        item_ids = self.queueids
-        found = None
-    
-        # Synchronised section
-        # This will the the item out of the queue by recording that we
-        # have seen the item.
-        alias_queue_lock.acquire()
-
-        for item_id in item_ids:
-            if not alias_queue_seen.has_key(item_id):
-                log.debug("found item %s" % item_id)
-                alias_queue_seen[item_id] = True
-                found = item_id
-                break
-
-        alias_queue_lock.release()
-
-        if found:
-            my_item = ItemFactory.get(self.dao, 
-                          item_id, 
-                          ProviderFactory.get_provider, 
-                          default_settings.PROVIDERS)
-
-            return my_item
-        else:
-            return None
-
     def save_and_unqueue(self, item):
         item.aliases.last_completed = time.time()
         item.save()
+        self.unqueue(item.id)
 
 class MetricsQueue(Queue):
     
-    def __init__(self, dao, prov=None):
+    def __init__(self, dao, prov=None, ready_items=None, claims=None):
         self.dao = dao
         self._provider = prov
+        self.ready_items = ready_items
+        self.claims = claims or local_claims
+        # the items we've claimed from refresh requests, rather than because
+        # their metrics were out of date
+        self.refreshing = set()
     
     @property
     def provider(self):
@@ -124,60 +521,70 @@ class MetricsQueue(Queue):
     def provider(self, _provider):
         self._provider = _provider
 
-    def dequeue(self):
-        item_ids = self.queueids
-        found = None
+    @property
+    def queue_name(self):
+        return self.provider or "metrics"
 
-        # Synchronised section
-        # This will the the item out of the queue by recording that we
-        # have seen the item.
-        metric_queue_lock.acquire()
+    @property
+    def fields(self):
+        # only make the metrics of the provider we're working for
+        if self.provider:
+            return ["aliases", "metrics:" + self.provider]
+        return ["aliases", "metrics"]
 
-        for item_id in item_ids:
-            if not metric_queue_seen.has_key((item_id, self.provider)):
-                log.debug("found item %s" % item_id)
-                metric_queue_seen[(item_id, self.provider)] = True
-                found = item_id
-                break;
+    def rows(self, **params):
+        # the view rows just have the id and key; ask for include_docs to
+        # get the items too
+        if self._provider:
+            params["startkey"] = [self.provider]
+            params["endkey"] = [self.provider,{}]
+        return view_rows(self.dao, 'queues/metrics', self.page_size, **params)
 
-        metric_queue_lock.release()
+    def row_lane(self, row):
+        # see config/couch/views/metrics.js
+        return row["key"][1]
 
-        if found:
-            return ItemFactory.get(self.dao, 
-                          item_id, 
-                          ProviderFactory.get_provider, 
-                          default_settings.PROVIDERS)
-        else:
+    def claim(self, queued_id):
+        # refresh requests are claimed as the item they're for, so a refresh
+        # and an update of the same item aren't worked on at once
+        tiid = refresh_tiid(queued_id)
+        if tiid is None:
+            return Queue.claim(self, queued_id)
+        if not self.claims.claim(self.queue_name, tiid):
             return None
+        self.refreshing.add(tiid)
+        return tiid
+
+    def queued_id(self, item_id):
+        if item_id in self.refreshing:
+            return refresh_doc_id(item_id)
+        return item_id
+
+    def release(self, item_ids, lane):
+        Queue.release(self, item_ids, lane)
+        self.refreshing.difference_update(item_ids)
+
+    def unqueue(self, item_id):
+        Queue.unqueue(self, item_id)
+        self.refreshing.discard(item_id)
 
     @property
     def queueids(self):
-        # change this for live
-        viewname = 'queues/metrics'
-        if self._provider:
-            res = self.dao.view(
-                viewname,
-                startkey=[self.provider,None,None],
-                endkey=[self.provider,u'\ufff0',u'\ufff0']
-                )
-        else:
-            res = self.dao.view(viewname)
-        return [row["id"] for row in res["rows"]]
+        return [row["id"] for row in self.rows()]
 
     @property
     def queue(self):
-        res = self.queueids
         items = []
-        # using reversed() as a hack...we actually want to use the couchdb
-        # descending=true param to get the oldest stuff first, but
-        for id in res:
-            my_item = ItemFactory.get(self.dao, 
-                          item_id, 
-                          ProviderFactory.get_provider, 
+        for row in self.rows(include_docs=True):
+            my_item = ItemFactory.get_from_doc(self.dao, 
+                          row["doc"], 
                           default_settings.PROVIDERS)
             items.append(my_item)
         return items
 
     def save_and_unqueue(self, item):
         item.save()
+        if item.id in self.refreshing:
+            complete_refresh(self.dao, item.id, self.provider, time.time())
+        self.unqueue(item.id)
 
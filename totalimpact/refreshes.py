@@ -0,0 +1,50 @@
+import couchdb
+from totalimpact.tilogging import logging
+
+# set up logging
+logger = logging.getLogger(__name__)
+
+REFRESH_ID_PREFIX = "refresh:"
+
+
+def refresh_doc_id(tiid):
+    return REFRESH_ID_PREFIX + tiid
+
+def refresh_doc(tiid):
+    # requested and completed are provider name -> time
+    return {"id": refresh_doc_id(tiid), "type": "refresh_request", "tiid": tiid,
+        "requested": {}, "completed": {}}
+
+def refresh_tiid(doc_id):
+    '''The tiid a refresh request doc is for, or None if doc_id isn't one'''
+    if doc_id.startswith(REFRESH_ID_PREFIX):
+        return doc_id[len(REFRESH_ID_PREFIX):]
+    return None
+
+def pending_refreshes(doc):
+    '''The providers a refresh request doc asks for that haven't been done;
+    the queues/metrics view lists it under each of them'''
+    if doc.get("type") != "refresh_request" or doc.get("_deleted"):
+        return []
+    completed = doc.get("completed") or {}
+    return [provider_name for (provider_name, requested) in doc["requested"].iteritems()
+        if requested > completed.get(provider_name, 0)]
+
+def complete_refresh(dao, tiid, provider_name, now, retries=5):
+    '''Marks a provider's refresh of an item done, so it comes off the
+    provider's metrics queue.
+
+    returns False if the refresh request doc kept changing under us'''
+    for attempt in range(retries):
+        doc = dao.get(refresh_doc_id(tiid))
+        if doc is None or provider_name not in pending_refreshes(doc):
+            return True
+        doc.setdefault("completed", {})[provider_name] = now
+        try:
+            dao.save_and_commit(doc)
+            return True
+        except couchdb.ResourceConflict:
+            # the scheduler just asked for another provider's refresh
+            pass
+    logger.warning("couldn't mark refresh of %s by %s done" % (tiid, provider_name))
+    return False
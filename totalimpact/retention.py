@@ -0,0 +1,124 @@
+import time
+from totalimpact.dao import view_rows
+from totalimpact.models import ItemFactory, snapshot_time
+from totalimpact.tilogging import logging
+
+# set up logging
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_ID_PREFIX = "snapshot:"
+
+
+def snapshot_bucket(ts, now, policy):
+    '''Returns the bucket that a snapshot taken at time ts falls in under the
+    retention policy: None if it's new enough that all snapshots are kept,
+    else the day or month it was taken in.'''
+    age_days = (now - ts) / 86400.0
+    if age_days <= policy["keep_all_days"]:
+        return None
+
+    taken = time.gmtime(ts)
+    if age_days <= policy["keep_daily_days"]:
+        return ("day", taken.tm_year, taken.tm_mon, taken.tm_mday)
+    return ("month", taken.tm_year, taken.tm_mon)
+
+def snapshots_to_drop(snapshot_docs, now, policy):
+    '''Works out which of the snapshots of one provider's metrics on one item
+    the retention policy drops: all but the newest in each day or month
+    bucket, and failed refreshes (every value None) past keep_all_days.
+
+    returns a list of the docs to drop'''
+    drop = []
+    kept_buckets = set()
+
+    newest_first = sorted(snapshot_docs, key=lambda doc: snapshot_time(doc["ts"]), reverse=True)
+    for doc in newest_first:
+        ts = snapshot_time(doc["ts"])
+        if not ts:
+            # not a time we understand, so leave it be
+            continue
+
+        bucket = snapshot_bucket(ts, now, policy)
+        if bucket is None:
+            continue
+
+        failed = [value for value in doc["values"].values() if value is not None] == []
+        if failed or bucket in kept_buckets:
+            drop.append(doc)
+        else:
+            kept_buckets.add(bucket)
+
+    return drop
+
+
+class MetricsCompactor(object):
+    """ Applies the metrics retention policy to the db
+
+        Each run pages through the snapshot docs (the snapshot: range of
+        _all_docs) and drops the ones the policy says to. Then items that
+        still have their whole metric history in their own doc (listed by
+        the queues/legacy_items view) have it moved out to snapshots, so old
+        items shrink too.
+    """
+
+    def __init__(self, dao, providers_config, policy):
+        self.dao = dao
+        self.providers_config = providers_config
+        self.policy = policy
+
+    def run(self, now=None, stopped=None):
+        '''Does one pass over the db. stopped is an optional function that
+        returns True when we should give up early.
+
+        returns (items shrunk, snapshots dropped)'''
+        if now is None:
+            now = time.time()
+
+        items_shrunk = 0
+        snapshots_dropped = 0
+
+        # snapshot ids start with the tiid and provider, so all the snapshots
+        # of a provider on an item come one after the other
+        group_key = None
+        group = []
+
+        for doc in self.read('_all_docs', stopped, startkey=SNAPSHOT_ID_PREFIX,
+                endkey=SNAPSHOT_ID_PREFIX + u"\ufff0"):
+            if (doc["tiid"], doc["provider"]) != group_key:
+                snapshots_dropped += self.compact_snapshots(group, now)
+                group_key = (doc["tiid"], doc["provider"])
+                group = []
+            group.append(doc)
+        snapshots_dropped += self.compact_snapshots(group, now)
+
+        for doc in self.read('queues/legacy_items', stopped):
+            items_shrunk += self.shrink_item(doc)
+
+        logger.info("compacted metrics: %i items shrunk, %i snapshots dropped" % (
+            items_shrunk, snapshots_dropped))
+        return (items_shrunk, snapshots_dropped)
+
+    def read(self, viewname, stopped=None, **params):
+        '''Generates the docs listed by a view, page_size at a time'''
+        for row in view_rows(self.dao, viewname, self.policy["page_size"],
+                include_docs=True, **params):
+            if stopped is not None and stopped():
+                return
+            yield row["doc"]
+
+    def compact_snapshots(self, snapshot_docs, now):
+        drop = snapshots_to_drop(snapshot_docs, now, self.policy)
+        for (success, docid, rev_or_exc) in self.dao.bulk_delete(drop):
+            if not success:
+                logger.info("couldn't drop snapshot %s: %s" % (docid, rev_or_exc))
+        return len(drop)
+
+    def shrink_item(self, item_doc):
+        # the metrics are moved as they are in the doc, so make nothing
+        item = ItemFactory.get_from_doc(self.dao, item_doc, self.providers_config, fields=[])
+        # don't make it look like the item was requested
+        item.last_requested = item_doc.get("last_requested")
+        if not ItemFactory.move_metrics_history(self.dao, item):
+            return 0
+        item.save()
+        return 1
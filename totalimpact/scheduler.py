@@ -0,0 +1,149 @@
+import time
+from totalimpact.models import snapshot_time
+from totalimpact.dao import view_rows
+from totalimpact.itemviews import last_viewed_times
+from totalimpact.refreshes import refresh_doc_id, refresh_doc
+from totalimpact.tilogging import logging
+
+# set up logging
+logger = logging.getLogger(__name__)
+
+
+def provider_metrics(doc, provider_name):
+    '''The metrics in an item doc from one provider, leaving out ignored ones'''
+    return [metric for (metric_name, metric) in doc.get("metrics", {}).iteritems()
+        if metric_name.split(":")[0] == provider_name and not metric.get("ignore")]
+
+def refresh_interval(metrics, base_interval, max_backoff):
+    '''How long to leave a provider's metrics on an item before refreshing
+    them: base_interval, stretched out the longer the values have stayed
+    the same, up to max_backoff times.'''
+    stable_for = None
+    for metric in metrics:
+        if not metric.get("values"):
+            continue
+        latest_ts = snapshot_time(max(metric["values"], key=snapshot_time))
+        last_changed = snapshot_time(metric.get("last_changed") or latest_ts)
+        metric_stable_for = max(0, latest_ts - last_changed)
+        # if any of them is changing, they're all worth refreshing
+        if stable_for is None or metric_stable_for < stable_for:
+            stable_for = metric_stable_for
+
+    backoff = 1 + (stable_for or 0) / float(base_interval)
+    return base_interval * min(backoff, max_backoff)
+
+def providers_to_refresh(doc, now, providers_config, policy, last_viewed=None,
+        requested=None):
+    '''Works out which providers' metrics on an item are due a refresh.
+
+    Items nobody has requested or viewed in idle_days aren't refreshed.
+    last_viewed is from the item's view doc (see itemviews), if it has one;
+    items from before those were kept may have it in the doc.
+    Metrics that have never been fetched are left to the metrics queue, as
+    are ones with a refresh already requested since they were last updated;
+    requested is from the item's refresh request doc (see refreshes), if it
+    has one.
+
+    returns a list of provider names'''
+    aliases = doc.get("aliases")
+    if not isinstance(aliases, dict) or not aliases.get("last_completed"):
+        return []
+
+    last_active = max(last_viewed or doc.get("last_viewed") or 0,
+        doc.get("last_requested") or 0)
+    if now - last_active > policy["idle_days"] * 86400:
+        return []
+
+    requested = requested or {}
+    due = []
+    for (provider_name, provider_config) in providers_config.iteritems():
+        metrics = provider_metrics(doc, provider_name)
+        last_modified = max([snapshot_time(ts) for metric in metrics for ts in metric.get("values", {})] or [0])
+        if not last_modified or requested.get(provider_name, 0) > last_modified:
+            continue
+
+        interval = refresh_interval(metrics,
+            provider_config.get("refresh_interval", policy["refresh_interval"]),
+            policy["max_backoff"])
+        if now - last_modified >= interval:
+            due.append(provider_name)
+    return due
+
+
+class RefreshScheduler(object):
+    """ Asks for items' metrics to be refreshed when they're due (see
+        providers_to_refresh)
+
+        Each run reads when items were last viewed, then for each provider
+        reads the items from the queues/refresh view whose metrics from it
+        haven't been updated for at least its refresh interval. A refresh is
+        requested by setting the time for the provider in the item's refresh
+        request doc (see refreshes), which puts the item on that provider's
+        metrics queue until the refresh is done. The items themselves aren't
+        written to, so their etags stay the same until their metrics change.
+    """
+
+    def __init__(self, dao, providers_config, policy):
+        self.dao = dao
+        self.providers_config = providers_config
+        self.policy = policy
+
+    def run(self, now=None, stopped=None):
+        '''Does one pass over the stale items. stopped is an optional
+        function that returns True when we should give up early.
+
+        returns the number of refreshes requested'''
+        if now is None:
+            now = time.time()
+
+        requested = 0
+        last_viewed = last_viewed_times(self.dao, self.policy["page_size"])
+        for (provider_name, provider_config) in sorted(self.providers_config.iteritems()):
+            if stopped is not None and stopped():
+                break
+            interval = provider_config.get("refresh_interval", self.policy["refresh_interval"])
+            page = []
+            # metrics only get longer between refreshes (see refresh_interval),
+            # so the ones updated since now - interval aren't due
+            for row in view_rows(self.dao, 'queues/refresh', self.policy["page_size"],
+                    include_docs=True, startkey=[provider_name],
+                    endkey=[provider_name, now - interval]):
+                if stopped is not None and stopped():
+                    break
+                page.append(row["doc"])
+                if len(page) >= self.policy["page_size"]:
+                    requested += self.request(provider_name, page, now, last_viewed)
+                    page = []
+            requested += self.request(provider_name, page, now, last_viewed)
+
+        logger.info("requested %i metrics refreshes" % requested)
+        return requested
+
+    def request(self, provider_name, docs, now, last_viewed):
+        '''Requests the refreshes from a provider due on a page of items.
+
+        returns the number requested'''
+        if not docs:
+            return 0
+        tiids = [doc["_id"] for doc in docs]
+        refresh_docs = self.dao.get_bulk([refresh_doc_id(tiid) for tiid in tiids])
+        to_save = []
+        for (doc, refresh) in zip(docs, refresh_docs):
+            if refresh is None:
+                refresh = refresh_doc(doc["_id"])
+            due = providers_to_refresh(doc, now,
+                {provider_name: self.providers_config[provider_name]}, self.policy,
+                last_viewed.get(doc["_id"]), refresh["requested"])
+            if due:
+                refresh["requested"][provider_name] = now
+                to_save.append(refresh)
+
+        requested = 0
+        for (success, docid, rev_or_exc) in self.dao.bulk_save(to_save):
+            if success:
+                requested += 1
+            else:
+                # a worker is marking a refresh done; we'll look at it again
+                # next run
+                logger.info("couldn't request refresh of %s: %s" % (docid, rev_or_exc))
+        return requested
@@ -0,0 +1,217 @@
+import threading, time
+from copy import deepcopy
+import couchdb
+from totalimpact.queue import LANES
+from totalimpact.tilogging import logging
+
+# set up logging
+logger = logging.getLogger(__name__)
+
+STATS_ID_PREFIX = "backend_stats:"
+
+
+def oldest_requested(dao, viewname, prefix):
+    '''The last request time in the first row of a queue view whose key
+    starts with prefix (the key up to the lane), or None if there isn't one'''
+    rows = dao.view(viewname, startkey=prefix, endkey=prefix + [{}], limit=1)["rows"]
+    if not rows:
+        return None
+    return rows[0]["key"][len(prefix)]
+
+def queue_depths(dao):
+    '''Reads how many items are waiting in each queue and lane, and when the
+    oldest of them was requested.
+
+    The _depth views count the rows of the queue views in couch's reduce
+    index, so this takes a query for the counts and one for the oldest row
+    of each queue and lane with anything in it, however long the backlog.
+
+    returns a dict of queue name -> lane -> {"depth", "oldest_requested"}'''
+    depths = {}
+
+    # see the keys the views emit in config/couch/views
+    for row in dao.view('queues/aliases_depth', group_level=1)["rows"]:
+        depths.setdefault("aliases", {})[LANES[row["key"][0]]] = {
+            "depth": row["value"],
+            "oldest_requested": oldest_requested(dao, 'queues/aliases', row["key"])
+        }
+    for row in dao.view('queues/metrics_depth', group_level=2)["rows"]:
+        (provider_name, lane) = row["key"]
+        depths.setdefault(provider_name, {})[LANES[lane]] = {
+            "depth": row["value"],
+            "oldest_requested": oldest_requested(dao, 'queues/metrics', row["key"])
+        }
+
+    return depths
+
+def backend_stats_docs(dao, now, max_age):
+    '''The stats docs published by the backend processes, leaving out ones
+    that haven't been updated in max_age seconds (their process has most
+    likely gone)'''
+    res = dao.view('_all_docs', include_docs=True,
+        startkey=STATS_ID_PREFIX, endkey=STATS_ID_PREFIX + u"\ufff0")
+    return [row["doc"] for row in res["rows"]
+        if now - row["doc"].get("updated", 0) <= max_age]
+
+def queue_report(dao, provider_names, now, max_age):
+    '''Puts together the queue depths from the views with the counters the
+    backend processes publish, for GET /queues.
+
+    returns a dict like:
+        {"queues": {queue name: {"depth", "oldest_age", "ready", "dequeued",
+                                 "dequeue_rate", "lanes": {...}}},
+         "providers": {provider name: {method: {"success", "errors",
+                                                "latency"}}},
+         "backends": [{"owner", "updated", "started"}]}'''
+    depths = queue_depths(dao)
+    docs = backend_stats_docs(dao, now, max_age)
+
+    queues = {}
+    for queue_name in ["aliases"] + list(provider_names):
+        lanes = {}
+        for lane in LANES:
+            lane_depth = depths.get(queue_name, {}).get(lane)
+            if lane_depth is None:
+                lanes[lane] = {"depth": 0, "oldest_age": None}
+            else:
+                # items from before last_requested was kept don't have it
+                oldest_age = None
+                if lane_depth["oldest_requested"] is not None:
+                    oldest_age = now - lane_depth["oldest_requested"]
+                lanes[lane] = {"depth": lane_depth["depth"], "oldest_age": oldest_age}
+
+        ages = [lanes[lane]["oldest_age"] for lane in LANES if lanes[lane]["oldest_age"] is not None]
+        queues[queue_name] = {
+            "depth": sum([lanes[lane]["depth"] for lane in LANES]),
+            "oldest_age": max(ages or [None]),
+            "lanes": lanes,
+            "ready": 0,
+            "dequeued": 0,
+            "dequeue_rate": 0.0
+        }
+
+    providers = {}
+    for doc in docs:
+        for (queue_name, counts) in doc.get("queues", {}).iteritems():
+            if queue_name in queues:
+                for key in ["ready", "dequeued", "dequeue_rate"]:
+                    queues[queue_name][key] += counts.get(key, 0)
+        for (provider_name, methods) in doc.get("providers", {}).iteritems():
+            for (method, counts) in methods.iteritems():
+                merge_provider_counts(
+                    providers.setdefault(provider_name, {}).setdefault(method, new_provider_counts()),
+                    counts)
+
+    backends = [{"owner": doc["owner"], "started": doc["started"], "updated": doc["updated"]}
+        for doc in docs]
+
+    return {"queues": queues, "providers": providers, "backends": backends}
+
+def new_provider_counts():
+    return {"success": 0, "errors": {}, "latency": {"count": 0, "total": 0.0, "max": 0.0}}
+
+def merge_provider_counts(total, counts):
+    total["success"] += counts["success"]
+    for (error_type, n) in counts["errors"].iteritems():
+        total["errors"][error_type] = total["errors"].get(error_type, 0) + n
+    total["latency"]["count"] += counts["latency"]["count"]
+    total["latency"]["total"] += counts["latency"]["total"]
+    total["latency"]["max"] = max(total["latency"]["max"], counts["latency"]["max"])
+
+
+class BackendStats(object):
+    """ Counts what the worker threads in this backend process get done:
+        how many items they take off each queue, and how each call to a
+        provider goes (success or error type, and how long it took).
+
+        The counts are totals since the process started. publish() saves
+        them to the db every so often, with the rate items were taken off
+        each queue since it last did, so the API can report on all the
+        backend processes.
+    """
+
+    def __init__(self, owner, ready_items=None):
+        self.owner = owner
+        self.ready_items = ready_items
+        self.started = time.time()
+        self.dequeued = {}
+        self.providers = {}
+        self.lock = threading.Lock()
+
+        # what we had last time we published, for the rates
+        self.published = (self.started, {})
+        self.rev = None
+
+    def count_dequeued(self, queue_name, n):
+        self.lock.acquire()
+        self.dequeued[queue_name] = self.dequeued.get(queue_name, 0) + n
+        self.lock.release()
+
+    def count_provider_call(self, provider_name, method, error_type, latency):
+        '''error_type is None if the call succeeded'''
+        self.lock.acquire()
+        try:
+            counts = self.providers.setdefault(provider_name, {}).setdefault(method,
+                new_provider_counts())
+            if error_type is None:
+                counts["success"] += 1
+            else:
+                counts["errors"][error_type] = counts["errors"].get(error_type, 0) + 1
+            counts["latency"]["count"] += 1
+            counts["latency"]["total"] += latency
+            counts["latency"]["max"] = max(counts["latency"]["max"], latency)
+        finally:
+            self.lock.release()
+
+    def as_doc(self, now):
+        self.lock.acquire()
+        try:
+            (last_time, last_dequeued) = self.published
+            elapsed = max(now - last_time, 1e-6)
+            queue_names = set(self.dequeued)
+            if self.ready_items is not None:
+                queue_names.update(self.ready_items.queues)
+
+            queues = {}
+            for queue_name in queue_names:
+                n = self.dequeued.get(queue_name, 0)
+                queues[queue_name] = {
+                    "dequeued": n,
+                    "dequeue_rate": (n - last_dequeued.get(queue_name, 0)) / elapsed,
+                    "ready": 0
+                }
+                if self.ready_items is not None and queue_name in self.ready_items.queues:
+                    # ids pushed to this process, waiting for a worker
+                    queues[queue_name]["ready"] = self.ready_items.qsize(queue_name)
+            self.published = (now, dict(self.dequeued))
+
+            return {
+                "id": STATS_ID_PREFIX + self.owner,
+                "type": "backend_stats",
+                "owner": self.owner,
+                "started": self.started,
+                "updated": now,
+                "queues": queues,
+                "providers": deepcopy(self.providers)
+            }
+        finally:
+            self.lock.release()
+
+    def publish(self, dao, now=None):
+        if now is None:
+            now = time.time()
+        doc = self.as_doc(now)
+        if self.rev is None:
+            # we may be a restarted process with the same owner
+            current = dao.get(doc["id"])
+            if current is not None:
+                self.rev = current["_rev"]
+        if self.rev is not None:
+            doc["_rev"] = self.rev
+
+        try:
+            (id, self.rev) = dao.save(doc)
+        except couchdb.ResourceConflict:
+            # we'll pick up the current rev next time
+            logger.info("conflict publishing %s" % doc["id"])
+            self.rev = None